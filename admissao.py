@@ -0,0 +1,205 @@
+# admissao.py - Controle de admissão do /chat: concorrência das chamadas à IA e limite de taxa por token
+#
+# Concorrência: cada worker deixa no máximo IA_CONCORRENCIA_MAX requisições de
+# chat (e, portanto, chamadas à OpenRouter) em andamento. Até IA_FILA_MAX
+# requisições esperam a vez por no máximo IA_FILA_TIMEOUT segundos; com a fila
+# cheia a requisição é recusada na hora com 429 + Retry-After. Um pico vira
+# fila curta + recusas rápidas em vez de todos os workers presos na OpenRouter
+# (e 429 dela para todo mundo). O teto total é WEB_CONCURRENCY x IA_CONCORRENCIA_MAX.
+#
+# Taxa por token: balde de fichas (token bucket) de CHAT_TAXA_RAJADA fichas,
+# reposto a CHAT_TAXA_POR_MINUTO fichas por minuto. O balde fica no banco
+# (painel.consumir_ficha_taxa), então o limite vale somado entre workers e nós.
+#
+# A vaga é reservada antes de gravar a mensagem do usuário (uma requisição
+# recusada não deixa rastro no histórico) e devolvida no teardown da requisição;
+# no /chat/stream, só quando o stream termina (log_estruturado.stream_com_contexto).
+#
+# Variáveis de ambiente:
+#   IA_CONCORRENCIA_MAX   requisições de chat simultâneas por worker (padrão 50; 0 = sem limite)
+#   IA_FILA_MAX           requisições esperando vaga por worker (padrão 100)
+#   IA_FILA_TIMEOUT       segundos máximos na fila (padrão 10)
+#   IA_RETRY_AFTER        Retry-After (s) das recusas por sobrecarga (padrão 5)
+#   CHAT_TAXA_POR_MINUTO  mensagens por minuto por token (padrão 10; 0 = sem limite)
+#   CHAT_TAXA_RAJADA      mensagens seguidas permitidas antes do limite (padrão 5)
+
+import os
+import math
+import time
+import threading
+
+from flask import g
+
+import metricas
+import log_estruturado
+
+IA_CONCORRENCIA_MAX = int(os.getenv("IA_CONCORRENCIA_MAX", "50"))
+IA_FILA_MAX = int(os.getenv("IA_FILA_MAX", "100"))
+IA_FILA_TIMEOUT = float(os.getenv("IA_FILA_TIMEOUT", "10"))
+IA_RETRY_AFTER = int(os.getenv("IA_RETRY_AFTER", "5"))
+CHAT_TAXA_POR_MINUTO = float(os.getenv("CHAT_TAXA_POR_MINUTO", "10"))
+CHAT_TAXA_RAJADA = float(os.getenv("CHAT_TAXA_RAJADA", "5"))
+
+
+class SobrecargaError(Exception):
+    """Requisição recusada pelo controle de admissão (vira 429 com Retry-After)."""
+
+    def __init__(self, motivo: str, retry_after: int, mensagem: str):
+        super().__init__(mensagem)
+        self.motivo = motivo  # 'fila_cheia', 'fila_timeout' ou 'taxa'
+        self.retry_after = max(1, retry_after)
+
+
+class Vaga:
+    """Vaga reservada no limitador; liberar() pode ser chamado mais de uma vez."""
+
+    __slots__ = ("_limitador", "_liberada")
+
+    def __init__(self, limitador):
+        self._limitador = limitador
+        self._liberada = limitador is None  # Sem limitador (IA_CONCORRENCIA_MAX=0): nada a devolver
+
+    def liberar(self):
+        if not self._liberada:
+            self._liberada = True
+            self._limitador._sair()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.liberar()
+
+
+class LimitadorConcorrencia:
+    """
+    Semáforo com fila de espera limitada: até `maximo` vagas em uso, até `fila_max`
+    esperando por no máximo `timeout` segundos; além disso recusa sem esperar.
+    Thread-safe (e cooperativo com o monkey-patch do gevent).
+    """
+
+    def __init__(self, maximo: int = IA_CONCORRENCIA_MAX, fila_max: int = IA_FILA_MAX,
+                 timeout: float = IA_FILA_TIMEOUT):
+        self.maximo = maximo
+        self.fila_max = max(0, fila_max)
+        self.timeout = timeout
+        self._em_uso = 0
+        self._na_fila = 0
+        self._cond = threading.Condition()
+        self._stats = {"admitidas": 0, "esperaram": 0, "espera_total_s": 0.0, "espera_max_s": 0.0,
+                       "pico_em_uso": 0, "pico_fila": 0, "recusadas_fila_cheia": 0, "recusadas_timeout": 0}
+
+    def reservar(self) -> Vaga:
+        """Vaga livre (esperando na fila se preciso) ou SobrecargaError."""
+        if self.maximo <= 0:
+            return Vaga(None)
+        with self._cond:
+            if self._em_uso >= self.maximo:
+                if self._na_fila >= self.fila_max:
+                    self._stats["recusadas_fila_cheia"] += 1
+                    metricas.ADMISSAO_RECUSAS.labels(motivo="fila_cheia").inc()
+                    raise SobrecargaError("fila_cheia", IA_RETRY_AFTER, "Serviço sobrecarregado no momento. Tente novamente em instantes.")
+                self._na_fila += 1
+                self._stats["pico_fila"] = max(self._stats["pico_fila"], self._na_fila)
+                metricas.IA_FILA.inc()
+                inicio = time.monotonic()
+                try:
+                    livre = self._cond.wait_for(lambda: self._em_uso < self.maximo, self.timeout)
+                finally:
+                    self._na_fila -= 1
+                    metricas.IA_FILA.dec()
+                espera = time.monotonic() - inicio
+                self._stats["esperaram"] += 1
+                self._stats["espera_total_s"] += espera
+                self._stats["espera_max_s"] = max(self._stats["espera_max_s"], espera)
+                if not livre:
+                    self._stats["recusadas_timeout"] += 1
+                    metricas.ADMISSAO_RECUSAS.labels(motivo="fila_timeout").inc()
+                    raise SobrecargaError("fila_timeout", IA_RETRY_AFTER, "Serviço sobrecarregado no momento. Tente novamente em instantes.")
+            self._em_uso += 1
+            self._stats["admitidas"] += 1
+            self._stats["pico_em_uso"] = max(self._stats["pico_em_uso"], self._em_uso)
+        metricas.IA_EM_ANDAMENTO.inc()
+        return Vaga(self)
+
+    def _sair(self):
+        with self._cond:
+            self._em_uso -= 1
+            self._cond.notify()
+        metricas.IA_EM_ANDAMENTO.dec()
+
+    def estatisticas(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats, em_uso=self._em_uso, na_fila=self._na_fila)
+        stats["maximo"] = self.maximo
+        stats["fila_max"] = self.fila_max
+        stats["espera_media_s"] = stats["espera_total_s"] / stats["esperaram"] if stats["esperaram"] else 0.0
+        return stats
+
+
+# --- Limite de taxa por token ---
+
+_recusas_taxa = 0
+
+
+def verificar_taxa(user_token: str, consumir_ficha):
+    """
+    Tira uma ficha do balde do token (`consumir_ficha(chave, capacidade, por_segundo) -> bool`,
+    ver painel.consumir_ficha_taxa) ou levanta SobrecargaError('taxa').
+    """
+    global _recusas_taxa
+    if CHAT_TAXA_POR_MINUTO <= 0:
+        return
+    por_segundo = CHAT_TAXA_POR_MINUTO / 60
+    if consumir_ficha(f"chat:{user_token}", max(1.0, CHAT_TAXA_RAJADA), por_segundo):
+        return
+    _recusas_taxa += 1
+    metricas.ADMISSAO_RECUSAS.labels(motivo="taxa").inc()
+    raise SobrecargaError("taxa", math.ceil(1 / por_segundo),
+                          "Muitas mensagens em pouco tempo. Aguarde alguns segundos e tente de novo.")
+
+
+# --- Limitador do processo (recriado após fork) e integração com o Flask ---
+
+_limitador = None
+_limitador_pid = None
+_limitador_lock = threading.Lock()
+
+
+def obter_limitador() -> LimitadorConcorrencia:
+    global _limitador, _limitador_pid
+    pid = os.getpid()
+    if _limitador is None or _limitador_pid != pid:
+        with _limitador_lock:
+            if _limitador is None or _limitador_pid != pid:
+                _limitador = LimitadorConcorrencia()
+                _limitador_pid = pid
+    return _limitador
+
+
+def admitir(user_token: str, consumir_ficha):
+    """
+    Limite de taxa do token + vaga no limitador de concorrência. A vaga fica em `g`
+    e é devolvida no teardown da requisição (ver instalar). Levanta SobrecargaError.
+    """
+    verificar_taxa(user_token, consumir_ficha)
+    g._vaga_ia = obter_limitador().reservar()
+
+
+def instalar(app):
+    """Registra o teardown que devolve a vaga da requisição (no fim do stream, no /chat/stream)."""
+
+    @app.teardown_request
+    def _liberar_vaga(erro):
+        if log_estruturado.em_stream():
+            return
+        vaga = g.pop("_vaga_ia", None)
+        if vaga is not None:
+            vaga.liberar()
+
+
+def estatisticas() -> dict:
+    return {
+        "concorrencia": obter_limitador().estatisticas(),
+        "taxa": {"por_minuto": CHAT_TAXA_POR_MINUTO, "rajada": CHAT_TAXA_RAJADA, "recusadas": _recusas_taxa},
+    }
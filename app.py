@@ -4,16 +4,25 @@ import os
 import requests
 # Importação do Flash adicionada
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash 
+from flask import Response, g
 from dotenv import load_dotenv
 import logging
-from datetime import datetime
 import json
+import io
+import csv
+import time
+import functools
+import re
 
 # Configuração de Logging 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Carrega variáveis de ambiente do .env 
 load_dotenv_success = load_dotenv(override=True, verbose=True)
+
+# Logging em fila/JSON com um registro consolidado por requisição (ver log_estruturado.py)
+import log_estruturado
+log_estruturado.configurar()
 logging.info(f"Arquivo .env carregado com sucesso? {load_dotenv_success}")
 
 # --- Modificação 1: Adicionar Importação do buscar_token_ativo_por_telefone ---
@@ -23,7 +32,13 @@ try:
         verificar_token_valido, 
         atualizar_validade_token, 
         buscar_token_ativo_por_telefone,  # <--- LINHA ADICIONADA/GARANTIDA
-        criar_tabela_chat_history, add_chat_message, get_chat_history 
+        criar_tabela_chat_history, add_chat_message, get_chat_history,
+        registrar_turno_chat, estatisticas_pool, estatisticas_cache_tokens,
+        estatisticas_cache_historico, estatisticas_resumidor, estatisticas_escrita,
+        configurar_resumidor, limitar_janela_resumo, obter_resumo_conversa, listar_tokens_pagina,
+        importar_tokens_lote, alterar_tokens_lote, verificar_esquema,
+        configurar_metricas, consumir_ficha_taxa, reservar_idempotencia,
+        concluir_idempotencia, liberar_idempotencia
     )
     PAINEL_IMPORTADO = True
     logging.info("Módulo 'painel' (com buscar_token) e chat importados com sucesso.")
@@ -52,12 +67,77 @@ except ImportError as e:
         return None
     def criar_tabela_chat_history(): 
         logging.info("Placeholder: Criar tabela chat")
+    def verificar_esquema(): 
+        logging.info("Placeholder: Verificar esquema")
+        return True
+    def configurar_metricas(observador): 
+        pass
     def add_chat_message(ut, r, c): 
         logging.info(f"Placeholder: Add chat msg {ut[:8]} R:{r}")
         return True
     def get_chat_history(ut, lim): 
         logging.info(f"Placeholder: Get chat hist {ut[:8]}")
         return []
+    def registrar_turno_chat(ut, c, limit=20, chave_idempotencia=None): 
+        logging.info(f"Placeholder: Turno chat {ut[:8]}")
+        return [{"role": "user", "content": c}]
+    def estatisticas_pool(): 
+        return {}
+    def estatisticas_cache_tokens(): 
+        return {}
+    def estatisticas_cache_historico(): 
+        return {}
+    def estatisticas_resumidor(): 
+        return {}
+    def estatisticas_escrita(): 
+        return {}
+    def configurar_resumidor(fn, janela): 
+        logging.info("Placeholder: Resumidor desligado")
+    def limitar_janela_resumo(ut, n): 
+        pass
+    def obter_resumo_conversa(ut): 
+        return None
+    def listar_tokens_pagina(busca=None, status=None, cursor=None, limite=50): 
+        logging.info("Placeholder: Listar página de tokens")
+        return [], None
+    def importar_tokens_lote(arquivo, formato="csv", dias_validade=7, progresso=None): 
+        logging.info("Placeholder: Importar tokens")
+        return None
+    def alterar_tokens_lote(operacao, busca=None, status=None, dias=None): 
+        logging.info(f"Placeholder: Operação em lote {operacao}")
+        return None
+    def consumir_ficha_taxa(chave, capacidade, por_segundo): 
+        return True
+    def reservar_idempotencia(ut, chave): 
+        return "nova", None
+    def concluir_idempotencia(ut, chave, resposta): 
+        return False
+    def liberar_idempotencia(ut, chave): 
+        return False
+
+# Cliente HTTP da OpenRouter (keep-alive, retries, circuit breaker)
+from openrouter import obter_cliente, CircuitoAbertoError
+
+# Lista ordenada de modelos com hedge entre eles (ver modelos_ia.py)
+import modelos_ia
+
+# Montagem do contexto por orçamento de tokens
+from contexto import montar_contexto, CONTEXT_MAX_MSGS, CONTEXT_TOKEN_BUDGET
+
+# Cache opcional de respostas para aberturas de conversa ("Oi", "bom dia"...)
+from cache_respostas import RESPONSE_CACHE, chave_para, versao_prompt, cache as cache_respostas
+
+# Métricas Prometheus (/metrics), somadas entre os workers do gunicorn
+import metricas
+from metricas import medir, CHAT_ETAPA, CHAT_RESULTADO
+configurar_metricas(metricas.observar_bd)
+
+# Controle de admissão do /chat: limite de concorrência das chamadas à IA e de taxa por token (429)
+import admissao
+from admissao import SobrecargaError
+
+# Estáticos com hash no nome, pré-comprimidos, e o service worker do app shell
+import estaticos
 
 # Importa pytz 
 try:
@@ -77,15 +157,25 @@ except ImportError:
 
 # Configuração do App Flask 
 app = Flask(__name__)
+log_estruturado.instalar(app)
+admissao.instalar(app)
+estaticos.instalar(app)
 app.secret_key = os.getenv("PAINEL_SENHA", "configure-uma-chave-secreta-forte-no-env")
 if app.secret_key == "configure-uma-chave-secreta-forte-no-env":
     logging.warning("PAINEL_SENHA não definida!")
+PAINEL_POR_PAGINA = int(os.getenv("PAINEL_POR_PAGINA", "50"))  # tokens por página no painel admin
+IDEMPOTENCIA_ESPERA = float(os.getenv("IDEMPOTENCIA_ESPERA", "60"))  # segundos que um reenvio espera a requisição original
+IDEMPOTENCIA_INTERVALO = 0.25  # segundos entre as consultas do reenvio que espera
+CHAVE_IDEMPOTENCIA_VALIDA = re.compile(r"^[A-Za-z0-9_-]{8,64}$")  # UUID do navegador e afins
 
 # Configurações da IA 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
-AI_MODEL = "deepseek/deepseek-chat-v3-0324" 
-logging.info(f"Usando modelo de IA: {AI_MODEL}")
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+AI_MODEL = modelos_ia.AI_MODELS[0]  # Principal
+# A chave do cache de respostas leva a lista, não o modelo que respondeu: com o hedge
+# os modelos de AI_MODELS são intercambiáveis, e mudar a lista invalida o cache
+AI_MODELS_CACHE = ",".join(modelos_ia.AI_MODELS)
+logging.info(f"Usando modelos de IA (em ordem): {', '.join(modelos_ia.AI_MODELS)}")
 
 # Ler SYSTEM_PROMPT do arquivo 
 SYSTEM_PROMPT_FILE = "system_prompt.txt"
@@ -101,66 +191,105 @@ except Exception as e:
     logging.error(f"Erro lendo '{SYSTEM_PROMPT_FILE}': {e}", exc_info=True)
 if not OPENROUTER_API_KEY:
     logging.error("FATAL: OPENROUTER_API_KEY não carregada!")
+SYSTEM_PROMPT_VERSAO = versao_prompt(SYSTEM_PROMPT)  # Entra na chave do cache de respostas
 
-# Criação Tabelas 
+# Esquema do banco: só confere a versão (o DDL roda em 'python -m painel migrate', no release)
 try:
     if PAINEL_IMPORTADO:
-        criar_tabela_tokens()
-        criar_tabela_chat_history()
+        verificar_esquema()
 except Exception as e:
-    logging.error(f"Erro ao criar tabelas: {e}", exc_info=True)
+    logging.error(f"Erro ao verificar esquema: {e}", exc_info=True)
 
 # --- Função Auxiliar API OpenRouter ---
-def get_ai_response(messages_to_send: list) -> str:
-    """Envia mensagens para a API OpenRouter e retorna a resposta da IA."""
-    if not OPENROUTER_API_KEY:
-        raise ValueError("Chave API não configurada.")
-    headers = {
+def _openrouter_headers() -> dict:
+    """Cabeçalhos comuns das chamadas à OpenRouter."""
+    return {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}", 
         "Content-Type": "application/json", 
         "HTTP-Referer": request.url_root if request else "http://localhost:5000", 
         "X-Title": "Dra Ana App" 
     }
+
+def _erro_http_openrouter(http_err: requests.exceptions.HTTPError) -> Exception:
+    """Converte o erro HTTP da OpenRouter na exceção usada pelas rotas."""
+    status_code = http_err.response.status_code
+    logging.error(f"Erro HTTP da API OpenRouter: {status_code} - {http_err.response.text}")
+    if status_code == 401:
+        return PermissionError("Erro de autenticação com a API.")
+    elif status_code == 402:
+        return ConnectionRefusedError("Problema de crédito ou limite excedido na API.")
+    elif status_code == 429:
+        return ConnectionRefusedError("Limite de taxa (rate limit) da API excedido.")
+    else:
+        return ConnectionError(f"Erro na comunicação com a API ({status_code}).")
+
+def _registrar_uso_ia(usage: dict | None):
+    """Acumula e loga o uso de tokens da resposta, incluindo os tokens servidos do cache de prompt."""
+    uso = obter_cliente(OPENROUTER_API_URL).registrar_uso(usage)
+    if uso:
+        logging.debug("Uso IA: prompt=%s (cache=%s) completion=%s",
+                      uso['prompt_tokens'], uso['cached_tokens'], uso['completion_tokens'])
+        log_estruturado.anotar(tokens_prompt=uso['prompt_tokens'], tokens_cache=uso['cached_tokens'],
+                               tokens_resposta=uso['completion_tokens'])
+
+def _conteudo_resposta(api_result) -> tuple:
+    """(conteúdo, usage) de uma resposta não-stream da OpenRouter; ValueError se vier fora do formato."""
+    if (isinstance(api_result, dict) and 'choices' in api_result and 
+        api_result['choices'] and isinstance(api_result['choices'][0], dict) and 
+        'message' in api_result['choices'][0] and 
+        isinstance(api_result['choices'][0]['message'], dict) and 
+        'content' in api_result['choices'][0]['message']):
+        return api_result['choices'][0]['message']['content'], api_result.get("usage")
+    logging.error(f"Resposta da API OpenRouter inesperada: {api_result}")
+    raise ValueError("Resposta da API inesperada.")
+
+def get_ai_response(messages_to_send: list, temperature: float = 0.9) -> str:
+    """
+    Envia mensagens para a API OpenRouter e retorna a resposta da IA. Corre entre
+    os modelos de AI_MODELS (ver modelos_ia.correr): vale a primeira resposta.
+    """
+    if not OPENROUTER_API_KEY:
+        raise ValueError("Chave API não configurada.")
+    headers = _openrouter_headers()
     payload = {
         "model": AI_MODEL, 
         "messages": messages_to_send, 
-        "temperature": 0.9 
+        "temperature": temperature,
+        "usage": {"include": True}  # Pede a contabilidade de tokens (inclui cached_tokens)
     } 
-    logging.info(f"Enviando {len(messages_to_send)} msgs para {AI_MODEL} com temp=0.9")
-    try: 
-        logging.debug(f"Payload (parcial): {json.dumps(payload, ensure_ascii=False)[:500]}...")
-    except Exception: 
-        logging.debug("Nao logou payload json.")
-        
+    logging.debug("Enviando %d msgs para %s com temp=%s", len(messages_to_send), AI_MODEL, temperature)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        try: 
+            logging.debug("Payload (parcial): %.500s...", json.dumps(payload, ensure_ascii=False))
+        except Exception: 
+            logging.debug("Nao logou payload json.")
+
+    def tentar(modelo, tentativa):
+        # stream=True só no requests: o corpo é lido aqui, e o cancelamento fecha a conexão no meio.
+        # Retries só no último modelo; antes dele, falhar rápido dispara o fallback
+        response = obter_cliente(OPENROUTER_API_URL).enviar(dict(payload, model=modelo), headers, stream=True,
+                                                            retries=None if tentativa.ultima else 0)
+        tentativa.ao_cancelar(response.close)
+        with response:
+            yield _conteudo_resposta(response.json())
+
     try:
-        response = requests.post(OPENROUTER_API_URL, headers=headers, json=payload, timeout=45)
-        response.raise_for_status() 
-        api_result = response.json()
-        if (isinstance(api_result, dict) and 'choices' in api_result and 
-            api_result['choices'] and isinstance(api_result['choices'][0], dict) and 
-            'message' in api_result['choices'][0] and 
-            isinstance(api_result['choices'][0]['message'], dict) and 
-            'content' in api_result['choices'][0]['message']):
-            ai_content = api_result['choices'][0]['message']['content']
-            logging.info(f"Resposta OK da IA: {ai_content[:100]}...")
-            return ai_content.strip() if isinstance(ai_content, str) else str(ai_content)
-        else:
-            logging.error(f"Resposta da API OpenRouter inesperada: {api_result}")
-            raise ValueError("Resposta da API inesperada.")
+        corrida = modelos_ia.correr(tentar, "resposta")
+        try:
+            ai_content, usage = next(corrida)
+        finally:
+            corrida.close()
+        _registrar_uso_ia(usage)
+        logging.debug("Resposta OK da IA: %.100s...", ai_content)
+        return ai_content.strip() if isinstance(ai_content, str) else str(ai_content)
+    except CircuitoAbertoError as e:
+        logging.error(f"OpenRouter: chamada recusada, {e}")
+        raise
     except requests.exceptions.Timeout:
         logging.error("Timeout ao conectar com a API OpenRouter.")
         raise TimeoutError("A IA demorou muito para responder.")
     except requests.exceptions.HTTPError as http_err:
-        status_code = http_err.response.status_code
-        logging.error(f"Erro HTTP da API OpenRouter: {status_code} - {http_err.response.text}")
-        if status_code == 401:
-            raise PermissionError("Erro de autenticação com a API.")
-        elif status_code == 402:
-            raise ConnectionRefusedError("Problema de crédito ou limite excedido na API.")
-        elif status_code == 429:
-            raise ConnectionRefusedError("Limite de taxa (rate limit) da API excedido.")
-        else:
-            raise ConnectionError(f"Erro na comunicação com a API ({status_code}).")
+        raise _erro_http_openrouter(http_err)
     except requests.exceptions.RequestException as e:
         logging.error(f"Erro de rede ao conectar com a API OpenRouter: {e}")
         raise ConnectionError("Erro de rede ao conectar com a IA.")
@@ -168,6 +297,97 @@ def get_ai_response(messages_to_send: list) -> str:
         logging.exception("Erro inesperado ao processar resposta da IA.")
         raise ValueError("Erro ao processar a resposta da IA.")
 
+def get_ai_response_stream(messages_to_send: list):
+    """
+    Versão streaming de get_ai_response: chama a OpenRouter com stream=True e
+    gera os pedaços de texto (deltas) conforme chegam. O hedge entre os modelos
+    vale até o primeiro pedaço; dali em diante segue só o modelo que o mandou.
+    Levanta as mesmas exceções de get_ai_response.
+    """
+    if not OPENROUTER_API_KEY:
+        raise ValueError("Chave API não configurada.")
+    payload = {
+        "model": AI_MODEL, 
+        "messages": messages_to_send, 
+        "temperature": 0.9,
+        "stream": True,
+        "usage": {"include": True}  # O uso chega no último chunk do stream
+    }
+    logging.debug("Enviando %d msgs para %s com temp=0.9 (stream)", len(messages_to_send), AI_MODEL)
+    headers = _openrouter_headers()
+
+    def tentar(modelo, tentativa):
+        # Roda na thread da tentativa: o uso volta como item e é registrado na requisição
+        response = obter_cliente(OPENROUTER_API_URL).enviar(dict(payload, model=modelo), headers, stream=True,
+                                                            retries=None if tentativa.ultima else 0)
+        tentativa.ao_cancelar(response.close)
+        with response:
+            # Formato SSE da OpenRouter: linhas "data: {json}", comentários ": ..." e "data: [DONE]".
+            # SSE é sempre UTF-8, mas o Content-Type vem sem charset e o requests cairia no ISO-8859-1
+            response.encoding = "utf-8"
+            for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                if not line or line.startswith(":") or not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    logging.warning(f"Chunk SSE inválido da OpenRouter: {data[:200]}")
+                    continue
+                if isinstance(chunk, dict) and chunk.get("error"):
+                    logging.error(f"Erro no meio do stream da OpenRouter ({modelo}): {chunk['error']}")
+                    raise ConnectionError("Erro na comunicação com a API (stream interrompido).")
+                if isinstance(chunk, dict) and chunk.get("usage"):
+                    yield "uso", chunk["usage"]
+                choices = chunk.get("choices") if isinstance(chunk, dict) else None
+                if not choices or not isinstance(choices[0], dict):
+                    continue
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield "delta", delta
+
+    try:
+        for tipo, valor in modelos_ia.correr(tentar, "stream"):
+            if tipo == "uso":
+                _registrar_uso_ia(valor)
+            else:
+                yield valor
+    except CircuitoAbertoError as e:
+        logging.error(f"OpenRouter: chamada recusada (stream), {e}")
+        raise
+    except requests.exceptions.Timeout:
+        logging.error("Timeout na API OpenRouter (stream).")
+        raise TimeoutError("A IA demorou muito para responder.")
+    except requests.exceptions.HTTPError as http_err:
+        raise _erro_http_openrouter(http_err)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Erro de rede na API OpenRouter (stream): {e}")
+        raise ConnectionError("Erro de rede ao conectar com a IA.")
+
+# --- Resumos contínuos das conversas (rodam em segundo plano, fora do /chat) ---
+RESUMO_PROMPT = (
+    "Você resume conversas entre a Dra. Ana (médica) e uma paciente. Escreva em português, "
+    "em no máximo 12 linhas, os fatos importantes para continuar o atendimento: sintomas, "
+    "histórico, idade, medicações, exames, dúvidas em aberto e orientações já dadas. "
+    "Não invente nada e não inclua saudações."
+)
+
+def gerar_resumo_conversa(resumo_anterior: str | None, mensagens: list) -> str:
+    """Atualiza o resumo da conversa com as mensagens que saíram da janela de histórico."""
+    transcricao = "\n".join(
+        f"{'Paciente' if m['role'] == 'user' else 'Dra. Ana'}: {m['content']}" for m in mensagens
+    )
+    pedido = f"Resumo até agora:\n{resumo_anterior or '(nenhum)'}\n\nNovas mensagens:\n{transcricao}\n\nResumo atualizado:"
+    return get_ai_response([
+        {"role": "system", "content": RESUMO_PROMPT},
+        {"role": "user", "content": pedido},
+    ], temperature=0.2)
+
+if PAINEL_IMPORTADO:
+    configurar_resumidor(gerar_resumo_conversa, janela=CONTEXT_MAX_MSGS)
+
 # --- Rotas ---
 
 @app.route("/") 
@@ -265,7 +485,80 @@ def dra_ana_route():
     logging.debug(f"Acesso permitido a /dra-ana para token {user_token[:8]}...")
     return render_template("chat.html")
 
+def _medir_rota(rota: str):
+    """Observa a duração total da rota e conta as respostas pelo status HTTP."""
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def rota_medida(*args, **kwargs):
+            inicio = time.perf_counter()
+            resposta = funcao(*args, **kwargs)
+            CHAT_ETAPA.labels(rota=rota, etapa="total").observe(time.perf_counter() - inicio)
+            status = resposta[1] if isinstance(resposta, tuple) else getattr(resposta, "status_code", 200)
+            CHAT_RESULTADO.labels(rota=rota, resultado=str(status)).inc()
+            return resposta
+        return rota_medida
+    return decorador
+
+def _resposta_sobrecarga(erro: SobrecargaError, rota: str, user_token: str):
+    """429 com Retry-After para uma requisição recusada pelo controle de admissão."""
+    logging.warning(f"API /{rota}: Recusada ({erro.motivo}) T:{user_token[:8]}... Retry-After {erro.retry_after}s.")
+    log_estruturado.anotar(admissao=erro.motivo)
+    return jsonify({"error": str(erro)}), 429, {"Retry-After": str(erro.retry_after)}
+
+# --- Idempotência das mensagens (header Idempotency-Key, ver painel/idempotencia.py) ---
+
+def _chave_idempotencia(rota: str, user_token: str) -> str | None:
+    """Chave de idempotência da requisição; ausente ou malformada = sem deduplicação."""
+    chave = request.headers.get("Idempotency-Key", "").strip()
+    if chave and not CHAVE_IDEMPOTENCIA_VALIDA.match(chave):
+        logging.warning(f"API /{rota}: Idempotency-Key malformada ignorada. T:{user_token[:8]}")
+        return None
+    return chave or None
+
+def _reservar_chave(user_token: str, chave: str) -> tuple[str, str | None]:
+    """
+    Reserva a chave da mensagem. Se outra requisição a está processando, espera
+    (até IDEMPOTENCIA_ESPERA) ela terminar para devolver a mesma resposta.
+    Retorna (estado, resposta) como painel.reservar_idempotencia; em 'nova' a
+    reserva fica em `g` até _concluir_chave ou o teardown (que a libera).
+    """
+    limite = time.monotonic() + IDEMPOTENCIA_ESPERA
+    estado, resposta = reservar_idempotencia(user_token, chave)
+    while estado == "andamento" and time.monotonic() < limite:
+        time.sleep(IDEMPOTENCIA_INTERVALO)
+        estado, resposta = reservar_idempotencia(user_token, chave)
+    if estado == "nova":
+        g._idempotencia = (user_token, chave)
+    else:
+        log_estruturado.anotar(idempotencia="repetida" if estado == "concluida" else "em_andamento")
+    return estado, resposta
+
+def _concluir_chave(ai_response: str):
+    """Guarda a resposta na chave reservada pela requisição (se houver)."""
+    reserva = g.pop("_idempotencia", None)
+    if reserva is not None:
+        concluir_idempotencia(*reserva, ai_response)
+
+def _resposta_em_andamento(rota: str, user_token: str):
+    """409 para o reenvio que cansou de esperar a requisição original."""
+    logging.warning(f"API /{rota}: Mensagem repetida ainda em andamento após {IDEMPOTENCIA_ESPERA:.0f}s T:{user_token[:8]}...")
+    return jsonify({"error": "Sua mensagem ainda está sendo respondida. Aguarde um instante."}), 409, \
+        {"Retry-After": str(admissao.IA_RETRY_AFTER)}
+
+@app.teardown_request
+def _liberar_chave_idempotencia(erro):
+    """
+    Requisição terminou sem resposta (erro, 403, 429...): o próximo reenvio processa
+    a mensagem (sem gravar de novo a msg do usuário, se ela já entrou no banco).
+    """
+    if log_estruturado.em_stream():
+        return
+    reserva = g.pop("_idempotencia", None)
+    if reserva is not None:
+        liberar_idempotencia(*reserva)
+
 @app.route("/chat", methods=["POST"]) 
+@_medir_rota("chat")
 def chat_endpoint():
     """Endpoint da API para receber e responder mensagens do chat."""
     user_token = session.get('user_token')
@@ -273,15 +566,6 @@ def chat_endpoint():
     if not acesso_ok or not user_token:
         logging.warning("API /chat: Acesso negado (sem token/flag na sessão).")
         return jsonify({"error": "Sessão inválida ou inexistente"}), 403
-    is_valid_token = True 
-    if PAINEL_IMPORTADO:
-        is_valid_token = verificar_token_valido(user_token)
-    if not is_valid_token:
-        logging.warning(f"API /chat: Acesso negado (Token inválido ou expirado: {user_token[:8]}...). Removendo da sessão.")
-        session.pop('acesso_concluido', None)
-        session.pop('user_token', None)
-        session.modified = True
-        return jsonify({"error": "Token inválido ou expirado"}), 403
     try:
         data = request.get_json()
         if not data or "mensagem" not in data:
@@ -291,23 +575,61 @@ def chat_endpoint():
         if not isinstance(user_message, str) or not user_message.strip():
             logging.warning(f"API /chat: Mensagem vazia recebida. T:{user_token[:8]}")
             return jsonify({"error": "Mensagem não pode ser vazia"}), 400
-        logging.info(f"Msg Recebida (T:{user_token[:8]}): {user_message[:100]}...")
-        if PAINEL_IMPORTADO:
-            add_chat_message(user_token, 'user', user_message)
-        else:
-            logging.warning("Placeholder: Não salvando msg user.")
-        chat_history = []
-        if PAINEL_IMPORTADO:
-            chat_history = get_chat_history(user_token, limit=20)
-        else:
-            logging.warning("Placeholder: Não buscando histórico.")
-        messages_to_send = [{"role": "system", "content": SYSTEM_PROMPT}] + chat_history
+        logging.debug("Msg Recebida (T:%s): %.100s...", user_token[:8], user_message)
+        log_estruturado.anotar(token=user_token[:8], tamanho_msg=len(user_message))
+        # Reenvio da mesma mensagem: devolve a resposta da original em vez de chamar a IA de novo
+        chave = _chave_idempotencia("chat", user_token)
+        if chave:
+            with medir(CHAT_ETAPA, rota="chat", etapa="idempotencia"):
+                estado, resposta_anterior = _reservar_chave(user_token, chave)
+            if estado == "concluida":
+                return jsonify({"response": resposta_anterior})
+            if estado == "andamento":
+                return _resposta_em_andamento("chat", user_token)
+        # Limite de taxa do token e vaga para chamar a IA, antes de gravar qualquer coisa
         try:
-            ai_response = get_ai_response(messages_to_send)
+            with medir(CHAT_ETAPA, rota="chat", etapa="admissao"):
+                admissao.admitir(user_token, consumir_ficha_taxa)
+        except SobrecargaError as e:
+            return _resposta_sobrecarga(e, "chat", user_token)
+        # Valida o token, salva a msg do usuário e lê o histórico numa única ida ao banco
+        with medir(CHAT_ETAPA, rota="chat", etapa="turno_bd"):
             if PAINEL_IMPORTADO:
-                add_chat_message(user_token, 'assistant', ai_response)
+                chat_history = registrar_turno_chat(user_token, user_message, limit=CONTEXT_MAX_MSGS,
+                                                    chave_idempotencia=chave)
+            else:
+                logging.warning("Placeholder: Não salvando msg user / não buscando histórico.")
+                chat_history = [{"role": "user", "content": user_message}]
+        if chat_history is None:
+            logging.warning(f"API /chat: Acesso negado (Token inválido ou expirado: {user_token[:8]}...). Removendo da sessão.")
+            session.pop('acesso_concluido', None)
+            session.pop('user_token', None)
+            session.modified = True
+            return jsonify({"error": "Token inválido ou expirado"}), 403
+        with medir(CHAT_ETAPA, rota="chat", etapa="resumo"):
+            resumo = obter_resumo_conversa(user_token) if PAINEL_IMPORTADO else None
+        with medir(CHAT_ETAPA, rota="chat", etapa="contexto"):
+            messages_to_send, prompt_tokens = montar_contexto(SYSTEM_PROMPT, chat_history, CONTEXT_TOKEN_BUDGET, resumo=resumo)
+        logging.debug("Contexto T:%s: %d msgs, ~%d tokens (orçamento %d)",
+                      user_token[:8], len(messages_to_send), prompt_tokens, CONTEXT_TOKEN_BUDGET)
+        log_estruturado.anotar(msgs_contexto=len(messages_to_send), tokens_contexto=prompt_tokens)
+        # O que o orçamento cortou do histórico passa a entrar no resumo
+        limitar_janela_resumo(user_token, sum(1 for m in messages_to_send if m["role"] != "system"))
+        chave_resposta = chave_para(AI_MODELS_CACHE, SYSTEM_PROMPT_VERSAO, chat_history) if RESPONSE_CACHE and not resumo else None
+        try:
+            ai_response = cache_respostas.buscar(chave_resposta)
+            if ai_response is not None:
+                log_estruturado.anotar(cache_resposta=True)
             else:
-                logging.warning("Placeholder: Não salvando msg assistant.")
+                with medir(CHAT_ETAPA, rota="chat", etapa="ia"):
+                    ai_response = get_ai_response(messages_to_send)
+                cache_respostas.guardar(chave_resposta, ai_response)
+            with medir(CHAT_ETAPA, rota="chat", etapa="salvar_resposta"):
+                if PAINEL_IMPORTADO:
+                    add_chat_message(user_token, 'assistant', ai_response)
+                else:
+                    logging.warning("Placeholder: Não salvando msg assistant.")
+            _concluir_chave(ai_response)
             return jsonify({"response": ai_response})
         except (ValueError, ConnectionError, PermissionError, TimeoutError, ConnectionRefusedError) as e:
             error_message = str(e)
@@ -322,6 +644,145 @@ def chat_endpoint():
         logging.exception(f"API /chat: Erro geral no processamento T:{user_token[:8]}...")
         return jsonify({"error": "Erro interno no servidor."}), 500
 
+def _evento_sse(dados: dict, evento: str | None = None) -> str:
+    """Formata um evento Server-Sent Events."""
+    linha_evento = f"event: {evento}\n" if evento else ""
+    return f"{linha_evento}data: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+@app.route("/chat/stream", methods=["POST"]) 
+@_medir_rota("chat_stream")
+def chat_stream_endpoint():
+    """
+    Igual ao /chat, mas devolve a resposta da IA como Server-Sent Events:
+    eventos 'data: {"delta": "..."}' durante a geração, e no final
+    'event: done' (resposta completa) ou 'event: error'.
+    A resposta montada é salva no histórico quando o stream termina.
+    """
+    user_token = session.get('user_token')
+    acesso_ok = session.get('acesso_concluido')
+    if not acesso_ok or not user_token:
+        logging.warning("API /chat/stream: Acesso negado (sem token/flag na sessão).")
+        return jsonify({"error": "Sessão inválida ou inexistente"}), 403
+    data = request.get_json(silent=True)
+    if not data or "mensagem" not in data:
+        logging.warning(f"API /chat/stream: Payload inválido ou sem 'mensagem'. T:{user_token[:8]}")
+        return jsonify({"error": "Requisição inválida"}), 400
+    user_message = data.get("mensagem")
+    if not isinstance(user_message, str) or not user_message.strip():
+        logging.warning(f"API /chat/stream: Mensagem vazia recebida. T:{user_token[:8]}")
+        return jsonify({"error": "Mensagem não pode ser vazia"}), 400
+    logging.debug("Msg Recebida stream (T:%s): %.100s...", user_token[:8], user_message)
+    log_estruturado.anotar(token=user_token[:8], tamanho_msg=len(user_message))
+    chave = _chave_idempotencia("chat/stream", user_token)
+    if chave:
+        with medir(CHAT_ETAPA, rota="chat_stream", etapa="idempotencia"):
+            estado, resposta_anterior = _reservar_chave(user_token, chave)
+        if estado == "concluida":
+            return Response(_evento_sse({"response": resposta_anterior}, evento="done"),
+                            mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+        if estado == "andamento":
+            return _resposta_em_andamento("chat/stream", user_token)
+    # A vaga só é devolvida no teardown, quando o stream termina
+    try:
+        with medir(CHAT_ETAPA, rota="chat_stream", etapa="admissao"):
+            admissao.admitir(user_token, consumir_ficha_taxa)
+    except SobrecargaError as e:
+        return _resposta_sobrecarga(e, "chat/stream", user_token)
+    with medir(CHAT_ETAPA, rota="chat_stream", etapa="turno_bd"):
+        if PAINEL_IMPORTADO:
+            chat_history = registrar_turno_chat(user_token, user_message, limit=CONTEXT_MAX_MSGS,
+                                                chave_idempotencia=chave)
+        else:
+            logging.warning("Placeholder: Não salvando msg user / não buscando histórico.")
+            chat_history = [{"role": "user", "content": user_message}]
+    if chat_history is None:
+        logging.warning(f"API /chat/stream: Acesso negado (Token inválido ou expirado: {user_token[:8]}...). Removendo da sessão.")
+        session.pop('acesso_concluido', None)
+        session.pop('user_token', None)
+        session.modified = True
+        return jsonify({"error": "Token inválido ou expirado"}), 403
+    with medir(CHAT_ETAPA, rota="chat_stream", etapa="resumo"):
+        resumo = obter_resumo_conversa(user_token) if PAINEL_IMPORTADO else None
+    with medir(CHAT_ETAPA, rota="chat_stream", etapa="contexto"):
+        messages_to_send, prompt_tokens = montar_contexto(SYSTEM_PROMPT, chat_history, CONTEXT_TOKEN_BUDGET, resumo=resumo)
+    logging.debug("Contexto stream T:%s: %d msgs, ~%d tokens (orçamento %d)",
+                  user_token[:8], len(messages_to_send), prompt_tokens, CONTEXT_TOKEN_BUDGET)
+    log_estruturado.anotar(msgs_contexto=len(messages_to_send), tokens_contexto=prompt_tokens)
+    # O que o orçamento cortou do histórico passa a entrar no resumo
+    limitar_janela_resumo(user_token, sum(1 for m in messages_to_send if m["role"] != "system"))
+    chave_resposta = chave_para(AI_MODELS_CACHE, SYSTEM_PROMPT_VERSAO, chat_history) if RESPONSE_CACHE and not resumo else None
+
+    def salvar_resposta(ai_response: str, em_cache: str | None):
+        if em_cache is None:
+            cache_respostas.guardar(chave_resposta, ai_response)
+        with medir(CHAT_ETAPA, rota="chat_stream", etapa="salvar_resposta"):
+            if PAINEL_IMPORTADO:
+                add_chat_message(user_token, 'assistant', ai_response)
+        _concluir_chave(ai_response)
+
+    def gerar_eventos():
+        partes = []
+        fluxo = None
+        em_cache = cache_respostas.buscar(chave_resposta)
+        try:
+            if em_cache is not None:
+                log_estruturado.anotar(cache_resposta=True)
+                partes.append(em_cache)
+                yield _evento_sse({"delta": em_cache})
+            else:
+                inicio_ia = time.perf_counter()
+                fluxo = get_ai_response_stream(messages_to_send)
+                for delta in fluxo:
+                    if not partes:
+                        primeiro_delta = time.perf_counter() - inicio_ia
+                        CHAT_ETAPA.labels(rota="chat_stream", etapa="ia_primeiro_delta").observe(primeiro_delta)
+                        log_estruturado.anotar_etapa("ia_primeiro_delta", primeiro_delta)
+                    partes.append(delta)
+                    yield _evento_sse({"delta": delta})
+                duracao_ia = time.perf_counter() - inicio_ia
+                CHAT_ETAPA.labels(rota="chat_stream", etapa="ia").observe(duracao_ia)
+                log_estruturado.anotar_etapa("ia", duracao_ia)
+        except GeneratorExit:
+            # Cliente caiu no meio do stream. Com chave de idempotência, termina de ler a IA
+            # e guarda a resposta: o reenvio (mesma chave) a recebe sem chamar a IA de novo
+            if g.get("_idempotencia") is not None:
+                try:
+                    if fluxo is not None:
+                        partes.extend(fluxo)
+                    ai_response = "".join(partes).strip()
+                    if ai_response:
+                        salvar_resposta(ai_response, em_cache)
+                        logging.info(f"API /chat/stream: Cliente desconectou; resposta guardada para o reenvio T:{user_token[:8]}...")
+                except Exception as e:
+                    logging.warning(f"API /chat/stream: Cliente desconectou e a IA falhou T:{user_token[:8]}...: {e}")
+            raise
+        except (ValueError, ConnectionError, PermissionError, TimeoutError, ConnectionRefusedError) as e:
+            logging.error(f"API /chat/stream: Erro ao chamar IA para T:{user_token[:8]}...: {e}")
+            CHAT_RESULTADO.labels(rota="chat_stream", resultado="erro_ia").inc()
+            yield _evento_sse({"error": f"Erro ao comunicar com a IA: {e}"}, evento="error")
+            return
+        except Exception:
+            logging.exception(f"API /chat/stream: Erro inesperado no stream T:{user_token[:8]}...")
+            CHAT_RESULTADO.labels(rota="chat_stream", resultado="erro").inc()
+            yield _evento_sse({"error": "Erro interno ao processar na IA."}, evento="error")
+            return
+        ai_response = "".join(partes).strip()
+        if not ai_response:
+            logging.error(f"API /chat/stream: Stream terminou sem conteúdo T:{user_token[:8]}...")
+            CHAT_RESULTADO.labels(rota="chat_stream", resultado="erro_ia").inc()
+            yield _evento_sse({"error": "Erro ao comunicar com a IA: resposta vazia."}, evento="error")
+            return
+        salvar_resposta(ai_response, em_cache)
+        CHAT_RESULTADO.labels(rota="chat_stream", resultado="ok").inc()
+        logging.debug("Resposta OK da IA (stream): %.100s...", ai_response)
+        yield _evento_sse({"response": ai_response}, evento="done")
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # Desliga buffering de proxies (nginx/Render)
+    }
+    return Response(log_estruturado.stream_com_contexto(gerar_eventos()), mimetype="text/event-stream", headers=headers)
+
 # --- Rotas do Painel Admin ---
 
 @app.route("/login", methods=["GET", "POST"]) 
@@ -395,29 +856,62 @@ def painel():
                 flash("Erro inesperado no servidor ao gerar token.", "danger")
         return redirect(url_for('painel'))  # Redireciona após POST
 
-    # Lógica GET (busca tokens sempre)
+    # Lógica GET: uma página por vez, filtrada no banco
     tokens = []
+    proximo_cursor = None
+    busca = request.args.get("q", "").strip()
+    status_filtro = request.args.get("status", "")
+    cursor = request.args.get("apos") or None
     try:
         if PAINEL_IMPORTADO:
-            tokens = listar_tokens()
+            tokens, proximo_cursor = listar_tokens_pagina(busca=busca, status=status_filtro or None,
+                                                          cursor=cursor, limite=PAINEL_POR_PAGINA)
         else:
             erro_painel = "Painel não importado, não pode listar tokens."
     except Exception as e:
         logging.exception("Erro ao listar tokens para o painel.")
         erro_painel = "Erro ao buscar lista de tokens."
 
-    now_tz = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')
-    if PYTZ_IMPORTADO:
-        try: 
-            now_tz = datetime.now(timezone("America/Sao_Paulo")).strftime('%Y-%m-%d %H:%M:%S %Z%z')
-        except Exception as e: 
-            logging.warning(f"Erro timezone: {e}. Usando UTC.")
-
     return render_template("painel.html",
                            tokens=tokens, 
-                           now=now_tz,
+                           busca=busca,
+                           status_filtro=status_filtro,
+                           cursor=cursor,
+                           proximo_cursor=proximo_cursor,
                            erro=erro_painel)
 
+@app.route("/painel/estatisticas") 
+def painel_estatisticas():
+    """Estatísticas internas deste worker (pool de conexões, caches e cliente da IA), em JSON."""
+    if not session.get("autenticado"):
+        return jsonify({"error": "Acesso não autorizado"}), 403
+    return jsonify({
+        "pid": os.getpid(),
+        "pool_conexoes": estatisticas_pool(),
+        "cache_tokens": estatisticas_cache_tokens(),
+        "cache_historico": estatisticas_cache_historico(),
+        "openrouter": obter_cliente(OPENROUTER_API_URL).estatisticas(),
+        "resumidor": estatisticas_resumidor(),
+        "escrita_mensagens": estatisticas_escrita(),
+        "admissao": admissao.estatisticas(),
+        "modelos_ia": modelos_ia.estatisticas(),
+        "cache_respostas": cache_respostas.estatisticas(),
+        "logging": log_estruturado.estatisticas(),
+        "estaticos": estaticos.estatisticas(),
+    })
+
+@app.route("/metrics")
+def metrics():
+    """Métricas no formato do Prometheus (todos os workers). Com METRICS_TOKEN, exige 'Authorization: Bearer <token>'."""
+    token_metricas = os.getenv("METRICS_TOKEN")
+    if token_metricas and request.headers.get("Authorization") != f"Bearer {token_metricas}":
+        return Response("Acesso não autorizado\n", status=403, mimetype="text/plain")
+    exportado = metricas.exportar()
+    if exportado is None:
+        return Response("prometheus_client não instalado\n", status=503, mimetype="text/plain")
+    corpo, tipo = exportado
+    return Response(corpo, content_type=tipo)
+
 @app.route("/excluir_token", methods=["POST"]) 
 def excluir_token_route():
     """Processa a exclusão de um token."""
@@ -480,6 +974,75 @@ def atualizar_token_route():
         flash("Erro: Módulo do painel não carregado.", "danger")
     return redirect(url_for("painel"))
 
+@app.route("/painel/importar", methods=["POST"])
+def importar_tokens_route():
+    """Importa tokens de um CSV/NDJSON e devolve o relatório (CSV) com o token ou o conflito de cada linha."""
+    if not session.get("autenticado"):
+        flash("Acesso não autorizado.", "warning")
+        return redirect(url_for("login"))
+    arquivo = request.files.get("arquivo")
+    dias_str = request.form.get("dias_validade", "7")
+    if not arquivo or not arquivo.filename:
+        flash("Erro: Nenhum arquivo enviado para importação.", "warning")
+        return redirect(url_for("painel"))
+    if not dias_str.isdigit() or int(dias_str) <= 0:
+        flash("Número de dias de validade inválido.", "danger")
+        return redirect(url_for("painel"))
+    if not PAINEL_IMPORTADO:
+        flash("Erro: Módulo do painel não carregado.", "danger")
+        return redirect(url_for("painel"))
+    formato = "ndjson" if arquivo.filename.lower().endswith((".ndjson", ".jsonl")) else "csv"
+
+    def progresso(etapa, linhas):
+        logging.info(f"Importação '{arquivo.filename}': {linhas} linha(s) {etapa}.")
+
+    relatorio = importar_tokens_lote(arquivo.stream, formato=formato, dias_validade=int(dias_str), progresso=progresso)
+    if relatorio is None:
+        flash("Erro ao importar tokens (nada foi gravado).", "danger")
+        return redirect(url_for("painel"))
+    logging.info(f"Admin importou '{arquivo.filename}': {relatorio['inseridos']} inserido(s), "
+                 f"{relatorio['conflitos']} conflito(s), {relatorio['invalidos']} inválido(s).")
+    saida = io.StringIO()
+    escritor = csv.writer(saida)
+    escritor.writerow(["linha", "nome", "telefone", "token", "situacao"])
+    escritor.writerows(relatorio["linhas"])
+    return Response(saida.getvalue(), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=relatorio_importacao.csv"})
+
+@app.route("/painel/lote", methods=["POST"])
+def operacao_lote_route():
+    """Estende, expira ou exclui de uma vez todos os tokens do filtro atual do painel."""
+    if not session.get("autenticado"):
+        flash("Acesso não autorizado.", "warning")
+        return redirect(url_for("login"))
+    operacao = request.form.get("operacao")
+    busca = request.form.get("q", "").strip()
+    status_filtro = request.form.get("status", "")
+    voltar = redirect(url_for("painel", q=busca or None, status=status_filtro or None))
+    if operacao not in ("estender", "expirar", "excluir"):
+        flash("Erro: Operação em lote inválida.", "danger")
+        return voltar
+    if operacao == "excluir" and not busca and not status_filtro:
+        flash("Para excluir em lote, filtre os tokens primeiro (busca ou status).", "warning")
+        return voltar
+    dias = None
+    if operacao == "estender":
+        dias_str = request.form.get("dias_adicionar", "")
+        if not dias_str.isdigit() or int(dias_str) <= 0:
+            flash("Erro: Número de dias inválido.", "danger")
+            return voltar
+        dias = int(dias_str)
+    if not PAINEL_IMPORTADO:
+        flash("Erro: Módulo do painel não carregado.", "danger")
+        return voltar
+    afetados = alterar_tokens_lote(operacao, busca=busca, status=status_filtro or None, dias=dias)
+    if afetados is None:
+        flash("Erro interno na operação em lote.", "danger")
+    else:
+        flash(f"Operação '{operacao}' aplicada a {afetados} token(s).", "success")
+        logging.info(f"Admin operação em lote '{operacao}': {afetados} token(s).")
+    return voltar
+
 @app.route("/resetar_acesso") 
 def resetar_acesso():
     """Limpa a sessão de acesso do usuário."""
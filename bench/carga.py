@@ -0,0 +1,378 @@
+# bench/carga.py - Benchmark de carga do app inteiro (acesso, chat, painel), com resultado em JSON
+#
+# Sobe tudo localmente e mede de fora, como um usuário:
+#   - Postgres: o de --database-url ou, sem ele, um cluster descartável criado com
+#     initdb/pg_ctl num diretório temporário (sem Docker; precisa dos binários do
+#     Postgres no PATH ou em /usr/lib/postgresql/*/bin) e, sem eles, um arquivo
+#     SQLite temporário (backend painel/bd_sqlite.py; --database-url sqlite:///x.db também vale);
+#   - OpenRouter falsa com latência/jitter configuráveis e streaming SSE;
+#   - o app com gunicorn (workers e classe configuráveis), depois das migrações.
+#
+# Cada paciente virtual faz /acesso -> /dra-ana -> --turnos x /chat (ou /chat/stream
+# com --stream); --concorrencia pacientes rodam ao mesmo tempo. Em paralelo,
+# --admins sessões do painel fazem login e recarregam /painel (com e sem filtros).
+#
+# Relatório por rota: p50/p95/p99, média, máximo, vazão e taxa de erro; no banco,
+# conexões abertas (pg_stat_database.sessions, PG 14+) e pico de conexões
+# simultâneas (só com Postgres). O JSON vai para --saida (padrão bench/resultados/carga-<data>.json);
+# --comparar <json anterior> imprime a diferença de p95 e vazão por rota.
+#
+# Exemplos:
+#   python bench/carga.py --pacientes 200 --concorrencia 50 --turnos 3 --latencia 1.5
+#   python bench/carga.py --stream --pedacos 20 --intervalo-pedaco 0.05 --comparar bench/resultados/antes.json
+#   python bench/carga.py --database-url postgresql://localhost/clara_bench --workers 4
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import psycopg2
+
+from comum import iniciar_openrouter_falsa, url_openrouter, porta_livre, esperar_porta, percentil, RESPOSTA_PADRAO
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIR_RESULTADOS = os.path.join(RAIZ, "bench", "resultados")
+FILTROS_PAINEL = ["", "?q=bench", "?status=ativos", "?status=expirados"]
+
+
+class PostgresTemporario:
+    """Cluster Postgres descartável (initdb + pg_ctl) num diretório temporário, só em localhost."""
+
+    def __init__(self):
+        self.bin = self._achar_binarios()
+        self.dir = tempfile.mkdtemp(prefix="clara_bench_pg_")
+        self.porta = porta_livre()
+        self.url = f"postgresql://postgres@127.0.0.1:{self.porta}/postgres"
+
+    @staticmethod
+    def _achar_binarios() -> str:
+        if shutil.which("initdb") and shutil.which("pg_ctl"):
+            return os.path.dirname(shutil.which("initdb"))
+        candidatos = sorted(glob.glob("/usr/lib/postgresql/*/bin/initdb"), reverse=True)
+        if candidatos:
+            return os.path.dirname(candidatos[0])
+        raise RuntimeError("initdb/pg_ctl não encontrados: instale o Postgres ou use --database-url.")
+
+    def iniciar(self):
+        dados = os.path.join(self.dir, "dados")
+        subprocess.run([os.path.join(self.bin, "initdb"), "-D", dados, "-U", "postgres", "-A", "trust",
+                        "--no-sync"], check=True, stdout=subprocess.DEVNULL)
+        opcoes = f"-p {self.porta} -k {self.dir} -c listen_addresses=127.0.0.1 -c fsync=off -c max_connections=300"
+        subprocess.run([os.path.join(self.bin, "pg_ctl"), "-D", dados, "-o", opcoes, "-w",
+                        "-l", os.path.join(self.dir, "postgres.log"), "start"], check=True, stdout=subprocess.DEVNULL)
+        return self
+
+    def parar(self):
+        subprocess.run([os.path.join(self.bin, "pg_ctl"), "-D", os.path.join(self.dir, "dados"), "-m", "fast",
+                        "-w", "stop"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class MonitorBanco:
+    """
+    Conta as sessões abertas no banco durante a rodada e amostra o pico de
+    conexões simultâneas (a própria conexão do monitor é descontada).
+    """
+
+    def __init__(self, url: str, intervalo: float = 0.25):
+        self.conn = psycopg2.connect(url)
+        self.conn.autocommit = True
+        self.intervalo = intervalo
+        self.pico = 0
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._amostrar, daemon=True)
+        self.sessoes_inicio = self._sessoes()
+
+    def _sessoes(self) -> int | None:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT current_setting('server_version_num')::int >= 140000")
+            if not cur.fetchone()[0]:
+                return None
+            cur.execute("SELECT sessions FROM pg_stat_database WHERE datname = current_database()")
+            return cur.fetchone()[0]
+
+    def _amostrar(self):
+        while not self._parar.wait(self.intervalo):
+            with self.conn.cursor() as cur:
+                cur.execute("SELECT count(*) - 1 FROM pg_stat_activity WHERE datname = current_database()")
+                self.pico = max(self.pico, cur.fetchone()[0])
+
+    def iniciar(self):
+        self._thread.start()
+        return self
+
+    def parar(self) -> dict:
+        self._parar.set()
+        self._thread.join()
+        # pg_stat_database é atualizada com atraso (stats collector / fim de transação)
+        time.sleep(1.0)
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_stat_clear_snapshot()")
+        sessoes_fim = self._sessoes()
+        self.conn.close()
+        return {
+            "conexoes_abertas": None if sessoes_fim is None else sessoes_fim - self.sessoes_inicio,
+            "pico_conexoes_simultaneas": self.pico,
+        }
+
+
+class Coletor:
+    """Latências e status por rota, de todas as threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.amostras = defaultdict(list)  # rota -> [(segundos, status, ok)]
+
+    def registrar(self, rota: str, segundos: float, status, ok: bool):
+        with self.lock:
+            self.amostras[rota].append((segundos, status, ok))
+
+    def medir(self, rota: str, funcao, esperado=200):
+        """Chama funcao() -> Response, registra e devolve a resposta (ou None em erro de rede)."""
+        inicio = time.perf_counter()
+        try:
+            resposta = funcao()
+        except requests.RequestException as e:
+            self.registrar(rota, time.perf_counter() - inicio, type(e).__name__, False)
+            return None
+        self.registrar(rota, time.perf_counter() - inicio, resposta.status_code, resposta.status_code == esperado)
+        return resposta
+
+    def resumo(self, duracao: float) -> dict:
+        rotas = {}
+        for rota, amostras in sorted(self.amostras.items()):
+            tempos = [s for s, _, _ in amostras]
+            erros = sum(1 for _, _, ok in amostras if not ok)
+            status = defaultdict(int)
+            for _, codigo, _ in amostras:
+                status[str(codigo)] += 1
+            rotas[rota] = {
+                "requisicoes": len(amostras),
+                "erros": erros,
+                "taxa_erro": round(erros / len(amostras), 4),
+                "status": dict(status),
+                "p50_ms": round(percentil(tempos, 50) * 1000, 1),
+                "p95_ms": round(percentil(tempos, 95) * 1000, 1),
+                "p99_ms": round(percentil(tempos, 99) * 1000, 1),
+                "media_ms": round(sum(tempos) / len(tempos) * 1000, 1),
+                "max_ms": round(max(tempos) * 1000, 1),
+                "vazao_rps": round(len(amostras) / duracao, 2) if duracao else 0.0,
+            }
+        return rotas
+
+
+def paciente(base: str, indice: int, args, coletor: Coletor):
+    """Um usuário do chat: acesso novo, página do chat e `turnos` mensagens."""
+    sessao = requests.Session()
+    telefone = f"bench{args.rodada}{indice:06d}"
+    resposta = coletor.medir("/acesso", lambda: sessao.post(
+        f"{base}/acesso", data={"nome": f"Bench {indice}", "telefone": telefone},
+        allow_redirects=False, timeout=args.timeout), esperado=302)
+    if resposta is None or resposta.status_code != 302:
+        return
+    coletor.medir("/dra-ana", lambda: sessao.get(f"{base}/dra-ana", timeout=args.timeout))
+    for turno in range(args.turnos):
+        mensagem = {"mensagem": f"Oi, sou a paciente {indice}. Pergunta {turno}: estou com dor de cabeça."}
+        if args.stream:
+            _turno_stream(base, sessao, mensagem, args, coletor)
+        else:
+            coletor.medir("/chat", lambda: sessao.post(f"{base}/chat", json=mensagem, timeout=args.timeout))
+
+
+def _turno_stream(base: str, sessao, mensagem: dict, args, coletor: Coletor):
+    """/chat/stream: mede até o primeiro delta e até o 'event: done'."""
+    inicio = time.perf_counter()
+    try:
+        with sessao.post(f"{base}/chat/stream", json=mensagem, stream=True, timeout=args.timeout) as resposta:
+            if resposta.status_code != 200:
+                coletor.registrar("/chat/stream", time.perf_counter() - inicio, resposta.status_code, False)
+                return
+            primeiro = None
+            evento = None
+            texto = ""
+            for linha in resposta.iter_lines(chunk_size=None, decode_unicode=True):
+                if linha.startswith("data:") and primeiro is None:
+                    primeiro = time.perf_counter() - inicio
+                    coletor.registrar("/chat/stream (primeiro delta)", primeiro, 200, True)
+                if linha.startswith("data:") and evento is None:
+                    texto += json.loads(linha[5:]).get("delta", "")
+                if linha.startswith("event:"):
+                    evento = linha[6:].strip()
+            status = 200 if evento == "done" else f"event:{evento}"
+            if evento == "done" and texto.strip() != RESPOSTA_PADRAO:
+                status = "texto_corrompido"  # Ex.: acentos decodificados com o charset errado
+            coletor.registrar("/chat/stream", time.perf_counter() - inicio, status, status == 200)
+    except requests.RequestException as e:
+        coletor.registrar("/chat/stream", time.perf_counter() - inicio, type(e).__name__, False)
+
+
+def admin(base: str, senha: str, args, coletor: Coletor, fim: threading.Event):
+    """Uma sessão do painel recarregando a listagem até os pacientes terminarem."""
+    sessao = requests.Session()
+    resposta = coletor.medir("/login", lambda: sessao.post(
+        f"{base}/login", data={"senha": senha}, allow_redirects=False, timeout=args.timeout), esperado=302)
+    if resposta is None or resposta.status_code != 302:
+        return
+    i = 0
+    while not fim.is_set():
+        filtro = FILTROS_PAINEL[i % len(FILTROS_PAINEL)]
+        coletor.medir("/painel", lambda: sessao.get(f"{base}/painel{filtro}", timeout=args.timeout))
+        i += 1
+        fim.wait(args.pausa_painel)
+
+
+def _commit_atual() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(atual: dict, caminho_anterior: str):
+    """Imprime p95 e vazão por rota: anterior -> atual (variação %)."""
+    with open(caminho_anterior, encoding="utf-8") as arquivo:
+        anterior = json.load(arquivo)
+
+    def variacao(antes, depois):
+        return f"{(depois - antes) / antes * 100:+.1f}%" if antes else "n/a"
+
+    print(f"\nComparação com {caminho_anterior} (commit {anterior['rodada'].get('commit')}):")
+    print(f"{'rota':34} {'p95 antes':>10} {'p95 agora':>10} {'var':>8} {'rps antes':>10} {'rps agora':>10} {'var':>8}")
+    for rota, dados in atual["rotas"].items():
+        velho = anterior["rotas"].get(rota)
+        if not velho:
+            print(f"{rota:34} {'-':>10} {dados['p95_ms']:>10} {'nova':>8}")
+            continue
+        print(f"{rota:34} {velho['p95_ms']:>10} {dados['p95_ms']:>10} {variacao(velho['p95_ms'], dados['p95_ms']):>8} "
+              f"{velho['vazao_rps']:>10} {dados['vazao_rps']:>10} {variacao(velho['vazao_rps'], dados['vazao_rps']):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga do app (acesso, chat e painel).")
+    parser.add_argument("--pacientes", type=int, default=100, help="pacientes virtuais no total")
+    parser.add_argument("--concorrencia", type=int, default=20, help="pacientes ao mesmo tempo")
+    parser.add_argument("--turnos", type=int, default=3, help="mensagens por paciente")
+    parser.add_argument("--admins", type=int, default=2, help="sessões do painel recarregando em paralelo")
+    parser.add_argument("--pausa-painel", type=float, default=0.5, help="pausa entre recargas do painel (s)")
+    parser.add_argument("--stream", action="store_true", help="usa /chat/stream em vez de /chat")
+    parser.add_argument("--latencia", type=float, default=1.0, help="latência da OpenRouter falsa até o 1º byte (s)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="variação aleatória da latência (± s)")
+    parser.add_argument("--pedacos", type=int, default=8, help="eventos SSE por resposta em streaming")
+    parser.add_argument("--intervalo-pedaco", type=float, default=0.05, help="pausa entre eventos SSE (s)")
+    parser.add_argument("--workers", type=int, default=2, help="processos do gunicorn")
+    parser.add_argument("--worker-class", default="gevent", help="gevent ou sync")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"),
+                        help="Postgres usado pelo app (padrão: cluster temporário com initdb)")
+    parser.add_argument("--timeout", type=float, default=120, help="timeout de cada requisição (s)")
+    parser.add_argument("--saida", help="arquivo JSON do resultado (padrão: bench/resultados/carga-<data>.json)")
+    parser.add_argument("--comparar", help="JSON de uma rodada anterior para comparar")
+    parser.add_argument("--rotulo", default="", help="texto livre guardado no resultado (ex.: 'antes do pool')")
+    args = parser.parse_args()
+    args.rodada = int(time.time()) % 100000  # telefones únicos entre rodadas no mesmo banco
+
+    postgres = dir_sqlite = None
+    if not args.database_url:
+        try:
+            postgres = PostgresTemporario().iniciar()
+            args.database_url = postgres.url
+        except RuntimeError as e:
+            print(f"{e} Usando SQLite temporário.", file=sys.stderr)
+            dir_sqlite = tempfile.mkdtemp(prefix="clara_bench_sqlite_")
+            args.database_url = f"sqlite:///{os.path.join(dir_sqlite, 'clara.db')}"
+    sqlite = args.database_url.startswith("sqlite:")
+    upstream = iniciar_openrouter_falsa(latencia=args.latencia, jitter=args.jitter, pedacos=args.pedacos,
+                                        intervalo=args.intervalo_pedaco)
+    senha = os.getenv("PAINEL_SENHA", "bench")
+    porta_app = porta_livre()
+    env = dict(os.environ,
+               DATABASE_URL=args.database_url,
+               OPENROUTER_API_KEY="bench",
+               OPENROUTER_API_URL=url_openrouter(upstream),
+               PAINEL_SENHA=senha,
+               PORT=str(porta_app),
+               WEB_CONCURRENCY=str(args.workers),
+               GUNICORN_WORKER_CLASS=args.worker_class,
+               # Controle de admissão desligado, a menos que venha do ambiente (para medir as recusas 429)
+               IA_CONCORRENCIA_MAX=os.getenv("IA_CONCORRENCIA_MAX", "0"),
+               CHAT_TAXA_POR_MINUTO=os.getenv("CHAT_TAXA_POR_MINUTO", "0"))
+    servidor = None
+    try:
+        subprocess.run([sys.executable, "-m", "painel", "migrate"], cwd=RAIZ, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        servidor = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", "/dev/null", "app:app"],
+            cwd=RAIZ, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        esperar_porta(porta_app)
+        base = f"http://127.0.0.1:{porta_app}"
+
+        coletor = Coletor()
+        monitor = None if sqlite else MonitorBanco(args.database_url).iniciar()
+        fim = threading.Event()
+        admins = [threading.Thread(target=admin, args=(base, senha, args, coletor, fim), daemon=True)
+                  for _ in range(args.admins)]
+        inicio = time.monotonic()
+        for thread in admins:
+            thread.start()
+        with ThreadPoolExecutor(max_workers=args.concorrencia) as executor:
+            list(executor.map(lambda i: paciente(base, i, args, coletor), range(args.pacientes)))
+        fim.set()
+        for thread in admins:
+            thread.join()
+        duracao = time.monotonic() - inicio
+        banco = monitor.parar() if monitor else {"conexoes_abertas": None, "pico_conexoes_simultaneas": None}
+
+        rotas = coletor.resumo(duracao)
+        total = sum(r["requisicoes"] for rota, r in rotas.items() if "primeiro delta" not in rota)
+        erros = sum(r["erros"] for rota, r in rotas.items() if "primeiro delta" not in rota)
+        resultado = {
+            "rodada": {
+                "data": datetime.now().isoformat(timespec="seconds"),
+                "commit": _commit_atual(),
+                "rotulo": args.rotulo,
+                "parametros": {k: v for k, v in vars(args).items()
+                               if k not in ("database_url", "saida", "comparar", "rodada")},
+                "banco": "sqlite" if sqlite else "postgres temporario" if postgres else "postgres externo",
+            },
+            "duracao_s": round(duracao, 2),
+            "requisicoes": total,
+            "erros": erros,
+            "taxa_erro": round(erros / total, 4) if total else 0.0,
+            "vazao_rps": round(total / duracao, 2) if duracao else 0.0,
+            "rotas": rotas,
+            "banco": banco,
+            "openrouter_falsa": upstream.estatisticas(),
+        }
+        saida = args.saida or os.path.join(DIR_RESULTADOS, f"carga-{datetime.now():%Y%m%d-%H%M%S}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(saida)), exist_ok=True)
+        with open(saida, "w", encoding="utf-8") as arquivo:
+            json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+        print(json.dumps(resultado, indent=2, ensure_ascii=False))
+        print(f"\nResultado gravado em {saida}")
+        if args.comparar:
+            comparar(resultado, args.comparar)
+    finally:
+        if servidor:
+            servidor.terminate()
+            servidor.wait(timeout=30)
+        upstream.shutdown()
+        if postgres:
+            postgres.parar()
+        if dir_sqlite:
+            shutil.rmtree(dir_sqlite, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# bench/comum.py - Peças comuns dos benchmarks: OpenRouter falsa, portas e percentis
+
+import json
+import time
+import random
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPOSTA_PADRAO = "Oi! Sou a Dra. Ana. Me conte um pouco mais sobre o que você está sentindo."
+
+
+class OpenRouterFalsa(ThreadingHTTPServer):
+    """
+    Servidor que imita /chat/completions: espera `latencia` (± `jitter`) segundos
+    antes do primeiro byte e, com "stream": true no payload, manda a resposta em
+    `pedacos` eventos SSE separados por `intervalo` segundos. Conta chamadas simultâneas.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, endereco, latencia: float, jitter: float = 0.0, pedacos: int = 8,
+                 intervalo: float = 0.0, resposta: str = RESPOSTA_PADRAO):
+        super().__init__(endereco, _HandlerOpenRouter)
+        self.latencia = latencia
+        self.jitter = jitter
+        self.pedacos = max(1, pedacos)
+        self.intervalo = intervalo
+        self.resposta = resposta
+        self.lock = threading.Lock()
+        self.em_andamento = 0
+        self.pico_em_andamento = 0
+        self.total = 0
+        self.streams = 0
+
+    def atraso(self) -> float:
+        return max(0.0, self.latencia + random.uniform(-self.jitter, self.jitter))
+
+    def estatisticas(self) -> dict:
+        with self.lock:
+            return {"chamadas": self.total, "streams": self.streams, "pico_simultaneas": self.pico_em_andamento}
+
+
+class _HandlerOpenRouter(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        srv = self.server
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            payload = {}
+        stream = bool(payload.get("stream"))
+        with srv.lock:
+            srv.em_andamento += 1
+            srv.total += 1
+            srv.streams += stream
+            srv.pico_em_andamento = max(srv.pico_em_andamento, srv.em_andamento)
+        try:
+            time.sleep(srv.atraso())
+            if stream:
+                self._responder_stream(srv)
+            else:
+                self._responder_json(srv)
+        finally:
+            with srv.lock:
+                srv.em_andamento -= 1
+
+    def _uso(self, srv) -> dict:
+        return {"prompt_tokens": 500, "completion_tokens": len(srv.resposta) // 4,
+                "prompt_tokens_details": {"cached_tokens": 400}}
+
+    def _responder_json(self, srv):
+        corpo = json.dumps({
+            "choices": [{"message": {"role": "assistant", "content": srv.resposta}}],
+            "usage": self._uso(srv),
+        }, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _responder_stream(self, srv):
+        # Transfer-Encoding: chunked, como a OpenRouter: cada evento SSE chega ao cliente assim que é enviado.
+        # Também como ela: UTF-8 cru (acentos sem \u) e Content-Type sem charset
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        tamanho = -(-len(srv.resposta) // srv.pedacos)
+        for i in range(0, len(srv.resposta), tamanho):
+            if i:
+                time.sleep(srv.intervalo)
+            chunk = {"choices": [{"delta": {"content": srv.resposta[i:i + tamanho]}}]}
+            self._enviar_pedaco(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        self._enviar_pedaco(f"data: {json.dumps({'choices': [], 'usage': self._uso(srv)})}\n\n".encode())
+        self._enviar_pedaco(b"data: [DONE]\n\n")
+        self._enviar_pedaco(b"")
+
+    def _enviar_pedaco(self, dados: bytes):
+        self.wfile.write(f"{len(dados):x}\r\n".encode() + dados + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def iniciar_openrouter_falsa(**kwargs) -> OpenRouterFalsa:
+    """Sobe a OpenRouter falsa numa porta livre, em thread daemon."""
+    servidor = OpenRouterFalsa(("127.0.0.1", porta_livre()), **kwargs)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def url_openrouter(servidor: OpenRouterFalsa) -> str:
+    return f"http://127.0.0.1:{servidor.server_address[1]}/api/v1/chat/completions"
+
+
+def porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def esperar_porta(porta: int, timeout: float = 30):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            with socket.create_connection(("127.0.0.1", porta), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Servidor não subiu na porta {porta} em {timeout}s.")
+
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
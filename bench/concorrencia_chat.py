@@ -0,0 +1,118 @@
+# bench/concorrencia_chat.py - Quantos /chat simultâneos cabem em UM processo gunicorn?
+#
+# Sobe uma OpenRouter falsa local (latência configurável), inicia o app com
+# gunicorn (1 worker, classe escolhida) e dispara N chamadas /chat ao mesmo tempo.
+# Com worker "sync" o tempo total cresce ~N x latência; com "gevent" fica perto
+# de 1 x latência, porque as chamadas esperam a IA em paralelo no mesmo processo.
+#
+# Precisa de um Postgres acessível em DATABASE_URL (o token de acesso é criado via /acesso).
+#
+# Exemplo:
+#   python bench/concorrencia_chat.py --requests 300 --latencia 5 --worker-class gevent
+#   python bench/concorrencia_chat.py --requests 20 --latencia 2 --worker-class sync
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from comum import iniciar_openrouter_falsa, url_openrouter, porta_livre, esperar_porta, percentil
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de concorrência do /chat em um único processo.")
+    parser.add_argument("--requests", type=int, default=300, help="chamadas /chat simultâneas")
+    parser.add_argument("--latencia", type=float, default=5.0, help="latência da OpenRouter falsa (s)")
+    parser.add_argument("--worker-class", default="gevent", help="gevent ou sync")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="Postgres usado pelo app")
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("DATABASE_URL não definida (use --database-url).")
+
+    upstream = iniciar_openrouter_falsa(latencia=args.latencia)
+
+    porta_app = porta_livre()
+    env = dict(os.environ,
+               DATABASE_URL=args.database_url,
+               OPENROUTER_API_KEY="bench",
+               OPENROUTER_API_URL=url_openrouter(upstream),
+               PAINEL_SENHA=os.getenv("PAINEL_SENHA", "bench"),
+               PORT=str(porta_app),
+               WEB_CONCURRENCY="1",
+               GUNICORN_WORKER_CLASS=args.worker_class,
+               DB_POOL_MAX=os.getenv("DB_POOL_MAX", "20"),
+               # Controle de admissão desligado, a menos que venha do ambiente (para medir as recusas 429)
+               IA_CONCORRENCIA_MAX=os.getenv("IA_CONCORRENCIA_MAX", "0"),
+               CHAT_TAXA_POR_MINUTO=os.getenv("CHAT_TAXA_POR_MINUTO", "0"))
+    # O app não cria tabelas ao subir: aplica as migrações antes
+    subprocess.run([sys.executable, "-m", "painel", "migrate"], cwd=RAIZ, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    servidor = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", "/dev/null", "app:app"],
+        cwd=RAIZ, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        esperar_porta(porta_app)
+        base = f"http://127.0.0.1:{porta_app}"
+
+        # Cria um acesso novo e guarda o cookie de sessão
+        login = requests.Session()
+        telefone = f"bench{int(time.time() * 1000)}"
+        resp = login.post(f"{base}/acesso", data={"nome": "Bench", "telefone": telefone}, allow_redirects=False)
+        if resp.status_code != 302:
+            raise RuntimeError(f"Falha no /acesso ({resp.status_code}): verifique o DATABASE_URL.")
+        cookies = login.cookies.get_dict()
+
+        latencias, erros = [], []
+        lock = threading.Lock()
+
+        def uma_chamada(i):
+            inicio = time.monotonic()
+            try:
+                r = requests.post(f"{base}/chat", json={"mensagem": f"Oi {i}"}, cookies=cookies, timeout=args.latencia * args.requests + 60)
+                ok = r.status_code == 200
+            except requests.RequestException as e:
+                ok, r = False, e
+            with lock:
+                if ok:
+                    latencias.append(time.monotonic() - inicio)
+                else:
+                    erros.append(getattr(r, "status_code", str(r)))
+
+        inicio_total = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.requests) as executor:
+            list(executor.map(uma_chamada, range(args.requests)))
+        duracao = time.monotonic() - inicio_total
+
+        resultado = {
+            "worker_class": args.worker_class,
+            "processos": 1,
+            "requisicoes": args.requests,
+            "latencia_upstream_s": args.latencia,
+            "ok": len(latencias),
+            "erros": len(erros),
+            "duracao_total_s": round(duracao, 2),
+            "pico_chamadas_upstream_simultaneas": upstream.pico_em_andamento,
+            "p50_s": round(percentil(latencias, 50), 3),
+            "p95_s": round(percentil(latencias, 95), 3),
+            "p99_s": round(percentil(latencias, 99), 3),
+            "throughput_rps": round(len(latencias) / duracao, 2) if duracao else 0.0,
+        }
+        print(json.dumps(resultado, indent=2))
+    finally:
+        servidor.terminate()
+        servidor.wait(timeout=30)
+        upstream.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# cache_respostas.py - Cache opcional de respostas para aberturas de conversa repetidas ("Oi", "bom dia"...)
+
+import os
+import re
+import time
+import random
+import hashlib
+import json
+import threading
+import unicodedata
+from collections import OrderedDict
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "False").lower() in ['true', '1', 't']
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX = int(os.getenv("RESPONSE_CACHE_MAX", "1000"))  # chaves (LRU)
+RESPONSE_CACHE_VARIANTES = int(os.getenv("RESPONSE_CACHE_VARIANTES", "4"))  # respostas guardadas por chave
+RESPONSE_CACHE_MAX_MSGS = int(os.getenv("RESPONSE_CACHE_MAX_MSGS", "1"))  # só conversas com até N msgs (1 = primeiro turno)
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", "60"))  # e mensagens curtas
+
+
+def normalizar(texto: str) -> str:
+    """'Olá!!  Bom dia ' -> 'ola bom dia' (sem acento, caixa, pontuação e espaços extras)."""
+    texto = unicodedata.normalize("NFKD", texto.casefold())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"[^\w\s]", " ", texto)
+    return " ".join(texto.split())
+
+
+def versao_prompt(system_prompt: str) -> str:
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def chave_para(modelo: str, versao_system_prompt: str, historico: list) -> str | None:
+    """
+    Chave do cache para o histórico (sem o system prompt), ou None se a
+    conversa não for uma abertura curta elegível.
+    """
+    if not historico or len(historico) > RESPONSE_CACHE_MAX_MSGS:
+        return None
+    normalizadas = []
+    for mensagem in historico:
+        content = mensagem.get("content")
+        if mensagem.get("role") not in ("user", "assistant") or not isinstance(content, str):
+            return None
+        if len(content) > RESPONSE_CACHE_MAX_CHARS:
+            return None
+        normalizadas.append([mensagem["role"], normalizar(content)])
+    bruto = json.dumps([modelo, versao_system_prompt, normalizadas], ensure_ascii=False)
+    return hashlib.sha256(bruto.encode("utf-8")).hexdigest()
+
+
+class CacheRespostas:
+    """
+    LRU com TTL; cada chave guarda até `variantes` respostas geradas. Enquanto
+    o conjunto não está cheio a busca devolve None (gera mais uma pela IA), depois
+    sorteia entre elas para manter a variedade da temperatura 0.9.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_chaves: int = RESPONSE_CACHE_MAX,
+                 variantes: int = RESPONSE_CACHE_VARIANTES):
+        self.ttl = ttl
+        self.max_chaves = max(1, max_chaves)
+        self.variantes = max(1, variantes)
+        self._dados = OrderedDict()  # chave -> (criado_monotonic, [respostas])
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expiradas": 0}
+
+    def buscar(self, chave: str | None) -> str | None:
+        if chave is None:
+            return None
+        with self._lock:
+            item = self._dados.get(chave)
+            if item is not None and time.monotonic() - item[0] > self.ttl:
+                del self._dados[chave]
+                self._stats["expiradas"] += 1
+                item = None
+            if item is None or len(item[1]) < self.variantes:
+                self._stats["misses"] += 1
+                return None
+            self._dados.move_to_end(chave)
+            self._stats["hits"] += 1
+            return random.choice(item[1])
+
+    def guardar(self, chave: str | None, resposta: str):
+        if chave is None or not resposta:
+            return
+        with self._lock:
+            item = self._dados.get(chave)
+            if item is None:
+                item = (time.monotonic(), [])
+                self._dados[chave] = item
+            if len(item[1]) < self.variantes:
+                # Repetições também contam: o sorteio reproduz a frequência real das respostas
+                item[1].append(resposta)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.max_chaves:
+                self._dados.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["chaves"] = len(self._dados)
+        total = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / total if total else 0.0
+        stats["ativo"] = RESPONSE_CACHE
+        return stats
+
+
+cache = CacheRespostas()
@@ -0,0 +1,99 @@
+# contexto.py - Monta as mensagens enviadas à IA dentro de um orçamento de tokens
+
+import os
+import logging
+from functools import lru_cache
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))  # prompt inteiro (system + histórico)
+CONTEXT_MAX_MSGS = int(os.getenv("CONTEXT_MAX_MSGS", "40"))  # quantas msgs recentes buscar para empacotar
+TOKENS_POR_MENSAGEM = 4  # overhead aproximado de role/separadores por mensagem
+CHARS_POR_TOKEN = 3.5  # heurística para português em tokenizers BPE
+# Marca o system prompt (prefixo fixo de ~7.7 KB) com cache_control para o cache de prompt do provedor.
+# Anthropic/Gemini via OpenRouter usam a marcação; DeepSeek/OpenAI cacheiam o prefixo automaticamente.
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "true").lower() in ['true', '1', 't']
+
+# Usa o tiktoken se estiver instalado (contagem exata p/ modelos OpenAI, boa aproximação p/ os demais)
+try:
+    import tiktoken
+    TIKTOKEN_IMPORTADO = True
+except ImportError:
+    TIKTOKEN_IMPORTADO = False
+
+_codificador = None
+_codificador_falhou = False
+
+
+def _obter_codificador():
+    global _codificador, _codificador_falhou
+    if _codificador is None and TIKTOKEN_IMPORTADO and not _codificador_falhou:
+        try:
+            _codificador = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # Ex.: sem rede para baixar o vocabulário. Fica na heurística.
+            _codificador_falhou = True
+            logging.warning(f"tiktoken indisponível ({e}). Usando estimativa por caracteres.")
+    return _codificador
+
+
+@lru_cache(maxsize=2048)  # system prompt e msgs recentes se repetem a cada turno
+def estimar_tokens(texto: str) -> int:
+    """Estimativa rápida de tokens de um texto."""
+    if not texto:
+        return 0
+    codificador = _obter_codificador()
+    if codificador is not None:
+        return len(codificador.encode(texto, disallowed_special=()))
+    return int(len(texto) / CHARS_POR_TOKEN) + 1
+
+
+def texto_mensagem(mensagem: dict) -> str:
+    """Texto de uma mensagem, seja content string ou lista de partes {"type": "text"}."""
+    content = mensagem.get("content") or ""
+    if isinstance(content, list):
+        return "".join(parte.get("text", "") for parte in content if isinstance(parte, dict))
+    return content
+
+
+def tokens_mensagem(mensagem: dict) -> int:
+    return estimar_tokens(texto_mensagem(mensagem)) + TOKENS_POR_MENSAGEM
+
+
+def mensagem_sistema(system_prompt: str) -> dict:
+    """
+    System prompt como primeira mensagem. Com PROMPT_CACHE, vai em partes com
+    cache_control; o texto é sempre idêntico byte a byte para o prefixo casar.
+    """
+    if not PROMPT_CACHE:
+        return {"role": "system", "content": system_prompt}
+    return {"role": "system", "content": [
+        {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}},
+    ]}
+
+
+def montar_contexto(system_prompt: str, historico: list, orcamento: int = CONTEXT_TOKEN_BUDGET,
+                    resumo: str | None = None) -> tuple[list, int]:
+    """
+    Retorna (mensagens, tokens_estimados): o system prompt, o `resumo` das
+    mensagens antigas (se houver) e as mensagens mais recentes do `historico`
+    que couberem no `orcamento`. A última mensagem (a do usuário neste turno)
+    entra sempre, mesmo estourando o orçamento.
+    """
+    # Ordem estável para o cache de prefixo: prompt fixo -> resumo (muda pouco) -> histórico
+    sistema = mensagem_sistema(system_prompt)
+    total = tokens_mensagem(sistema)
+    prefixo = [sistema]
+    if resumo:
+        msg_resumo = {"role": "system", "content": f"Resumo da conversa anterior com esta paciente:\n{resumo}"}
+        prefixo.append(msg_resumo)
+        total += tokens_mensagem(msg_resumo)
+    escolhidas = []
+    for mensagem in reversed(historico):
+        custo = tokens_mensagem(mensagem)
+        if escolhidas and total + custo > orcamento:
+            break
+        escolhidas.append(mensagem)
+        total += custo
+    escolhidas.reverse()
+    if len(escolhidas) < len(historico):
+        logging.debug("Contexto: %d msg(s) antigas fora do orçamento de %d tokens.", len(historico) - len(escolhidas), orcamento)
+    return prefixo + escolhidas, total
@@ -0,0 +1,249 @@
+# estaticos.py - Arquivos estáticos com hash no nome, pré-comprimidos e com cache longo
+#
+# gerar() (roda no on_starting do gunicorn, ao subir o app ou via `python -m estaticos`)
+# monta static/dist/ a partir dos arquivos de static/:
+#   - cópias com o hash do conteúdo no nome (chat.js -> chat.3f2a1b9c.js);
+#   - variantes .gz e .br (brotli, com o pacote Brotli) dos arquivos de texto;
+#   - o avatar (clara_icon.png) redimensionado: WebP 1x/2x/3x do tamanho exibido
+#     (40px), PNG pequeno de ícone/fallback e um WebP grande para o modal (com Pillow);
+#   - dist/assets.json: nome lógico -> arquivo gerado (só refaz o que mudou).
+# Os templates usam asset('chat.js') e avatar(); as URLs /assets/<arquivo> saem
+# com Cache-Control immutable de um ano e, conforme o Accept-Encoding, com a
+# variante br/gzip. Um deploy que muda um arquivo muda a URL, então não há cache velho.
+#
+# O service worker (/service_worker.js, na raiz para o escopo cobrir o /dra-ana)
+# é gerado com a versão do assets.json: pré-carrega os assets do app shell e o
+# próprio /dra-ana, que abre do cache nas visitas seguintes e se atualiza em
+# segundo plano. Cada deploy troca a versão e o cache antigo é apagado.
+#
+# Sem Pillow o avatar continua o PNG original (com hash); sem Brotli só há .gz.
+#
+# Variáveis de ambiente:
+#   ESTATICOS_GERAR           true (padrão) = gera o que faltar ao subir o app; false = só lê o assets.json
+#   ESTATICOS_CACHE_SEGUNDOS  max-age dos arquivos com hash (padrão 31536000 = 1 ano)
+
+import os
+import io
+import json
+import gzip
+import hashlib
+import logging
+import mimetypes
+
+from flask import render_template, request, send_from_directory, url_for, abort
+
+try:
+    import brotli
+    BROTLI_IMPORTADO = True
+except ImportError:
+    BROTLI_IMPORTADO = False
+
+try:
+    from PIL import Image
+    PIL_IMPORTADO = True
+except ImportError:
+    PIL_IMPORTADO = False
+
+ESTATICOS_GERAR = os.getenv("ESTATICOS_GERAR", "True").lower() in ['true', '1', 't']
+ESTATICOS_CACHE_SEGUNDOS = int(os.getenv("ESTATICOS_CACHE_SEGUNDOS", str(365 * 24 * 3600)))
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFESTO = os.path.join(DIST_DIR, "assets.json")
+PREFIXO_URL = "/assets/"
+
+ASSETS = ["chat.js", "chat_style.css", "style.css", "clara_icon.png"]
+COMPRIMIVEIS = {".js", ".css", ".json", ".svg", ".html"}
+COMPRESSAO_MINIMA = 1024  # bytes; abaixo disso a variante comprimida não compensa
+
+# Avatar: exibido a 40px (chat_style.css .avatar); 2x/3x para telas densas
+AVATAR = "clara_icon.png"
+AVATAR_TAMANHO = 40
+AVATAR_VARIANTES = {
+    "clara_icon-40.webp": 40,
+    "clara_icon-80.webp": 80,
+    "clara_icon-120.webp": 120,
+    "clara_icon-80.png": 80,     # fallback sem suporte a WebP
+    "clara_icon-192.png": 192,   # ícone das páginas de acesso
+    "clara_icon-512.webp": 512,  # modal com a foto ampliada
+}
+
+SHELL = "/dra-ana"
+SHELL_ASSETS = ["chat.js", "chat_style.css", "clara_icon-40.webp", "clara_icon-80.webp", "clara_icon-120.webp"]
+
+_manifesto = {"arquivos": {}, "origens": {}, "versao": "dev"}
+
+
+def _hash(dados: bytes) -> str:
+    return hashlib.sha256(dados).hexdigest()
+
+
+def _nome_com_hash(nome: str, dados: bytes) -> str:
+    base, extensao = os.path.splitext(nome)
+    return f"{base}.{_hash(dados)[:10]}{extensao}"
+
+
+def _gravar(caminho: str, dados: bytes):
+    """Escrita atômica: workers subindo juntos nunca veem um arquivo pela metade."""
+    parcial = f"{caminho}.{os.getpid()}.parcial"
+    with open(parcial, "wb") as arquivo:
+        arquivo.write(dados)
+    os.replace(parcial, caminho)
+
+
+def _publicar(nome: str, dados: bytes) -> str:
+    """Grava a cópia com hash (e as variantes comprimidas) em DIST_DIR; retorna o nome gerado."""
+    gerado = _nome_com_hash(nome, dados)
+    caminho = os.path.join(DIST_DIR, gerado)
+    if not os.path.exists(caminho):
+        _gravar(caminho, dados)
+    if os.path.splitext(nome)[1] in COMPRIMIVEIS and len(dados) >= COMPRESSAO_MINIMA:
+        if not os.path.exists(caminho + ".gz"):
+            _gravar(caminho + ".gz", gzip.compress(dados, compresslevel=9, mtime=0))
+        if BROTLI_IMPORTADO and not os.path.exists(caminho + ".br"):
+            _gravar(caminho + ".br", brotli.compress(dados, quality=11))
+    return gerado
+
+
+def _redimensionar(dados: bytes, lado: int, formato: str) -> bytes:
+    """Reduz a imagem para o menor lado = `lado` (o CSS recorta com object-fit: cover)."""
+    with Image.open(io.BytesIO(dados)) as imagem:
+        imagem.load()
+        escala = lado / min(imagem.size)
+        if escala < 1:
+            imagem = imagem.resize((round(imagem.width * escala), round(imagem.height * escala)), Image.LANCZOS)
+        saida = io.BytesIO()
+        if formato == "webp":
+            imagem.save(saida, "WEBP", quality=82, method=6)
+        else:
+            imagem.save(saida, "PNG", optimize=True)
+        return saida.getvalue()
+
+
+def gerar() -> dict:
+    """
+    Atualiza DIST_DIR e o assets.json a partir de static/. Só refaz os arquivos cuja
+    origem mudou (pelo hash); retorna o manifesto. Seguro com vários processos.
+    """
+    os.makedirs(DIST_DIR, exist_ok=True)
+    anterior = _ler_manifesto() or {"arquivos": {}, "origens": {}}
+    arquivos, origens = {}, {}
+    for nome in ASSETS:
+        caminho = os.path.join(STATIC_DIR, nome)
+        if not os.path.exists(caminho):
+            logging.warning(f"Estáticos: '{nome}' não encontrado em {STATIC_DIR}.")
+            continue
+        with open(caminho, "rb") as arquivo:
+            dados = arquivo.read()
+        origens[nome] = _hash(dados)
+        arquivos[nome] = _publicar(nome, dados)
+        if nome == AVATAR and PIL_IMPORTADO:
+            for variante, lado in AVATAR_VARIANTES.items():
+                gerado = anterior["arquivos"].get(variante)
+                if anterior["origens"].get(nome) != origens[nome] or not gerado or \
+                        not os.path.exists(os.path.join(DIST_DIR, gerado)):
+                    gerado = _publicar(variante, _redimensionar(dados, lado, os.path.splitext(variante)[1][1:]))
+                arquivos[variante] = gerado
+    if AVATAR in arquivos and not PIL_IMPORTADO:
+        logging.warning("Estáticos: Pillow não instalado; avatar sem as versões reduzidas/WebP.")
+    manifesto = {"arquivos": arquivos, "origens": origens,
+                 "versao": _hash(json.dumps(arquivos, sort_keys=True).encode())[:12]}
+    if manifesto != anterior:
+        _gravar(MANIFESTO, json.dumps(manifesto, indent=2, sort_keys=True).encode())
+        logging.info(f"Estáticos: {len(arquivos)} arquivo(s) em {DIST_DIR} (versão {manifesto['versao']}, "
+                     f"brotli={BROTLI_IMPORTADO}, pillow={PIL_IMPORTADO}).")
+    return manifesto
+
+
+def _ler_manifesto() -> dict | None:
+    try:
+        with open(MANIFESTO, "r", encoding="utf-8") as arquivo:
+            return json.load(arquivo)
+    except (OSError, ValueError):
+        return None
+
+
+def carregar() -> dict:
+    """Gera (se ESTATICOS_GERAR) e carrega o manifesto do processo."""
+    global _manifesto
+    try:
+        manifesto = gerar() if ESTATICOS_GERAR else _ler_manifesto()
+    except Exception:
+        logging.exception("Estáticos: falha ao gerar static/dist; servindo os arquivos originais.")
+        manifesto = _ler_manifesto()
+    if manifesto:
+        _manifesto = manifesto
+    return _manifesto
+
+
+# --- Templates ---
+
+def asset(nome: str, alternativa: str | None = None) -> str:
+    """
+    URL com hash de `nome`; sem ele no manifesto (ex.: variante do avatar sem
+    Pillow), a de `alternativa`; sem nenhum dos dois, a URL normal de static/.
+    """
+    for candidato in (nome, alternativa):
+        gerado = _manifesto["arquivos"].get(candidato) if candidato else None
+        if gerado:
+            return PREFIXO_URL + gerado
+    return url_for("static", filename=alternativa or nome)
+
+
+def avatar() -> dict:
+    """
+    URLs do avatar para o <picture> do chat: 'webp' (srcset 1x/2x/3x, ou None sem
+    Pillow), 'src' (PNG de fallback) e 'grande' (foto ampliada do modal).
+    """
+    arquivos = _manifesto["arquivos"]
+    webp = None
+    if "clara_icon-40.webp" in arquivos:
+        webp = ", ".join(f"{asset(f'clara_icon-{lado}.webp')} {lado // AVATAR_TAMANHO}x" for lado in (40, 80, 120))
+    return {"webp": webp, "src": asset("clara_icon-80.png", AVATAR), "grande": asset("clara_icon-512.webp", AVATAR)}
+
+
+# --- Integração com o Flask ---
+
+def instalar(app):
+    """Carrega o manifesto e registra /assets/<arquivo>, /service_worker.js e os helpers dos templates."""
+    carregar()
+    app.jinja_env.globals.update(asset=asset, avatar=avatar)
+
+    @app.route(PREFIXO_URL + "<path:arquivo>")
+    def assets(arquivo):
+        """Arquivo com hash: imutável; vai a variante br/gzip se o cliente aceitar."""
+        if arquivo.endswith((".gz", ".br")) or not os.path.isfile(os.path.join(DIST_DIR, arquivo)):
+            abort(404)
+        tipo = mimetypes.guess_type(arquivo)[0] or "application/octet-stream"
+        codificacao = None
+        for nome, extensao in (("br", ".br"), ("gzip", ".gz")):
+            if request.accept_encodings[nome] and os.path.isfile(os.path.join(DIST_DIR, arquivo + extensao)):
+                codificacao = nome
+                arquivo += extensao
+                break
+        resposta = send_from_directory(DIST_DIR, arquivo, mimetype=tipo, max_age=ESTATICOS_CACHE_SEGUNDOS)
+        if codificacao:
+            resposta.headers["Content-Encoding"] = codificacao
+            resposta.headers.pop("Content-Disposition", None)  # Nome da variante (.br/.gz), não do arquivo
+        resposta.headers["Vary"] = "Accept-Encoding"
+        resposta.cache_control.public = True
+        resposta.cache_control.immutable = True
+        return resposta
+
+    @app.route("/service_worker.js")
+    def service_worker():
+        """Service worker do app shell; sem cache HTTP para o navegador ver logo a versão nova."""
+        corpo = render_template("service_worker.js", versao=_manifesto["versao"], shell=SHELL,
+                                prefixo=PREFIXO_URL, precache=[asset(nome) for nome in SHELL_ASSETS
+                                                               if nome in _manifesto["arquivos"]])
+        return corpo, 200, {"Content-Type": "application/javascript; charset=utf-8", "Cache-Control": "no-cache"}
+
+
+def estatisticas() -> dict:
+    return {"versao": _manifesto["versao"], "arquivos": len(_manifesto["arquivos"]),
+            "brotli": BROTLI_IMPORTADO, "pillow": PIL_IMPORTADO}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    print(json.dumps(gerar()["arquivos"], indent=2))
@@ -0,0 +1,91 @@
+# gunicorn.conf.py - Configuração do servidor (usada pelo Procfile)
+#
+# Por padrão roda com workers "gevent" (green threads): enquanto um /chat espera
+# a OpenRouter (até 45 s), o mesmo processo continua atendendo outras requisições.
+# O gevent faz monkey-patch de socket/ssl (requests fica não-bloqueante) e o
+# psycogreen torna o psycopg2 cooperativo, então as esperas no Postgres também
+# liberam o worker.
+#
+# Variáveis de ambiente:
+#   GUNICORN_WORKER_CLASS        gevent (padrão) ou sync (modo antigo, 1 requisição por worker)
+#   WEB_CONCURRENCY              número de processos worker (padrão 2)
+#   GUNICORN_WORKER_CONNECTIONS  requisições simultâneas por worker gevent (padrão 1000)
+#   GUNICORN_TIMEOUT             segundos sem heartbeat antes de reiniciar o worker (padrão 120)
+#   PORT                         porta HTTP (padrão 5000)
+#   PROMETHEUS_MULTIPROC_DIR     onde os workers gravam as métricas do /metrics (padrão: <tmp>/clara_metricas)
+#
+# As mensagens do chat são gravadas em lote por uma thread de cada worker (ver
+# painel/escrita.py); o graceful_timeout precisa deixar tempo para o worker_exit
+# descarregar a fila. Spools deixados por workers mortos ficam em ESCRITA_SPOOL_DIR.
+#
+# Lembre de dimensionar DB_POOL_MAX: com gevent centenas de requisições dividem
+# as DB_POOL_MAX conexões do processo (as excedentes esperam a vez no pool).
+#
+# Benchmark de concorrência: python bench/concorrencia_chat.py --help
+
+import os
+import glob
+import logging
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+# Maior que o timeout da OpenRouter (45 s) para o modo sync não matar workers no meio da chamada
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+# Métricas Prometheus somadas entre workers: precisa estar no ambiente antes de os workers importarem o app
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "clara_metricas"))
+
+
+def on_starting(server):
+    """
+    Começa as métricas do zero a cada start do master (arquivos de processos antigos
+    somariam) e gera static/dist uma vez, antes dos workers (ver estaticos.py).
+    """
+    diretorio = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    os.makedirs(diretorio, exist_ok=True)
+    for arquivo in glob.glob(os.path.join(diretorio, "*.db")):
+        os.remove(arquivo)
+    try:
+        import estaticos
+        estaticos.gerar()
+    except Exception:
+        logging.warning("Não foi possível gerar static/dist no master; os workers tentam ao subir.", exc_info=True)
+
+
+def post_worker_init(worker):
+    """Depois do monkey-patch do gevent: torna o psycopg2 cooperativo."""
+    if worker_class != "gevent":
+        return
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        logging.info(f"Worker {worker.pid}: psycopg2 em modo gevent (psycogreen).")
+    except ImportError:
+        logging.warning(f"Worker {worker.pid}: psycogreen não instalado; consultas ao Postgres vão bloquear o worker.")
+
+
+def child_exit(server, worker):
+    """Worker morto: seus gauges 'live' saem da soma (contadores e histogramas continuam valendo)."""
+    try:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+    except ImportError:
+        pass
+
+
+def worker_exit(server, worker):
+    """
+    Ao encerrar o worker: grava as mensagens ainda na fila de escrita (no banco ou,
+    se ele não responder, no spool local) e fecha as conexões do pool do painel.
+    """
+    try:
+        from painel import fechar_pool
+        fechar_pool()
+    except Exception:
+        logging.warning("Não foi possível descarregar a fila/fechar o pool do painel.", exc_info=True)
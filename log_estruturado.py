@@ -0,0 +1,249 @@
+# log_estruturado.py - Logging fora da latência da requisição: fila + thread, JSON e amostragem
+#
+# Com LOG_FILA (padrão) o handler do root só enfileira o LogRecord; a formatação
+# (inclusive o `msg % args` das chamadas com argumentos) e a escrita no stderr
+# ficam na thread do QueueListener. Com LOG_FORMATO=json cada linha é um objeto
+# JSON. Cada requisição gera UM registro consolidado ("Requisição ...") com
+# método, rota, status, duração, as etapas medidas e os campos anotados pelo
+# código (anotar); as linhas por chamada (BD, IA...) são DEBUG e só saem numa
+# fração LOG_AMOSTRAGEM_DEBUG das requisições (0 = nunca, 1 = todas).
+#
+# Variáveis de ambiente:
+#   LOG_FORMATO          texto (padrão) ou json
+#   LOG_NIVEL            nível do root (padrão INFO)
+#   LOG_FILA             true (padrão) = handler em fila; false = escrita síncrona (modo antigo)
+#   LOG_FILA_MAX         registros pendentes na fila; além disso são descartados (padrão 10000)
+#   LOG_AMOSTRAGEM_DEBUG fração das requisições com registros DEBUG (padrão 0)
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, request, has_request_context, stream_with_context
+
+LOG_FORMATO = os.getenv("LOG_FORMATO", "texto").lower()
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO").upper()
+LOG_FILA = os.getenv("LOG_FILA", "True").lower() in ['true', '1', 't']
+LOG_FILA_MAX = int(os.getenv("LOG_FILA_MAX", "10000"))
+LOG_AMOSTRAGEM_DEBUG = min(1.0, max(0.0, float(os.getenv("LOG_AMOSTRAGEM_DEBUG", "0"))))
+
+FORMATO_TEXTO = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener = None
+_handler_fila = None
+_lock = threading.Lock()
+
+
+class FormatoJSON(logging.Formatter):
+    """Uma linha JSON por registro; os campos de `extra={"campos": {...}}` vão para o nível de cima."""
+
+    def format(self, record):
+        dados = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "msg": record.getMessage(),
+        }
+        campos = getattr(record, "campos", None)
+        if campos:
+            dados.update(campos)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            dados["exc"] = record.exc_text
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+
+class FormatoTexto(logging.Formatter):
+    """O formato antigo, com os campos do registro consolidado em 'chave=valor' no fim."""
+
+    def format(self, record):
+        linha = super().format(record)
+        campos = getattr(record, "campos", None)
+        if campos:
+            linha += " " + " ".join(f"{chave}={valor}" for chave, valor in campos.items())
+        return linha
+
+
+class AmostragemDebug(logging.Filter):
+    """
+    Deixa passar todo registro INFO ou acima; DEBUG só nas requisições sorteadas
+    (a decisão é por requisição, então uma requisição amostrada sai inteira).
+    Fora de requisição (threads de fundo) o sorteio é por registro.
+    """
+
+    def __init__(self, taxa: float):
+        super().__init__()
+        self.taxa = taxa
+
+    def filter(self, record):
+        if record.levelno >= logging.INFO:
+            return True
+        if self.taxa <= 0:
+            return False
+        if has_request_context():
+            return g.get("_log_amostrada", False)
+        return random.random() < self.taxa
+
+
+class HandlerFila(QueueHandler):
+    """
+    QueueHandler que NÃO formata na thread de quem loga (o padrão do stdlib
+    formata em prepare()); só a exceção vira texto aqui, enquanto o traceback
+    ainda existe. Com a fila cheia o registro é descartado e contado.
+    """
+
+    def __init__(self, fila):
+        super().__init__(fila)
+        self.descartados = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+def _formatador() -> logging.Formatter:
+    return FormatoJSON() if LOG_FORMATO == "json" else FormatoTexto(FORMATO_TEXTO)
+
+
+def configurar():
+    """
+    Troca os handlers do root conforme o ambiente. Idempotente; chamar depois
+    do load_dotenv. Com a fila, a thread de escrita é drenada no atexit.
+    """
+    global _listener, _handler_fila
+    with _lock:
+        if _listener is not None:
+            return
+        raiz = logging.getLogger()
+        for handler in list(raiz.handlers):
+            raiz.removeHandler(handler)
+        saida = logging.StreamHandler(sys.stderr)
+        saida.setFormatter(_formatador())
+        nivel = getattr(logging, LOG_NIVEL, logging.INFO)
+        # DEBUG só é criado se alguma fração for amostrada; senão o logging.debug sai no isEnabledFor
+        raiz.setLevel(min(nivel, logging.DEBUG) if LOG_AMOSTRAGEM_DEBUG > 0 else nivel)
+        if LOG_FILA:
+            _handler_fila = HandlerFila(queue.Queue(maxsize=LOG_FILA_MAX))
+            _handler_fila.addFilter(AmostragemDebug(LOG_AMOSTRAGEM_DEBUG))
+            raiz.addHandler(_handler_fila)
+            _listener = QueueListener(_handler_fila.queue, saida, respect_handler_level=True)
+            _listener.start()
+            atexit.register(parar)
+        else:
+            saida.addFilter(AmostragemDebug(LOG_AMOSTRAGEM_DEBUG))
+            raiz.addHandler(saida)
+            _listener = False  # Configurado, sem thread
+    logging.info(f"Logging: formato={LOG_FORMATO}, fila={LOG_FILA}, amostragem_debug={LOG_AMOSTRAGEM_DEBUG}")
+
+
+def parar():
+    """Escreve o que ainda está na fila e encerra a thread de logging."""
+    global _listener
+    with _lock:
+        if _listener:
+            try:
+                _listener.stop()
+            except queue.Full:
+                pass
+            _listener = None
+
+
+def anotar(**campos):
+    """Acrescenta campos ao registro consolidado da requisição atual (no-op fora de requisição)."""
+    if has_request_context():
+        g.setdefault("_log_campos", {}).update(campos)
+
+
+def anotar_etapa(etapa: str, segundos: float):
+    """Duração de uma etapa (ms) no registro consolidado; usada por metricas.medir."""
+    if has_request_context():
+        g.setdefault("_log_etapas", {})[etapa] = round(segundos * 1000, 1)
+
+
+def stream_com_contexto(gerador):
+    """
+    stream_with_context que segura os teardowns até o fim do stream. No Flask 3.1
+    o teardown_request roda quando a view retorna (antes do stream começar) e de
+    novo quando ele termina; enquanto em_stream() for verdadeiro, os teardowns do
+    app (registro consolidado, vaga da IA...) esperam pela segunda vez.
+    """
+    g._stream_aberto = True
+
+    def gerar():
+        try:
+            yield from gerador
+        finally:
+            g._stream_aberto = False
+
+    return stream_with_context(gerar())
+
+
+def em_stream() -> bool:
+    """True no teardown de uma view que devolveu stream_com_contexto(...) ainda não terminado."""
+    return bool(g.get("_stream_aberto"))
+
+
+def instalar(app):
+    """Registra os hooks do Flask que montam e emitem o registro consolidado de cada requisição."""
+
+    @app.before_request
+    def _iniciar_registro():
+        g._log_inicio = time.perf_counter()
+        g._log_amostrada = LOG_AMOSTRAGEM_DEBUG > 0 and random.random() < LOG_AMOSTRAGEM_DEBUG
+
+    @app.after_request
+    def _status_registro(resposta):
+        g._log_status = resposta.status_code
+        return resposta
+
+    # Com stream_com_contexto o registro sai no fim do stream, então a duração inclui o SSE inteiro
+    @app.teardown_request
+    def _emitir_registro(erro):
+        inicio = g.get("_log_inicio")
+        if inicio is None or request.endpoint == "static" or em_stream():
+            return
+        g._log_inicio = None  # Um registro por requisição
+        campos = {
+            "metodo": request.method,
+            "rota": request.path,
+            "status": g.get("_log_status", 500),
+            "duracao_ms": round((time.perf_counter() - inicio) * 1000, 1),
+        }
+        etapas = g.get("_log_etapas")
+        if etapas:
+            campos["etapas_ms"] = etapas
+        campos.update(g.get("_log_campos", {}))
+        if g.get("_log_amostrada"):
+            campos["amostrada"] = True
+        if erro is not None:
+            campos["erro"] = repr(erro)
+        logging.info("Requisição %s %s -> %s (%.1f ms)", campos["metodo"], campos["rota"],
+                     campos["status"], campos["duracao_ms"], extra={"campos": campos})
+
+
+def estatisticas() -> dict:
+    return {
+        "formato": LOG_FORMATO,
+        "fila": LOG_FILA,
+        "pendentes": _handler_fila.queue.qsize() if _handler_fila else 0,
+        "descartados": _handler_fila.descartados if _handler_fila else 0,
+        "amostragem_debug": LOG_AMOSTRAGEM_DEBUG,
+    }
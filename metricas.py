@@ -0,0 +1,102 @@
+# metricas.py - Métricas Prometheus do caminho quente (/chat, banco do painel e OpenRouter)
+#
+# Com vários workers do gunicorn cada processo tem seus contadores; o
+# gunicorn.conf.py define PROMETHEUS_MULTIPROC_DIR e o prometheus_client grava
+# os valores em arquivos mmap nesse diretório. O /metrics de qualquer worker
+# soma todos eles (MultiProcessCollector).
+# Sem o prometheus_client instalado as métricas viram no-op e o /metrics responde 503.
+
+import os
+import time
+from contextlib import contextmanager
+
+import log_estruturado
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+    from prometheus_client import multiprocess
+    PROMETHEUS_IMPORTADO = True
+except ImportError:
+    PROMETHEUS_IMPORTADO = False
+
+# Etapas do /chat vão de ms (cache, banco) a dezenas de segundos (IA)
+BUCKETS_ETAPA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 45, 90)
+BUCKETS_BD = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class _MetricaNula:
+    """Substituta quando o prometheus_client não está instalado."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, valor):
+        pass
+
+    def inc(self, valor=1):
+        pass
+
+    def dec(self, valor=1):
+        pass
+
+
+if PROMETHEUS_IMPORTADO:
+    CHAT_ETAPA = Histogram("clara_chat_etapa_segundos", "Duração de cada etapa do /chat",
+                           ["rota", "etapa"], buckets=BUCKETS_ETAPA)
+    CHAT_RESULTADO = Counter("clara_chat_requisicoes_total", "Requisições do /chat por resultado",
+                             ["rota", "resultado"])
+    BD_FUNCAO = Histogram("clara_painel_bd_segundos", "Duração das funções de banco do painel",
+                          ["funcao"], buckets=BUCKETS_BD)
+    IA_RESPOSTAS = Counter("clara_openrouter_respostas_total", "Respostas da OpenRouter por status HTTP (ou tipo de falha)",
+                           ["status"])
+    IA_RETRIES = Counter("clara_openrouter_retries_total", "Novas tentativas de chamada à OpenRouter")
+    IA_TOKENS = Counter("clara_ia_tokens_total", "Tokens contabilizados pela OpenRouter", ["tipo"])
+    # Controle de admissão (admissao.py); os gauges somam os workers vivos
+    IA_EM_ANDAMENTO = Gauge("clara_ia_em_andamento", "Requisições de chat com vaga no limitador de concorrência",
+                            multiprocess_mode="livesum")
+    IA_FILA = Gauge("clara_ia_fila", "Requisições de chat esperando vaga no limitador", multiprocess_mode="livesum")
+    ADMISSAO_RECUSAS = Counter("clara_admissao_recusas_total", "Requisições de chat recusadas com 429, por motivo",
+                               ["motivo"])
+    # Lista de modelos e hedge (modelos_ia.py)
+    IA_MODELO_LATENCIA = Histogram("clara_ia_modelo_latencia_segundos",
+                                   "Latência do modelo vencedor até a resposta (ou o primeiro pedaço, no stream)",
+                                   ["modelo", "tipo"], buckets=BUCKETS_ETAPA)
+    IA_HEDGE_DISPAROS = Counter("clara_ia_hedge_disparos_total", "Chamadas extras a outro modelo, por motivo (limiar ou falha)",
+                                ["motivo"])
+else:
+    CHAT_ETAPA = CHAT_RESULTADO = BD_FUNCAO = _MetricaNula()
+    IA_RESPOSTAS = IA_RETRIES = IA_TOKENS = _MetricaNula()
+    IA_EM_ANDAMENTO = IA_FILA = ADMISSAO_RECUSAS = _MetricaNula()
+    IA_MODELO_LATENCIA = IA_HEDGE_DISPAROS = _MetricaNula()
+
+
+@contextmanager
+def medir(histograma, **labels):
+    """
+    `with medir(CHAT_ETAPA, rota="chat", etapa="ia"):` observa a duração do bloco (mesmo com exceção)
+    e a anota no registro de log consolidado da requisição.
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracao = time.perf_counter() - inicio
+        histograma.labels(**labels).observe(duracao)
+        if "etapa" in labels:
+            log_estruturado.anotar_etapa(labels["etapa"], duracao)
+
+
+def observar_bd(funcao: str, segundos: float):
+    """Callback registrado no painel (configurar_metricas) para cada função de banco."""
+    BD_FUNCAO.labels(funcao=funcao).observe(segundos)
+
+
+def exportar() -> tuple[bytes, str] | None:
+    """Texto no formato de exposição do Prometheus (somando os workers), ou None sem prometheus_client."""
+    if not PROMETHEUS_IMPORTADO:
+        return None
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+        return generate_latest(registro), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
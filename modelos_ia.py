@@ -0,0 +1,251 @@
+# modelos_ia.py - Lista ordenada de modelos da IA e chamadas "hedged" entre eles
+#
+# AI_MODELS traz os modelos em ordem de preferência. Cada chamada começa no
+# primeiro; se ele não responder (no stream: não mandar o primeiro pedaço)
+# dentro do limiar, o próximo da lista é disparado em paralelo e vale o que
+# responder primeiro - o outro é cancelado (a conexão é fechada e a OpenRouter
+# para de gerar). Se um modelo falha, o próximo é disparado na hora (fallback):
+# por isso só o último da lista faz os retries do cliente OpenRouter, e cada
+# modelo tem o seu circuit breaker (openrouter.py).
+#
+# O limiar de cada modelo vem da latência medida dele neste processo: percentil
+# IA_HEDGE_PERCENTIL das últimas IA_HEDGE_AMOSTRAS respostas, dentro de
+# [IA_HEDGE_MIN, IA_HEDGE_MAX]. Com p95 só ~5% das chamadas disparam uma cópia,
+# e a cauda fica perto de limiar + latência do segundo modelo em vez de
+# esperar o OPENROUTER_READ_TIMEOUT do primeiro.
+#
+# Variáveis de ambiente:
+#   AI_MODELS               modelos em ordem de preferência, separados por vírgula
+#                           (padrão deepseek/deepseek-chat-v3-0324; um só = sem hedge)
+#   IA_HEDGE_PARALELAS      chamadas simultâneas por pedido (padrão 2; 1 = só fallback em erro)
+#   IA_HEDGE_PERCENTIL      percentil da latência usado como limiar (padrão 95)
+#   IA_HEDGE_MIN            limiar mínimo em segundos (padrão 1.5)
+#   IA_HEDGE_MAX            limiar máximo em segundos (padrão 15)
+#   IA_HEDGE_PADRAO         limiar enquanto o modelo tem poucas amostras (padrão 8)
+#   IA_HEDGE_AMOSTRAS       latências guardadas por modelo (padrão 200)
+#   IA_HEDGE_MIN_AMOSTRAS   amostras para passar a usar o percentil (padrão 20)
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+import metricas
+
+AI_MODELS = [m.strip() for m in os.getenv("AI_MODELS", "deepseek/deepseek-chat-v3-0324").split(",") if m.strip()]
+IA_HEDGE_PARALELAS = max(1, int(os.getenv("IA_HEDGE_PARALELAS", "2")))
+IA_HEDGE_PERCENTIL = min(100.0, max(1.0, float(os.getenv("IA_HEDGE_PERCENTIL", "95"))))
+IA_HEDGE_MIN = float(os.getenv("IA_HEDGE_MIN", "1.5"))
+IA_HEDGE_MAX = float(os.getenv("IA_HEDGE_MAX", "15"))
+IA_HEDGE_PADRAO = float(os.getenv("IA_HEDGE_PADRAO", "8"))
+IA_HEDGE_AMOSTRAS = int(os.getenv("IA_HEDGE_AMOSTRAS", "200"))
+IA_HEDGE_MIN_AMOSTRAS = int(os.getenv("IA_HEDGE_MIN_AMOSTRAS", "20"))
+
+# Mensagens das threads das tentativas para a corrida
+_ITEM, _FIM, _ERRO = "item", "fim", "erro"
+
+
+def _percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+class LatenciaModelo:
+    """
+    Janela das últimas latências de um modelo (até a resposta, ou até o primeiro
+    pedaço no stream) e o limiar de hedge derivado dela.
+    """
+
+    def __init__(self, janela: int = IA_HEDGE_AMOSTRAS):
+        self._amostras = deque(maxlen=max(1, janela))
+        self._lock = threading.Lock()
+        self._stats = {"respostas": 0, "falhas": 0, "canceladas": 0}
+
+    def registrar(self, segundos: float, evento: str = "respostas"):
+        """
+        Guarda uma latência. Chamadas canceladas entram com o tempo até o
+        cancelamento (a latência real foi no mínimo isso), senão o limiar só
+        veria as respostas rápidas.
+        """
+        with self._lock:
+            self._amostras.append(segundos)
+            self._stats[evento] += 1
+
+    def contar(self, evento: str):
+        with self._lock:
+            self._stats[evento] += 1
+
+    def limiar(self) -> float:
+        """Segundos sem resposta até disparar o próximo modelo."""
+        with self._lock:
+            if len(self._amostras) < IA_HEDGE_MIN_AMOSTRAS:
+                return IA_HEDGE_PADRAO
+            valor = _percentil(list(self._amostras), IA_HEDGE_PERCENTIL)
+        return min(IA_HEDGE_MAX, max(IA_HEDGE_MIN, valor))
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            amostras = list(self._amostras)
+            stats = dict(self._stats)
+        stats["amostras"] = len(amostras)
+        if amostras:
+            stats.update(p50_s=_percentil(amostras, 50), p95_s=_percentil(amostras, 95), p99_s=_percentil(amostras, 99))
+        stats["limiar_s"] = self.limiar()
+        return stats
+
+
+class Tentativa:
+    """
+    Chamada a um modelo dentro de uma corrida; `ao_cancelar` registra como
+    interrompê-la. `ultima` diz se não há mais modelo para o fallback: só então
+    vale a pena repetir a chamada (retries com backoff) no mesmo modelo.
+    """
+
+    def __init__(self, modelo: str, indice: int, ultima: bool = True):
+        self.modelo = modelo
+        self.indice = indice
+        self.ultima = ultima
+        self.inicio = time.monotonic()
+        self.cancelada = False
+        self._interromper = None
+        self._lock = threading.Lock()
+
+    def ao_cancelar(self, funcao):
+        """Registra `funcao` (ex.: response.close); se a tentativa já foi cancelada, chama na hora."""
+        with self._lock:
+            if not self.cancelada:
+                self._interromper = funcao
+                return
+        funcao()
+
+    def cancelar(self):
+        with self._lock:
+            if self.cancelada:
+                return
+            self.cancelada = True
+            funcao, self._interromper = self._interromper, None
+        if funcao is not None:
+            try:
+                funcao()
+            except Exception as e:
+                logging.debug("Erro ao cancelar chamada a %s: %s", self.modelo, e)
+
+
+def _executar(tentar, tentativa: Tentativa, fila: queue.Queue):
+    """Thread de uma tentativa: repassa os itens de tentar(modelo, tentativa) para a corrida."""
+    try:
+        for item in tentar(tentativa.modelo, tentativa):
+            if tentativa.cancelada:
+                return
+            fila.put((tentativa, _ITEM, item))
+        fila.put((tentativa, _FIM, None))
+    except Exception as e:
+        fila.put((tentativa, _ERRO, e))
+
+
+def correr(tentar, tipo: str, modelos: list | None = None):
+    """
+    Gera os itens de `tentar(modelo, tentativa)` (um iterador; levanta as exceções
+    de sempre) do primeiro modelo que produzir um item. Dispara o próximo modelo
+    quando os em andamento passam do limiar sem produzir nada ou falham, e cancela
+    os outros quando há um vencedor. `tipo` separa as latências ('resposta' ou
+    'stream'). Se todos falharem, levanta a exceção do primeiro modelo.
+    Cada tentativa roda numa thread (greenlet com o monkey-patch do gevent).
+    """
+    modelos = modelos or AI_MODELS
+    fila = queue.Queue()
+    tentativas = []
+    erros = {}
+    vencedora = None
+    proximo_disparo = None
+
+    def disparar(motivo: str):
+        nonlocal proximo_disparo
+        tentativa = Tentativa(modelos[len(tentativas)], len(tentativas), ultima=len(tentativas) == len(modelos) - 1)
+        tentativas.append(tentativa)
+        if tentativa.indice:
+            logging.info(f"IA: disparando {tentativa.modelo} ({motivo}; {tipo}).")
+            metricas.IA_HEDGE_DISPAROS.labels(motivo=motivo).inc()
+        proximo_disparo = tentativa.inicio + obter_latencia(tentativa.modelo, tipo).limiar()
+        threading.Thread(target=_executar, args=(tentar, tentativa, fila), daemon=True,
+                         name=f"ia-{tentativa.indice}").start()
+
+    disparar("principal")
+    try:
+        while True:
+            timeout = None
+            if vencedora is None and len(tentativas) < len(modelos):
+                em_andamento = len(tentativas) - len(erros)
+                if em_andamento < IA_HEDGE_PARALELAS:
+                    timeout = max(0.0, proximo_disparo - time.monotonic())
+            try:
+                tentativa, evento, valor = fila.get(timeout=timeout)
+            except queue.Empty:
+                disparar("limiar")
+                continue
+            if vencedora is None:
+                if evento == _ITEM:
+                    vencedora = tentativa
+                    latencia = time.monotonic() - tentativa.inicio
+                    obter_latencia(tentativa.modelo, tipo).registrar(latencia)
+                    metricas.IA_MODELO_LATENCIA.labels(modelo=tentativa.modelo, tipo=tipo).observe(latencia)
+                    for outra in tentativas:
+                        if outra is not tentativa and outra not in erros:
+                            outra.cancelar()
+                            obter_latencia(outra.modelo, tipo).registrar(time.monotonic() - outra.inicio, "canceladas")
+                    if tentativa.indice:
+                        logging.info(f"IA: {tentativa.modelo} respondeu primeiro ({latencia:.1f}s; {tipo}).")
+                    yield valor
+                    continue
+                if evento == _FIM:
+                    valor = ValueError("Resposta da API vazia.")
+                erros[tentativa] = valor
+                obter_latencia(tentativa.modelo, tipo).contar("falhas")
+                if len(tentativas) < len(modelos):
+                    logging.warning(f"IA: {tentativa.modelo} falhou ({valor}).")
+                    disparar("falha")
+                elif len(erros) == len(tentativas):
+                    raise erros[tentativas[0]]
+            elif tentativa is vencedora:
+                if evento == _ITEM:
+                    yield valor
+                elif evento == _FIM:
+                    return
+                else:
+                    raise valor
+            # Mensagens das tentativas canceladas são descartadas
+    finally:
+        for tentativa in tentativas:
+            tentativa.cancelar()
+
+
+# --- Latências do processo (recriadas após fork) ---
+
+_latencias = None
+_latencias_pid = None
+_latencias_lock = threading.Lock()
+
+
+def obter_latencia(modelo: str, tipo: str) -> LatenciaModelo:
+    global _latencias, _latencias_pid
+    pid = os.getpid()
+    with _latencias_lock:
+        if _latencias is None or _latencias_pid != pid:
+            _latencias = {}
+            _latencias_pid = pid
+        latencia = _latencias.get((modelo, tipo))
+        if latencia is None:
+            latencia = _latencias[(modelo, tipo)] = LatenciaModelo()
+    return latencia
+
+
+def estatisticas() -> dict:
+    return {
+        "modelos": AI_MODELS,
+        "paralelas": IA_HEDGE_PARALELAS,
+        "percentil": IA_HEDGE_PERCENTIL,
+        "latencias": {f"{modelo} ({tipo})": obter_latencia(modelo, tipo).estatisticas()
+                      for modelo in AI_MODELS for tipo in ("resposta", "stream")},
+    }
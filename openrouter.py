@@ -0,0 +1,241 @@
+# openrouter.py - Cliente HTTP da OpenRouter: sessão keep-alive, retries com backoff e circuit breaker por modelo
+
+import os
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metricas
+
+# Configuração (via .env / ambiente)
+OPENROUTER_POOL_MAX = int(os.getenv("OPENROUTER_POOL_MAX", "50"))  # conexões keep-alive por processo
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5"))
+OPENROUTER_READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "45"))
+OPENROUTER_RETRIES = int(os.getenv("OPENROUTER_RETRIES", "2"))  # tentativas extras em 429/5xx/erro de conexão
+OPENROUTER_BACKOFF_BASE = float(os.getenv("OPENROUTER_BACKOFF_BASE", "0.5"))
+OPENROUTER_BACKOFF_MAX = float(os.getenv("OPENROUTER_BACKOFF_MAX", "8"))
+OPENROUTER_RETRY_AFTER_MAX = float(os.getenv("OPENROUTER_RETRY_AFTER_MAX", "10"))  # Retry-After maior que isso: desiste
+OPENROUTER_CB_FALHAS = int(os.getenv("OPENROUTER_CB_FALHAS", "5"))  # falhas seguidas para abrir o circuito
+OPENROUTER_CB_PAUSA = float(os.getenv("OPENROUTER_CB_PAUSA", "30"))  # segundos com o circuito aberto
+
+STATUS_RETENTAVEIS = {429, 500, 502, 503, 504}
+
+
+class CircuitoAbertoError(ConnectionError):
+    """A OpenRouter está degradada; chamadas são recusadas sem tentar a rede."""
+
+
+class CircuitBreaker:
+    """
+    Estados: 'fechado' (normal), 'aberto' (recusa tudo por `pausa` segundos) e
+    'meio-aberto' (deixa passar uma única chamada de teste). `nome` (o modelo) só aparece nos logs.
+    """
+
+    def __init__(self, nome: str = "", falhas_para_abrir: int = OPENROUTER_CB_FALHAS, pausa: float = OPENROUTER_CB_PAUSA):
+        self.nome = nome
+        self.falhas_para_abrir = max(1, falhas_para_abrir)
+        self.pausa = pausa
+        self.estado = "fechado"
+        self.falhas_seguidas = 0
+        self.aberto_ate = 0.0
+        self.aberturas = 0
+        self._teste_em_andamento = False
+        self._lock = threading.Lock()
+
+    def permitir(self) -> bool:
+        with self._lock:
+            if self.estado == "fechado":
+                return True
+            if self.estado == "aberto" and time.monotonic() >= self.aberto_ate:
+                self.estado = "meio-aberto"
+                self._teste_em_andamento = False
+            if self.estado == "meio-aberto" and not self._teste_em_andamento:
+                self._teste_em_andamento = True
+                return True
+            return False
+
+    def sucesso(self):
+        with self._lock:
+            if self.estado != "fechado":
+                logging.info(f"Circuit breaker OpenRouter ({self.nome}): fechado (provedor respondeu).")
+            self.estado = "fechado"
+            self.falhas_seguidas = 0
+            self._teste_em_andamento = False
+
+    def falha(self):
+        with self._lock:
+            self.falhas_seguidas += 1
+            if self.estado == "meio-aberto" or self.falhas_seguidas >= self.falhas_para_abrir:
+                if self.estado != "aberto":
+                    self.aberturas += 1
+                    logging.error(f"Circuit breaker OpenRouter ({self.nome}): ABERTO por {self.pausa:.0f}s após {self.falhas_seguidas} falha(s).")
+                self.estado = "aberto"
+                self.aberto_ate = time.monotonic() + self.pausa
+                self._teste_em_andamento = False
+
+
+def _segundos_retry_after(valor: str | None) -> float | None:
+    """Interpreta o cabeçalho Retry-After (segundos ou data HTTP)."""
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        quando = parsedate_to_datetime(valor)
+        if quando.tzinfo is None:
+            quando = quando.replace(tzinfo=timezone.utc)
+        return max(0.0, (quando - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class ClienteOpenRouter:
+    """
+    Cliente reutilizável (um por processo): mantém conexões TLS abertas,
+    repete 429/5xx/erros de conexão com backoff exponencial com jitter
+    (respeitando Retry-After) e corta chamadas enquanto o circuito estiver aberto.
+    Há um circuito por modelo (payload["model"]): um modelo fora do ar não
+    derruba o fallback para os outros de AI_MODELS.
+    """
+
+    def __init__(self, url: str, retries: int = OPENROUTER_RETRIES,
+                 timeout: tuple = (OPENROUTER_CONNECT_TIMEOUT, OPENROUTER_READ_TIMEOUT)):
+        self.url = url
+        self.retries = max(0, retries)
+        self.timeout = timeout
+        self._breakers = {}  # modelo -> CircuitBreaker
+        self.sessao = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=OPENROUTER_POOL_MAX, max_retries=0)
+        self.sessao.mount("https://", adaptador)
+        self.sessao.mount("http://", adaptador)
+        self._lock = threading.Lock()
+        self._stats = {"chamadas": 0, "tentativas": 0, "retries": 0, "falhas": 0, "recusadas_circuito": 0}
+        self._uso = {"respostas_com_uso": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                     "cached_tokens": 0, "respostas_com_cache": 0}
+
+    def _contar(self, chave: str):
+        with self._lock:
+            self._stats[chave] += 1
+
+    def breaker(self, modelo: str) -> CircuitBreaker:
+        """Circuit breaker do modelo, criado no primeiro uso."""
+        with self._lock:
+            breaker = self._breakers.get(modelo)
+            if breaker is None:
+                breaker = self._breakers[modelo] = CircuitBreaker(modelo)
+            return breaker
+
+    def _espera_backoff(self, tentativa: int) -> float:
+        # "Full jitter": uniforme entre 0 e base * 2^tentativa (limitado)
+        return random.uniform(0, min(OPENROUTER_BACKOFF_MAX, OPENROUTER_BACKOFF_BASE * (2 ** tentativa)))
+
+    def enviar(self, payload: dict, headers: dict, stream: bool = False, retries: int | None = None) -> requests.Response:
+        """
+        POST do payload com retries (`retries` substitui o padrão do cliente; 0 =
+        uma tentativa só). Retorna a resposta 2xx (com stream=True o corpo ainda
+        não foi lido). Levanta requests.exceptions.* como o requests.post faria,
+        ou CircuitoAbertoError quando o circuito do modelo está aberto.
+        """
+        self._contar("chamadas")
+        breaker = self.breaker(payload.get("model", ""))
+        retries = self.retries if retries is None else max(0, retries)
+        for tentativa in range(retries + 1):
+            if not breaker.permitir():
+                self._contar("recusadas_circuito")
+                metricas.IA_RESPOSTAS.labels(status="circuito_aberto").inc()
+                raise CircuitoAbertoError(f"IA temporariamente indisponível (circuit breaker aberto: {breaker.nome}).")
+            self._contar("tentativas")
+            espera = None
+            try:
+                response = self.sessao.post(self.url, headers=headers, json=payload, timeout=self.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                breaker.falha()
+                self._contar("falhas")
+                metricas.IA_RESPOSTAS.labels(status="timeout" if isinstance(e, requests.exceptions.Timeout) else "erro_conexao").inc()
+                # Timeout de leitura já custou até 45 s: não repete para não dobrar a espera do usuário
+                if isinstance(e, requests.exceptions.ReadTimeout) or tentativa >= retries:
+                    raise
+                logging.warning(f"OpenRouter erro de conexão ({e.__class__.__name__}), tentativa {tentativa + 1}/{retries + 1}.")
+            else:
+                metricas.IA_RESPOSTAS.labels(status=str(response.status_code)).inc()
+                if response.status_code not in STATUS_RETENTAVEIS:
+                    if response.status_code < 500:
+                        breaker.sucesso()  # 2xx/4xx: o provedor está de pé
+                    response.raise_for_status()
+                    return response
+                breaker.falha()
+                self._contar("falhas")
+                espera = _segundos_retry_after(response.headers.get("Retry-After"))
+                if tentativa >= retries or (espera is not None and espera > OPENROUTER_RETRY_AFTER_MAX):
+                    response.raise_for_status()
+                logging.warning(f"OpenRouter HTTP {response.status_code}, tentativa {tentativa + 1}/{retries + 1}.")
+                response.close()
+            self._contar("retries")
+            metricas.IA_RETRIES.inc()
+            time.sleep(espera if espera is not None else self._espera_backoff(tentativa))
+        raise requests.exceptions.RetryError("Tentativas esgotadas.")  # Não deve chegar aqui
+
+    def registrar_uso(self, usage: dict | None) -> dict:
+        """
+        Normaliza e acumula o `usage` de uma resposta. Tokens de prompt vindos do
+        cache aparecem com nomes diferentes conforme o provedor.
+        Retorna {"prompt_tokens", "completion_tokens", "cached_tokens"}.
+        """
+        if not isinstance(usage, dict):
+            return {}
+        detalhes = usage.get("prompt_tokens_details") or {}
+        cached = (detalhes.get("cached_tokens") or usage.get("prompt_cache_hit_tokens")
+                  or usage.get("cache_read_input_tokens") or 0)
+        uso = {
+            "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+            "completion_tokens": int(usage.get("completion_tokens") or 0),
+            "cached_tokens": int(cached),
+        }
+        with self._lock:
+            self._uso["respostas_com_uso"] += 1
+            self._uso["prompt_tokens"] += uso["prompt_tokens"]
+            self._uso["completion_tokens"] += uso["completion_tokens"]
+            self._uso["cached_tokens"] += uso["cached_tokens"]
+            if uso["cached_tokens"] > 0:
+                self._uso["respostas_com_cache"] += 1
+        for tipo, quantidade in uso.items():
+            metricas.IA_TOKENS.labels(tipo=tipo.replace("_tokens", "")).inc(quantidade)
+        return uso
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["uso"] = dict(self._uso)
+            prompt_total = self._uso["prompt_tokens"]
+            breakers = dict(self._breakers)
+        stats["uso"]["fracao_prompt_cacheado"] = stats["uso"]["cached_tokens"] / prompt_total if prompt_total else 0.0
+        stats["circuitos"] = {modelo: {"estado": breaker.estado, "aberturas": breaker.aberturas,
+                                       "falhas_seguidas": breaker.falhas_seguidas}
+                              for modelo, breaker in breakers.items()}
+        return stats
+
+
+# --- Cliente do processo (a Session não deve ser compartilhada entre forks) ---
+
+_cliente = None
+_cliente_pid = None
+_cliente_lock = threading.Lock()
+
+
+def obter_cliente(url: str) -> ClienteOpenRouter:
+    global _cliente, _cliente_pid
+    pid = os.getpid()
+    if _cliente is None or _cliente_pid != pid or _cliente.url != url:
+        with _cliente_lock:
+            if _cliente is None or _cliente_pid != pid or _cliente.url != url:
+                _cliente = ClienteOpenRouter(url)
+                _cliente_pid = pid
+    return _cliente
@@ -4,8 +4,11 @@ import os
 import psycopg2
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone # Import timezone from datetime
+import time
 import secrets
+import base64
 import logging
+import functools
 
 # Importa pytz se disponível 
 try:
@@ -25,49 +28,270 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+from .pool import obter_pool
+from .pool import fechar_pool as _fechar_pool_postgres
+from . import armazenamento
+from . import cache_tokens
+from . import cache_historico
+from . import resumos
+from . import importacao
+from . import particoes
+from . import esquema
+from . import migracoes
+from . import escrita
+from . import idempotencia
+
+def _conexao():
+    """Empresta uma conexão do pool do processo (use com `with`)."""
+    return obter_pool(DATABASE_URL).conexao()
+
+def _executar_preparado(cur, nome: str, sql: str, params: tuple):
+    """Executa uma query quente como prepared statement na conexão do cursor."""
+    obter_pool(DATABASE_URL).executar_preparado(cur, nome, sql, params)
+
+_fonte_resumos = resumos.FontePostgres(_conexao)
+
+def fechar_pool():
+    """
+    Grava as mensagens ainda na fila de escrita (banco ou spool) e fecha as conexões
+    do processo (pool Postgres ou backend SQLite), ex.: no shutdown do worker.
+    """
+    escrita.encerrar()
+    _fechar_pool_postgres()
+    armazenamento.fechar()
+
+_observador_bd = None  # (nome_funcao, segundos) -> None; ver configurar_metricas
+
+def configurar_metricas(observador):
+    """Registra o callback chamado com a duração de cada função de banco do painel (None desliga)."""
+    global _observador_bd
+    _observador_bd = observador
+
+def _medido(funcao):
+    """Mede a duração da função pública do painel e repassa ao observador de métricas."""
+    @functools.wraps(funcao)
+    def medida(*args, **kwargs):
+        if _observador_bd is None:
+            return funcao(*args, **kwargs)
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args, **kwargs)
+        finally:
+            _observador_bd(funcao.__name__, time.perf_counter() - inicio)
+    return medida
+
+def _com_backend(funcao):
+    """
+    Com DATABASE_URL sqlite://, a função pública passa a ser atendida pelo método
+    de mesmo nome do backend SQLite (ver armazenamento.py). Decidido na importação:
+    com Postgres a função fica como está.
+    """
+    if not armazenamento.usa_sqlite(DATABASE_URL):
+        return funcao
+    nome = funcao.__name__
+    @functools.wraps(funcao)
+    def despachada(*args, **kwargs):
+        return getattr(armazenamento.obter(DATABASE_URL), nome)(*args, **kwargs)
+    return despachada
+
+@_com_backend
+def estatisticas_pool() -> dict:
+    """Estatísticas de uso/espera do pool de conexões deste processo."""
+    if not DATABASE_URL:
+        return {}
+    return obter_pool(DATABASE_URL).estatisticas()
+
+def estatisticas_cache_tokens() -> dict:
+    """Hits/misses do cache de validação de tokens deste processo."""
+    return cache_tokens.estatisticas()
+
+def estatisticas_cache_historico() -> dict:
+    """Hits/misses e memória do cache de histórico de conversas deste processo."""
+    return cache_historico.obter_cache().estatisticas()
+
+def estatisticas_escrita() -> dict:
+    """Fila, lotes gravados e spool da escrita em segundo plano das mensagens deste processo."""
+    return escrita.estatisticas()
+
+def estatisticas_resumidor() -> dict:
+    """Ciclos/resumos gerados pela thread de resumos deste processo."""
+    return resumos.estatisticas()
+
+def configurar_resumidor(funcao_resumir, janela: int):
+    """
+    Liga os resumos contínuos: `funcao_resumir(resumo_anterior, mensagens) -> str`
+    é chamada em segundo plano para condensar as msgs mais antigas que as
+    `janela` mais recentes de cada conversa ativa.
+    """
+    resumos.configurar(funcao_resumir, janela)
+
+def limitar_janela_resumo(user_token: str, msgs_no_prompt: int):
+    """
+    Informa quantas msgs do histórico couberam no prompt deste turno (o resto foi
+    cortado pelo orçamento de tokens): o resumo passa a cobrir as anteriores a elas.
+    """
+    resumos.limitar_janela(user_token, msgs_no_prompt)
+
+@_medido
+@_com_backend
+def obter_resumo_conversa(user_token: str) -> str | None:
+    """Resumo das mensagens antigas da conversa (None se ainda não houver)."""
+    if not DATABASE_URL or not user_token:
+        return None
+    return resumos.obter_resumo(_fonte_resumos, user_token)
+
+def _avisar_token_alterado(cur, token: str):
+    """
+    Dentro da transação do admin: NOTIFY para os outros workers/nós (entregue no commit)
+    e invalidação imediata do cache local.
+    """
+    cur.execute("SELECT pg_notify(%s, %s)", (cache_tokens.CANAL_NOTIFY, token))
+    cache_tokens.obter_cache().invalidar(token)
+
+# Queries do caminho quente do /chat (preparadas uma vez por conexão).
+# As mensagens guardam token_id/role SMALLINT (ver esquema.py); o role sai como texto.
+SQL_VALIDADE_TOKEN = "SELECT validade_em FROM tokens WHERE token = $1"
+SQL_INSERIR_MENSAGEM = """
+    INSERT INTO chat_messages (token_id, role, content)
+    SELECT id, $2::smallint, $3::text FROM tokens WHERE token = $1::text
+    RETURNING id
+"""
+SQL_HISTORICO = f"""
+    SELECT id, {esquema.SQL_ROLE_TEXTO}, content, timestamp FROM (
+        SELECT id, role, content, timestamp
+        FROM chat_messages
+        WHERE token_id = (SELECT id FROM tokens WHERE token = $1::text)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT $2
+    ) AS recent_messages
+    ORDER BY timestamp ASC, id ASC
+"""
+# Escrita em lote (ver escrita.py): cada mensagem leva o timestamp de quando chegou.
+# Mensagens de tokens já excluídos somem no JOIN.
+SQL_INSERIR_MENSAGENS_LOTE = """
+    INSERT INTO chat_messages (token_id, role, content, timestamp)
+    SELECT t.id, m.role, m.content, m.ts
+    FROM unnest($1::text[], $2::smallint[], $3::text[], $4::timestamptz[])
+         WITH ORDINALITY AS m(token, role, content, ts, ordem)
+    JOIN tokens t ON t.token = m.token
+    ORDER BY m.ordem
+"""
+# Token bucket do limite de taxa: repõe as fichas pelo tempo desde a última
+# atualização e tira uma. Sem ficha, o WHERE do upsert não atualiza e não volta linha.
+SQL_CONSUMIR_FICHA = """
+    INSERT INTO limites_taxa AS l (chave, fichas, atualizado_em)
+    VALUES ($1::text, $2::float8 - 1, clock_timestamp())
+    ON CONFLICT (chave) DO UPDATE
+        SET fichas = LEAST($2::float8, l.fichas + EXTRACT(EPOCH FROM clock_timestamp() - l.atualizado_em) * $3::float8) - 1,
+            atualizado_em = clock_timestamp()
+        WHERE LEAST($2::float8, l.fichas + EXTRACT(EPOCH FROM clock_timestamp() - l.atualizado_em) * $3::float8) >= 1
+    RETURNING fichas
+"""
+# Turno de chat em uma ida ao banco: valida o token, insere a msg do usuário e
+# devolve o histórico recente JÁ com ela. O INSERT de um CTE não é visível às
+# outras partes da mesma query, por isso a msg nova entra via UNION ALL.
+SQL_TURNO_CHAT = f"""
+    WITH tok AS (
+        SELECT id FROM tokens WHERE token = $1::text AND validade_em > now()
+    ), nova AS (
+        INSERT INTO chat_messages (token_id, role, content)
+        SELECT id, {esquema.ROLES['user']}, $2::text FROM tok
+        RETURNING id, role, content, timestamp
+    ), anteriores AS (
+        SELECT id, role, content, timestamp
+        FROM chat_messages
+        WHERE token_id = (SELECT id FROM tok)
+        ORDER BY timestamp DESC, id DESC
+        LIMIT GREATEST($3::int - 1, 0)
+    )
+    SELECT id, {esquema.SQL_ROLE_TEXTO}, content, timestamp FROM (
+        SELECT * FROM anteriores
+        UNION ALL
+        SELECT * FROM nova
+    ) AS turno
+    ORDER BY timestamp ASC, id ASC
+"""
+
+# Variante quando a conversa já está no cache de histórico: só valida + insere e
+# conta quantas msgs existem depois do marco do cache ($3/$4). Se a contagem não
+# bater com o que este processo anexou, outro worker escreveu e o cache é recarregado.
+SQL_TURNO_CHAT_CACHE = f"""
+    WITH tok AS (
+        SELECT id FROM tokens WHERE token = $1::text AND validade_em > now()
+    ), nova AS (
+        INSERT INTO chat_messages (token_id, role, content)
+        SELECT id, {esquema.ROLES['user']}, $2::text FROM tok
+        RETURNING id, timestamp
+    )
+    SELECT nova.id, nova.timestamp, (
+        SELECT count(*) FROM chat_messages
+        WHERE token_id = (SELECT id FROM tok) AND timestamp >= $3::timestamptz AND id > $4::int
+    ) FROM nova
+"""
+
+# Reenvio de uma msg já gravada (idempotencia.SQL_MARCAR_MENSAGEM): só valida o token antes de reler o histórico
+SQL_TOKEN_VALIDO = "SELECT 1 FROM tokens WHERE token = $1::text AND validade_em > now()"
+
 # --- Funções de Tokens ---
 
-def criar_tabela_tokens():
-    """Cria a tabela de tokens de acesso (nova estrutura com nome e telefone), se não existir."""
-    # Código completo da sua versão que funcionava
+@_com_backend
+def migrar_esquema() -> list[int] | None:
+    """
+    Aplica as migrações pendentes (ver migracoes.py). Para deploy/linha de
+    comando (`python -m painel migrate`), não para a importação do app.
+    Retorna as versões aplicadas ou None em caso de erro.
+    """
     if not DATABASE_URL:
-        logging.error("DATABASE_URL não definida. Impossível criar tabela 'tokens'.")
-        return
-    conn = None
+        logging.error("DATABASE_URL não definida. Impossível migrar o esquema.")
+        return None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS tokens (
-                    id SERIAL PRIMARY KEY,                  
-                    nome TEXT NOT NULL,                     
-                    telefone TEXT NOT NULL UNIQUE,          
-                    token TEXT NOT NULL UNIQUE,             
-                    criado_em TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, 
-                    validade_em TIMESTAMP WITH TIME ZONE      
-                );
-            """)
-            cur.execute(""" CREATE INDEX IF NOT EXISTS idx_tokens_token ON tokens (token); """)
-            cur.execute(""" CREATE INDEX IF NOT EXISTS idx_tokens_telefone ON tokens (telefone); """) 
-        conn.commit()
-        logging.info("Tabela 'tokens' verificada/criada com sucesso (nova estrutura).")
+        with _conexao() as conn:
+            aplicadas = migracoes.migrar(conn)
+        logging.info(f"Esquema na versão {migracoes.VERSAO_ATUAL} ({len(aplicadas)} migração(ões) aplicada(s)).")
+        return aplicadas
     except psycopg2.Error as e:
-        logging.exception(f"Erro BD criar/verificar 'tokens': {e.pgcode} - {e.pgerror}")
-        if conn:
-            conn.rollback()
+        logging.exception(f"Erro BD migrar esquema: {e.pgcode} - {e.pgerror}")
+        return None
     except Exception as e:
-        logging.exception("Erro inesperado criar/verificar 'tokens'")
-        if conn:
+        logging.exception("Erro inesperado migrar esquema")
+        return None
+
+@_com_backend
+def verificar_esquema() -> bool:
+    """
+    Checagem barata para a subida dos workers: uma consulta à versão do esquema.
+    Retorna True se o banco estiver na versão que este código espera.
+    """
+    if not DATABASE_URL:
+        logging.error("DATABASE_URL não definida. Impossível verificar o esquema.")
+        return False
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                versao = migracoes.versao_banco(cur)
             conn.rollback()
-    finally:
-        if conn:
-            conn.close()
+    except psycopg2.Error as e:
+        logging.exception(f"Erro BD verificar esquema: {e.pgcode} - {e.pgerror}")
+        return False
+    if versao < migracoes.VERSAO_ATUAL:
+        logging.error(f"Esquema do banco na versão {versao}, o app espera {migracoes.VERSAO_ATUAL}. "
+                      f"Rode 'python -m painel migrate'.")
+        return False
+    if versao > migracoes.VERSAO_ATUAL:
+        logging.warning(f"Esquema do banco ({versao}) mais novo que o app ({migracoes.VERSAO_ATUAL}).")
+    return True
+
+def criar_tabela_tokens():
+    """Mantida por compatibilidade: aplica as migrações pendentes (ver migrar_esquema)."""
+    migrar_esquema()
 
 def gerar_token():
     """Gera um token seguro."""
     # Código completo da sua versão que funcionava
     return secrets.token_urlsafe(16)
 
+@_medido
+@_com_backend
 def inserir_token(nome: str, telefone: str, dias_validade: int) -> str | None:
     """
     Insere um novo token associado a um nome e telefone único.
@@ -81,39 +305,33 @@ def inserir_token(nome: str, telefone: str, dias_validade: int) -> str | None:
     if not nome or not telefone:
         logging.warning("Tentativa token nome/tel vazio.")
         return None
-    conn = None
     token_novo = gerar_token()
     agora_utc = datetime.now(timezone.utc)
     validade_utc = agora_utc + timedelta(days=int(dias_validade))
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute(
-                """ INSERT INTO tokens (nome, telefone, token, criado_em, validade_em) VALUES (%s, %s, %s, %s, %s) """,
-                (nome, telefone, token_novo, agora_utc, validade_utc)
-            )
-        conn.commit()
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """ INSERT INTO tokens (nome, telefone, token, criado_em, validade_em) VALUES (%s, %s, %s, %s, %s) """,
+                    (nome, telefone, token_novo, agora_utc, validade_utc)
+                )
+                # Derruba um eventual "não existe" em cache para este token
+                _avisar_token_alterado(cur, token_novo)
+            conn.commit()
         logging.info(f"Token inserido: Nome='{nome}', Tel='***{telefone[-4:]}', T='{token_novo[:8]}...'")
         return token_novo
     except psycopg2.errors.UniqueViolation as e:
         logging.warning(f"Tel duplicado: '***{telefone[-4:]}' ('{nome}'). {e}")
-        if conn:
-            conn.rollback()
         return None 
     except psycopg2.Error as e:
         logging.exception(f"Erro BD inserir token N='{nome}', T='***{telefone[-4:]}': {e.pgcode} - {e.pgerror}")
-        if conn:
-            conn.rollback()
         return None 
     except Exception as e:
         logging.exception(f"Erro inesperado inserir token N='{nome}', T='***{telefone[-4:]}'")
-        if conn:
-            conn.rollback()
         return None 
-    finally:
-        if conn:
-            conn.close()
 
+@_medido
+@_com_backend
 def listar_tokens() -> list[tuple[str, str, str, str | None, str | None]]:
     """
     Lista todos os tokens do banco, retornando nome, telefone, token e datas formatadas.
@@ -123,23 +341,19 @@ def listar_tokens() -> list[tuple[str, str, str, str | None, str | None]]:
     if not DATABASE_URL:
         logging.error("DB URL não definida...")
         return []
-    conn = None
     tokens_raw = []
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute(" SELECT nome, telefone, token, criado_em, validade_em FROM tokens ORDER BY criado_em DESC ")
-            tokens_raw = cur.fetchall()
-            logging.info(f"Listados {len(tokens_raw)} tokens raw.")
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(" SELECT nome, telefone, token, criado_em, validade_em FROM tokens ORDER BY criado_em DESC ")
+                tokens_raw = cur.fetchall()
+                logging.info(f"Listados {len(tokens_raw)} tokens raw.")
     except psycopg2.Error as e:
         logging.exception(f"Erro BD listar tokens: {e.pgcode} - {e.pgerror}")
         return []
     except Exception as e:
         logging.exception("Erro inesperado listar tokens")
         return []
-    finally:
-        if conn:
-            conn.close()
 
     tokens_formatados = []
     fuso_brasil = None
@@ -161,20 +375,205 @@ def listar_tokens() -> list[tuple[str, str, str, str | None, str | None]]:
     logging.info(f"Retornando {len(tokens_formatados)} tokens formatados.")
     return tokens_formatados
 
+# Listagem paginada do painel: filtros e formatação de datas ficam no banco.
+# Paginação por chave (keyset) em (criado_em, id): o custo de cada página não
+# cresce com a posição, ao contrário de OFFSET.
+FUSO_PAINEL = "America/Sao_Paulo"
+STATUS_FILTROS = {
+    "ativos": "validade_em > now()",
+    "expirados": "(validade_em IS NULL OR validade_em <= now())",
+}
+
+def _escapar_like(texto: str) -> str:
+    return texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _codificar_cursor(criado_em: datetime, id_token: int) -> str:
+    bruto = f"{criado_em.isoformat()}|{id_token}"
+    return base64.urlsafe_b64encode(bruto.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decodificar_cursor(cursor: str) -> tuple[datetime, int] | None:
+    try:
+        bruto = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        criado_str, id_str = bruto.rsplit("|", 1)
+        return datetime.fromisoformat(criado_str), int(id_str)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def _filtros_tokens(busca: str | None, status: str | None) -> tuple[list, dict]:
+    """Condições SQL (e parâmetros nomeados) da busca/status do painel."""
+    condicoes, params = [], {}
+    if busca and busca.strip():
+        termo = _escapar_like(busca.strip())
+        condicoes.append("(nome ILIKE %(contem)s OR telefone LIKE %(prefixo)s OR token LIKE %(prefixo)s)")
+        params["contem"] = f"%{termo}%"
+        params["prefixo"] = f"{termo}%"
+    if status in STATUS_FILTROS:
+        condicoes.append(STATUS_FILTROS[status])
+    return condicoes, params
+
+@_medido
+@_com_backend
+def listar_tokens_pagina(busca: str | None = None, status: str | None = None,
+                         cursor: str | None = None, limite: int = 50) -> tuple[list, str | None]:
+    """
+    Uma página da lista de tokens, mais recentes primeiro.
+    `busca` casa com parte do nome ou com o início do telefone/token; `status` é
+    'ativos', 'expirados' ou None (todos); `cursor` é o valor devolvido pela página anterior.
+    Retorna ([(nome, telefone, token, criado_em_str, validade_em_str, ativo), ...], proximo_cursor | None).
+    """
+    if not DATABASE_URL:
+        logging.error("DB URL não definida...")
+        return [], None
+    limite = max(1, min(int(limite), 500))
+    condicoes, params = _filtros_tokens(busca, status)
+    params.update(fuso=FUSO_PAINEL, limite=limite + 1)
+    if cursor:
+        posicao = _decodificar_cursor(cursor)
+        if posicao is None:
+            logging.warning("Cursor de paginação inválido; voltando à primeira página.")
+        else:
+            condicoes.append("(criado_em, id) < (%(cursor_criado)s, %(cursor_id)s)")
+            params["cursor_criado"], params["cursor_id"] = posicao
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+    sql = f"""
+        SELECT nome, telefone, token,
+               to_char(criado_em AT TIME ZONE %(fuso)s, 'YYYY-MM-DD HH24:MI:SS'),
+               to_char(validade_em AT TIME ZONE %(fuso)s, 'YYYY-MM-DD HH24:MI:SS'),
+               COALESCE(validade_em > now(), false),
+               criado_em, id
+        FROM tokens
+        {where}
+        ORDER BY criado_em DESC, id DESC
+        LIMIT %(limite)s
+    """
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                linhas = cur.fetchall()
+            conn.rollback()
+    except psycopg2.Error as e:
+        logging.exception(f"Erro BD listar página de tokens: {e.pgcode} - {e.pgerror}")
+        return [], None
+    except Exception as e:
+        logging.exception("Erro inesperado listar página de tokens")
+        return [], None
+
+    proximo = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        ultima = linhas[-1]
+        if ultima[6] is not None:
+            proximo = _codificar_cursor(ultima[6], ultima[7])
+    return [linha[:6] for linha in linhas], proximo
+
+# --- Operações em lote do painel ---
+
+# Uma instrução por operação sobre todos os tokens que casam com o filtro do painel
+SQL_LOTE = {
+    "estender": "UPDATE tokens SET validade_em = now() + make_interval(days => %(dias)s) {where} RETURNING token",
+    "expirar": "UPDATE tokens SET validade_em = now() {where} RETURNING token",
+    "excluir": "DELETE FROM tokens {where} RETURNING token",  # msgs e resumos vão junto (ON DELETE CASCADE)
+}
+
+@_medido
+@_com_backend
+def importar_tokens_lote(arquivo, formato: str = "csv", dias_validade: int = 7, progresso=None) -> dict | None:
+    """
+    Importa tokens de um arquivo CSV/NDJSON (binário) numa única transação:
+    COPY para staging + um INSERT em conjunto. Telefones já cadastrados ou
+    repetidos não derrubam a importação, aparecem no relatório.
+    `progresso(etapa, linhas)` é chamado a cada bloco copiado.
+    Retorna o relatório de importacao.importar() ou None em caso de erro.
+    """
+    if not DATABASE_URL:
+        logging.error("DATABASE_URL não definida...")
+        return None
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                relatorio = importacao.importar(cur, arquivo, formato, int(dias_validade), progresso)
+                if relatorio["inseridos"]:
+                    cur.execute("SELECT pg_notify(%s, '*')", (cache_tokens.CANAL_NOTIFY,))
+            conn.commit()
+        cache_tokens.obter_cache().limpar()
+        return relatorio
+    except psycopg2.Error as e:
+        logging.exception(f"Erro BD importar tokens: {e.pgcode} - {e.pgerror}")
+        return None
+    except Exception as e:
+        logging.exception("Erro inesperado importar tokens")
+        return None
+
+@_medido
+@_com_backend
+def alterar_tokens_lote(operacao: str, busca: str | None = None, status: str | None = None,
+                        dias: int | None = None) -> int | None:
+    """
+    Aplica `operacao` ('estender' dias a partir de agora, 'expirar' ou 'excluir')
+    a todos os tokens que casam com a busca/status do painel, numa instrução só.
+    Retorna quantos tokens foram afetados, ou None em caso de erro.
+    """
+    if not DATABASE_URL:
+        logging.error("DATABASE_URL não definida...")
+        return None
+    if operacao not in SQL_LOTE:
+        logging.warning(f"Operação em lote desconhecida: {operacao}")
+        return None
+    condicoes, params = _filtros_tokens(busca, status)
+    if operacao == "estender":
+        try:
+            params["dias"] = int(dias)
+        except (TypeError, ValueError):
+            params["dias"] = 0
+        if params["dias"] <= 0:
+            logging.warning(f"Dias inválidos ({dias}) p/ estender em lote.")
+            return None
+    elif operacao == "expirar":
+        condicoes.append("(validade_em IS NULL OR validade_em > now())")
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SQL_LOTE[operacao].format(where=where), params)
+                afetados = [linha[0] for linha in cur.fetchall()]
+                if afetados:
+                    cur.execute("SELECT pg_notify(%s, '*')", (cache_tokens.CANAL_NOTIFY,))
+            conn.commit()
+        if afetados:
+            cache_tokens.obter_cache().limpar()
+            if operacao == "excluir":
+                historico = cache_historico.obter_cache()
+                for token in afetados:
+                    historico.invalidar(token)
+        logging.info(f"Operação em lote '{operacao}': {len(afetados)} token(s) (busca={bool(busca)}, status={status}).")
+        return len(afetados)
+    except psycopg2.Error as e:
+        logging.exception(f"Erro BD operação em lote '{operacao}': {e.pgcode} - {e.pgerror}")
+        return None
+    except Exception as e:
+        logging.exception(f"Erro inesperado operação em lote '{operacao}'")
+        return None
+
+@_medido
+@_com_backend
 def excluir_token(token: str) -> bool:
     """Exclui um token específico do banco."""
     # Código completo da sua versão que funcionava
     if not DATABASE_URL or not token:
         logging.error("DB URL/token ausente.")
         return False
-    conn = None
     rows_deleted = 0
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute("DELETE FROM tokens WHERE token = %s", (token,))
-            rows_deleted = cur.rowcount
-        conn.commit()
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM tokens WHERE token = %s", (token,))
+                rows_deleted = cur.rowcount
+                # chat_messages e chat_resumos: ON DELETE CASCADE
+                if rows_deleted > 0:
+                    _avisar_token_alterado(cur, token)
+            conn.commit()
+        cache_historico.obter_cache().invalidar(token)
         if rows_deleted > 0:
             logging.info(f"Token excluído: {token[:8]}...")
             return True
@@ -183,18 +582,13 @@ def excluir_token(token: str) -> bool:
             return False
     except psycopg2.Error as e:
         logging.exception(f"Erro BD excluir token {token[:8]}: {e.pgcode} - {e.pgerror}")
-        if conn:
-            conn.rollback()
         return False
     except Exception as e:
         logging.exception(f"Erro inesperado excluir token: {token[:8]}...")
-        if conn:
-            conn.rollback()
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@_medido
+@_com_backend
 def verificar_token_valido(token_a_verificar: str) -> bool:
     """
     Verifica se um token existe no banco de dados e se ainda está dentro do prazo de validade.
@@ -207,12 +601,19 @@ def verificar_token_valido(token_a_verificar: str) -> bool:
     if not token_a_verificar:
         logging.warning("Tentativa verificar token vazio.")
         return False
-    conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute(" SELECT validade_em FROM tokens WHERE token = %s ", (token_a_verificar,))
-            resultado = cur.fetchone()
+        cache = cache_tokens.obter_cache(DATABASE_URL)
+        em_cache, validade_cache = cache.obter(token_a_verificar)
+        if em_cache:
+            resultado = None if validade_cache is None else (validade_cache,)
+        else:
+            versao = cache.versao()
+            with _conexao() as conn:
+                with conn.cursor() as cur:
+                    _executar_preparado(cur, "validade_token", SQL_VALIDADE_TOKEN, (token_a_verificar,))
+                    resultado = cur.fetchone()
+                conn.rollback()  # Só leitura: encerra a transação antes de devolver ao pool
+            cache.guardar(token_a_verificar, resultado[0] if resultado else None, existe=resultado is not None, versao=versao)
         if resultado is None:
             logging.info(f"Token não encontrado: {token_a_verificar[:8]}...")
             return False
@@ -233,11 +634,10 @@ def verificar_token_valido(token_a_verificar: str) -> bool:
     except Exception as e:
         logging.exception(f"Erro inesperado verificar token {token_a_verificar[:8]}")
         return False
-    finally:
-        if conn:
-            conn.close()
 
 # --- Função atualizar_validade_token (Passo 3.1 - Mantida aqui para referência, mas pode remover se não quiser a funcionalidade agora) ---
+@_medido
+@_com_backend
 def atualizar_validade_token(token_a_atualizar: str, dias_a_adicionar: int) -> bool:
     """
     Atualiza a data de validade de um token existente, adicionando dias a partir de AGORA.
@@ -250,35 +650,33 @@ def atualizar_validade_token(token_a_atualizar: str, dias_a_adicionar: int) -> b
         dias_int = int(dias_a_adicionar);
         if dias_int <= 0: logging.warning(f"Dias <= 0 ({dias_int}) p/ token {token_a_atualizar[:8]}"); return False
     except (ValueError, TypeError): logging.warning(f"Dias inválidos ({dias_a_adicionar}) p/ token {token_a_atualizar[:8]}"); return False
-    conn = None
     try:
         agora_utc = datetime.now(timezone.utc); nova_validade_utc = agora_utc + timedelta(days=dias_int)
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute(""" UPDATE tokens SET validade_em = %s WHERE token = %s """, (nova_validade_utc, token_a_atualizar))
-            rowcount = cur.rowcount 
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(""" UPDATE tokens SET validade_em = %s WHERE token = %s """, (nova_validade_utc, token_a_atualizar))
+                rowcount = cur.rowcount 
+                if rowcount > 0:
+                    _avisar_token_alterado(cur, token_a_atualizar)
+            if rowcount > 0:
+                conn.commit()
         if rowcount > 0:
-            conn.commit(); logging.info(f"Validade token {token_a_atualizar[:8]} atualizada p/ {nova_validade_utc} ({rowcount} linha(s)).")
+            logging.info(f"Validade token {token_a_atualizar[:8]} atualizada p/ {nova_validade_utc} ({rowcount} linha(s)).")
             return True
         else: logging.warning(f"Token {token_a_atualizar[:8]} não encontrado p/ att validade."); return False
     except psycopg2.Error as e: 
         logging.exception(f"Erro BD att validade token {token_a_atualizar[:8]}: {e.pgcode} - {e.pgerror}");
-        if conn: 
-            conn.rollback() 
         return False
     except Exception as e: 
         logging.exception(f"Erro inesperado att validade token {token_a_atualizar[:8]}");
-        if conn: 
-            conn.rollback() 
         return False
-    finally:
-        if conn: 
-            conn.close()
 
 
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 # 👇👇👇 NOVA FUNÇÃO ADICIONADA (Solução Re-acesso) 👇👇👇
 # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+@_medido
+@_com_backend
 def buscar_token_ativo_por_telefone(telefone_a_buscar: str) -> str | None:
     """
     Busca no banco se existe um token ATIVO associado a um número de telefone.
@@ -292,18 +690,18 @@ def buscar_token_ativo_por_telefone(telefone_a_buscar: str) -> str | None:
         logging.warning("Tentativa de buscar token com telefone vazio.")
         return None
 
-    conn = None
     resultados = []
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT token, validade_em FROM tokens WHERE telefone = %s
-                """,
-                (telefone_a_buscar,)
-            )
-            resultados = cur.fetchall() 
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT token, validade_em FROM tokens WHERE telefone = %s
+                    """,
+                    (telefone_a_buscar,)
+                )
+                resultados = cur.fetchall() 
+            conn.rollback()
 
         if not resultados:
             logging.info(f"Nenhum token encontrado para o telefone ***{telefone_a_buscar[-4:]}")
@@ -333,9 +731,6 @@ def buscar_token_ativo_por_telefone(telefone_a_buscar: str) -> str | None:
     except Exception as e:
         logging.exception(f"Erro inesperado ao buscar token por telefone ***{telefone_a_buscar[-4:]}")
         return None 
-    finally:
-        if conn and not conn.closed: 
-            conn.close()
 
 # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 # 👆👆👆 NOVA FUNÇÃO ADICIONADA (Solução Re-acesso) 👆👆👆
@@ -344,94 +739,289 @@ def buscar_token_ativo_por_telefone(telefone_a_buscar: str) -> str | None:
 
 # --- Funções de Chat History (Código Completo Incluído) ---
 
+@_medido
+@_com_backend
+def consumir_ficha_taxa(chave: str, capacidade: float, por_segundo: float) -> bool:
+    """
+    Limite de taxa compartilhado por todos os workers/nós: tira uma ficha do balde
+    `chave` (até `capacidade` fichas, repostas a `por_segundo`). False = sem ficha.
+    Em erro de banco deixa passar: o limite não pode derrubar o chat.
+    """
+    if not DATABASE_URL or not chave:
+        return True
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                _executar_preparado(cur, "consumir_ficha", SQL_CONSUMIR_FICHA, (chave, capacidade, por_segundo))
+                linha = cur.fetchone()
+            conn.commit()
+        return linha is not None
+    except psycopg2.Error as e:
+        logging.warning(f"Erro BD limite de taxa ({chave[:13]}): {e.pgcode} - {e.pgerror}. Deixando passar.")
+        return True
+    except Exception as e:
+        logging.exception(f"Erro inesperado limite de taxa ({chave[:13]}). Deixando passar.")
+        return True
+
+@_medido
+@_com_backend
+def reservar_idempotencia(user_token: str, chave: str) -> tuple[str, str | None]:
+    """
+    Reserva a chave de idempotência da mensagem (ver idempotencia.py). Retorna
+    ('nova', None) se esta requisição deve processá-la, ('concluida', resposta)
+    se ela já foi respondida ou ('andamento', None) se outra requisição a está
+    processando. Em erro de BD segue como 'nova' (sem deduplicação).
+    """
+    if not DATABASE_URL or not user_token or not chave:
+        return "nova", None
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                _executar_preparado(cur, "reservar_idempotencia", idempotencia.SQL_RESERVAR,
+                                    (user_token, chave, idempotencia.IDEMPOTENCIA_ABANDONO))
+                token_existe, reservou, resposta = cur.fetchone()
+            conn.commit()
+        return idempotencia.estado(token_existe, reservou, resposta), resposta
+    except psycopg2.Error as e:
+        logging.warning(f"Erro BD reservar chave de idempotência T:{user_token[:8]}: {e.pgcode} - {e.pgerror}")
+        return "nova", None
+    except Exception as e:
+        logging.exception(f"Erro inesperado reservar chave de idempotência T:{user_token[:8]}")
+        return "nova", None
+
+@_medido
+@_com_backend
+def concluir_idempotencia(user_token: str, chave: str, resposta: str) -> bool:
+    """Guarda a resposta junto da chave reservada; os reenvios passam a recebê-la."""
+    if not DATABASE_URL or not user_token or not chave:
+        return False
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                _executar_preparado(cur, "concluir_idempotencia", idempotencia.SQL_CONCLUIR, (user_token, chave, resposta))
+                atualizadas = cur.rowcount
+            conn.commit()
+        return atualizadas > 0
+    except psycopg2.Error as e:
+        logging.warning(f"Erro BD concluir chave de idempotência T:{user_token[:8]}: {e.pgcode} - {e.pgerror}")
+        return False
+    except Exception as e:
+        logging.exception(f"Erro inesperado concluir chave de idempotência T:{user_token[:8]}")
+        return False
+
+@_medido
+@_com_backend
+def liberar_idempotencia(user_token: str, chave: str) -> bool:
+    """
+    Desfaz a reserva de uma requisição que falhou: o próximo reenvio processa a
+    mensagem. Se a msg do usuário já foi gravada, a reserva fica (livre para o
+    reenvio assumir) e a msg não é gravada de novo.
+    """
+    if not DATABASE_URL or not user_token or not chave:
+        return False
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                _executar_preparado(cur, "liberar_idempotencia", idempotencia.SQL_LIBERAR,
+                                    (user_token, chave, idempotencia.IDEMPOTENCIA_ABANDONO))
+                liberadas = cur.rowcount
+            conn.commit()
+        return liberadas > 0
+    except psycopg2.Error as e:
+        logging.warning(f"Erro BD liberar chave de idempotência T:{user_token[:8]}: {e.pgcode} - {e.pgerror}")
+        return False
+    except Exception as e:
+        logging.exception(f"Erro inesperado liberar chave de idempotência T:{user_token[:8]}")
+        return False
+
 def criar_tabela_chat_history():
-    """Cria a tabela para armazenar o histórico de chat, se não existir."""
-    # Código completo da sua versão que funcionava
-    if not DATABASE_URL: 
-        logging.error("DATABASE_URL não definida. Impossível criar tabela 'chat_messages'.")
-        return
-    conn = None
+    """Mantida por compatibilidade: aplica as migrações pendentes (ver migrar_esquema)."""
+    migrar_esquema()
+
+@_com_backend
+def manter_particoes_chat() -> dict | None:
+    """
+    Manutenção periódica de 'chat_messages': cria as partições dos próximos meses
+    e aplica a retenção (desanexa, arquiva em .csv.gz e apaga as partições velhas).
+    Também apaga as chaves de idempotência vencidas.
+    Retorna {"desanexadas", "arquivadas", "apagadas", "chaves_expiradas"} ou None em caso de erro.
+    """
+    if not DATABASE_URL:
+        logging.error("DATABASE_URL não definida. Impossível manter partições de 'chat_messages'.")
+        return None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS chat_messages (
-                    id SERIAL PRIMARY KEY, 
-                    user_token TEXT NOT NULL, 
-                    role TEXT NOT NULL CHECK (role IN ('user', 'assistant')), 
-                    content TEXT NOT NULL, 
-                    timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            cur.execute("""
-                CREATE INDEX IF NOT EXISTS idx_chat_msgs_user_token_ts
-                ON chat_messages (user_token, timestamp DESC);
-            """)
-        conn.commit()
-        logging.info("Tabela 'chat_messages' verificada/criada com sucesso.")
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                particoes.garantir_estrutura(cur)
+                expiradas = idempotencia.expurgar(cur)
+            conn.commit()
+            resultado = particoes.aplicar_retencao(conn)
+            resultado["chaves_expiradas"] = expiradas
+            return resultado
     except psycopg2.Error as e:
-        logging.exception(f"Erro BD criar/verificar 'chat_messages': {e.pgcode} - {e.pgerror}")
-        if conn: conn.rollback()
+        logging.exception(f"Erro BD manter partições 'chat_messages': {e.pgcode} - {e.pgerror}")
+        return None
     except Exception as e:
-        logging.exception("Erro inesperado criar/verificar 'chat_messages'")
-        if conn: conn.rollback()
-    finally:
-        if conn: conn.close()
+        logging.exception("Erro inesperado manter partições 'chat_messages'")
+        return None
 
+def _gravar_lote_mensagens(lote: list):
+    """Grava [(token, role, content, timestamp)] num único INSERT; chamada pela thread de escrita."""
+    tokens, roles, conteudos, momentos = zip(*lote)
+    with _conexao() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL statement_timeout = %s", (int(escrita.ESCRITA_TIMEOUT * 1000),))
+            _executar_preparado(cur, "inserir_mensagens_lote", SQL_INSERIR_MENSAGENS_LOTE,
+                                (list(tokens), [esquema.ROLES[r] for r in roles], list(conteudos), list(momentos)))
+            gravadas = cur.rowcount
+        conn.commit()
+    if gravadas < len(lote):
+        logging.warning(f"Lote de msgs: {len(lote) - gravadas} de {len(lote)} descartada(s) (token inexistente).")
+    logging.debug("Lote de msgs salvo BD: %d msgs", gravadas)
+
+@_medido
+@_com_backend
 def add_chat_message(user_token: str, role: str, content: str) -> bool:
-    """Adiciona uma mensagem (user ou assistant) ao histórico no banco."""
+    """
+    Adiciona uma mensagem (user ou assistant) ao histórico. Com ESCRITA_ASSINCRONA
+    (padrão) só enfileira para a gravação em lote (ver escrita.py) e retorna True;
+    um token inexistente é descartado depois, na gravação.
+    """
     # Código completo da sua versão que funcionava
     if not DATABASE_URL or not user_token or role not in ('user', 'assistant') or content is None: 
         logging.warning(f"Tentativa msg chat inválida. T:{user_token[:8] if user_token else 'N/A'} R:{role} C:{content is None}")
         return False
-    conn = None
+    if escrita.ESCRITA_ASSINCRONA:
+        escrita.obter_escritor(_gravar_lote_mensagens).enfileirar(user_token, role, content)
+        cache_historico.obter_cache().anexar(user_token, None, role, content)  # write-through
+        return True
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute(
-                """INSERT INTO chat_messages (user_token, role, content) VALUES (%s, %s, %s)""", 
-                (user_token, role, content)
-            )
-        conn.commit()
-        logging.info(f"Msg salva BD: T:{user_token[:8]} R:{role} C:{len(content)} bytes")
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                _executar_preparado(cur, "inserir_mensagem", SQL_INSERIR_MENSAGEM, (user_token, esquema.ROLES[role], content))
+                linha = cur.fetchone()
+            conn.commit()
+        if linha is None:
+            logging.warning(f"Msg não salva: token inexistente T:{user_token[:8]} R:{role}")
+            return False
+        id_msg = linha[0]
+        cache_historico.obter_cache().anexar(user_token, id_msg, role, content)  # write-through
+        logging.debug("Msg salva BD: T:%s R:%s C:%d bytes", user_token[:8], role, len(content))
         return True
     except psycopg2.Error as e:
         logging.exception(f"Erro BD salvar msg T:{user_token[:8]} R:{role}: {e.pgcode} - {e.pgerror}")
-        if conn: conn.rollback()
         return False
     except Exception as e:
         logging.exception(f"Erro inesperado salvar msg T:{user_token[:8]} R:{role}")
-        if conn: conn.rollback()
         return False
-    finally:
-        if conn: conn.close()
 
+def _ler_historico_bd(cur, user_token: str, limit: int) -> list:
+    """Lê do banco e recarrega o cache; retorna [(id, role, content, timestamp)] em ordem cronológica."""
+    cache = cache_historico.obter_cache()
+    n = max(limit, cache.msgs_por_conversa) if cache.cabe(limit) else limit
+    _executar_preparado(cur, "historico_chat", SQL_HISTORICO, (user_token, n))
+    linhas = cur.fetchall()
+    if cache.cabe(limit):
+        cache.carregar(user_token, linhas, completo=len(linhas) < n)
+    return linhas[-limit:] if limit > 0 else []
+
+@_medido
+@_com_backend
 def get_chat_history(user_token: str, limit: int = 20) -> list:
     """Busca as últimas 'limit' mensagens (pares user/assistant) para um token."""
     # Código completo da sua versão que funcionava
     if not DATABASE_URL or not user_token: return []
-    conn = None
+    history = cache_historico.obter_cache().obter(user_token, limit)
+    if history is not None:
+        logging.debug(f"Histórico do cache T:{user_token[:8]}: {len(history)}/{limit} msgs")
+        return history
+    escrita.aguardar_token(user_token)  # Msgs ainda na fila de escrita precisam estar no banco
     history = []
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT role, content FROM (
-                    SELECT role, content, timestamp 
-                    FROM chat_messages 
-                    WHERE user_token = %s 
-                    ORDER BY timestamp DESC 
-                    LIMIT %s
-                ) AS recent_messages 
-                ORDER BY timestamp ASC;
-            """, (user_token, limit))
-            results = cur.fetchall()
-        history = [{"role": row[0], "content": row[1]} for row in results]
-        logging.info(f"Histórico lido BD T:{user_token[:8]}: {len(history)}/{limit} msgs")
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                results = _ler_historico_bd(cur, user_token, limit)
+            conn.rollback()
+        history = [{"role": row[1], "content": row[2]} for row in results]
+        logging.debug("Histórico lido BD T:%s: %d/%d msgs", user_token[:8], len(history), limit)
     except psycopg2.Error as e:
         logging.exception(f"Erro BD buscar hist T:{user_token[:8]}: {e.pgcode} - {e.pgerror}")
     except Exception as e:
         logging.exception(f"Erro inesperado buscar hist T:{user_token[:8]}")
-    finally:
-        if conn: conn.close()
-    return history
\ No newline at end of file
+    return history
+
+@_medido
+@_com_backend
+def registrar_turno_chat(user_token: str, content: str, limit: int = 20,
+                         chave_idempotencia: str | None = None) -> list | None:
+    """
+    Valida o token, salva a mensagem do usuário e retorna as últimas 'limit'
+    mensagens (incluindo a nova) numa única instrução SQL / transação.
+    Com `chave_idempotencia` reservada, a chave é marcada na mesma transação; se
+    uma tentativa anterior com a chave já gravou a msg, só relê o histórico.
+    Retorna None se o token for inválido/expirado (nada é gravado) ou em erro de BD.
+    """
+    if not DATABASE_URL or not user_token or content is None:
+        logging.warning(f"Tentativa turno chat inválido. T:{user_token[:8] if user_token else 'N/A'} C:{content is None}")
+        return None
+    escrita.aguardar_token(user_token)  # A resposta anterior pode estar na fila de escrita
+    cache = cache_historico.obter_cache()
+    marco = cache.marco(user_token) if cache.cabe(limit) else None
+    try:
+        with _conexao() as conn:
+            with conn.cursor() as cur:
+                ja_gravada = False
+                if chave_idempotencia:
+                    _executar_preparado(cur, "marcar_mensagem_idempotencia", idempotencia.SQL_MARCAR_MENSAGEM,
+                                        (user_token, chave_idempotencia))
+                    linha = cur.fetchone()
+                    ja_gravada = bool(linha and linha[0])
+                if ja_gravada:
+                    # Reenvio depois de uma falha: a msg já está no banco, não grava de novo
+                    logging.info(f"Turno chat: msg já gravada por uma tentativa anterior T:{user_token[:8]}...")
+                    _executar_preparado(cur, "token_valido", SQL_TOKEN_VALIDO, (user_token,))
+                    results = None
+                    if cur.fetchone() is not None:
+                        linhas = _ler_historico_bd(cur, user_token, limit)
+                        results = [{"role": r[1], "content": r[2]} for r in linhas] if linhas else None
+                        momento = max(linhas)[3] if linhas else None
+                elif marco is not None:
+                    # Conversa em cache: valida + insere + teste de frescor, sem ler o histórico
+                    base_id, base_ts, anexadas = marco
+                    _executar_preparado(cur, "turno_chat_cache", SQL_TURNO_CHAT_CACHE, (user_token, content, base_ts, base_id))
+                    linha = cur.fetchone()
+                    results = None
+                    if linha is not None:
+                        id_msg, momento, depois_do_marco = linha
+                        if depois_do_marco == anexadas:
+                            cache.anexar(user_token, id_msg, 'user', content)
+                            results = cache.obter(user_token, limit)
+                        if results is None:
+                            # Outro worker gravou nesta conversa (ou o cache foi evictado): relê
+                            logging.debug(f"Cache de histórico desatualizado T:{user_token[:8]}. Relendo BD.")
+                            results = [{"role": r[1], "content": r[2]} for r in _ler_historico_bd(cur, user_token, limit)]
+                else:
+                    _executar_preparado(cur, "turno_chat", SQL_TURNO_CHAT, (user_token, content, limit))
+                    linhas = cur.fetchall()
+                    if linhas and cache.cabe(limit):
+                        cache.carregar(user_token, linhas, completo=len(linhas) < limit)
+                    results = [{"role": r[1], "content": r[2]} for r in linhas] if linhas else None
+                    momento = max(linhas)[3] if linhas else None  # A msg nova é a de maior id
+            conn.commit()
+    except psycopg2.Error as e:
+        logging.exception(f"Erro BD turno chat T:{user_token[:8]}: {e.pgcode} - {e.pgerror}")
+        cache.invalidar(user_token)
+        return None
+    except Exception as e:
+        logging.exception(f"Erro inesperado turno chat T:{user_token[:8]}")
+        cache.invalidar(user_token)
+        return None
+    if not results:
+        # Sem linhas = o CTE 'tok' veio vazio (token inexistente ou expirado)
+        logging.info(f"Turno chat recusado, token inválido/expirado: {user_token[:8]}...")
+        return None
+    logging.debug("Turno chat BD T:%s: msg salva + %d/%d msgs de histórico", user_token[:8], len(results), limit)
+    if escrita.ESCRITA_ASSINCRONA:
+        escrita.obter_escritor(_gravar_lote_mensagens).marcar_turno(user_token, momento)  # Resposta no relógio do banco
+    resumos.marcar_conversa_ativa(_fonte_resumos, user_token)
+    return results
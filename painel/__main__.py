@@ -0,0 +1,48 @@
+# painel/__main__.py - Tarefas administrativas do banco pela linha de comando
+#
+#   python -m painel migrate      aplica as migrações pendentes do esquema (rodar a cada deploy)
+#   python -m painel versao       mostra a versão do esquema no banco e a esperada pelo código
+#   python -m painel manutencao   cria partições futuras, aplica a retenção de chat_messages e
+#                                 apaga as chaves de idempotência vencidas
+
+import sys
+import json
+import argparse
+import logging
+
+from . import DATABASE_URL, migrar_esquema, verificar_esquema, manter_particoes_chat
+from . import migracoes, armazenamento
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m painel", description="Tarefas administrativas do banco do painel.")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+    comandos.add_parser("migrate", aliases=["migrar"], help="Aplica as migrações pendentes (serializado por advisory lock).")
+    comandos.add_parser("versao", help="Confere se o banco está na versão de esquema esperada pelo código.")
+    comandos.add_parser("manutencao", help="Cria as partições dos próximos meses, arquiva/apaga as além da retenção e apaga as chaves de idempotência vencidas.")
+    args = parser.parse_args(argv)
+
+    if not DATABASE_URL:
+        logging.error("DATABASE_URL não definida.")
+        return 2
+    if args.comando in ("migrate", "migrar"):
+        aplicadas = migrar_esquema()
+        if aplicadas is None:
+            return 1
+        if armazenamento.usa_sqlite(DATABASE_URL):
+            from .bd_sqlite import VERSAO_ATUAL
+        else:
+            VERSAO_ATUAL = migracoes.VERSAO_ATUAL
+        print(json.dumps({"aplicadas": aplicadas, "versao": VERSAO_ATUAL}))
+    elif args.comando == "versao":
+        return 0 if verificar_esquema() else 1
+    elif args.comando == "manutencao":
+        resultado = manter_particoes_chat()
+        if resultado is None:
+            return 1
+        print(json.dumps(resultado, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+# painel/armazenamento.py - Backend de armazenamento do painel, escolhido pelo esquema do DATABASE_URL
+#
+#   postgres://... / postgresql://... / DSN "dbname=..."  -> Postgres (o código de painel/__init__.py)
+#   sqlite:///caminho/relativo.db / sqlite:////caminho/absoluto.db / sqlite:///:memory:
+#                                                        -> SQLite em modo WAL (bd_sqlite.py)
+#
+# As funções públicas do painel não mudam: com SQLite, cada uma é atendida
+# pelo método de mesmo nome do backend (ver _com_backend em painel/__init__.py).
+# A escolha é feita uma vez, na importação; com Postgres não há custo nenhum.
+# O Postgres continua nas funções de painel/__init__.py: Armazenamento é o
+# contrato dos backends alternativos (hoje só o ArmazenamentoSQLite), e cada
+# função com @_com_backend tem aqui o seu método abstrato.
+
+import os
+import threading
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit, unquote
+
+ESQUEMAS_SQLITE = ("sqlite",)
+
+
+class Armazenamento(ABC):
+    """
+    Backend alternativo ao Postgres. Os métodos têm a mesma assinatura e o mesmo
+    retorno das funções homônimas de painel/__init__.py; uma subclasse que
+    esqueça algum não pode ser instanciada.
+    """
+
+    nome = "base"
+
+    @abstractmethod
+    def migrar_esquema(self) -> list[int] | None:
+        ...
+
+    @abstractmethod
+    def verificar_esquema(self) -> bool:
+        ...
+
+    @abstractmethod
+    def inserir_token(self, nome: str, telefone: str, dias_validade: int) -> str | None:
+        ...
+
+    @abstractmethod
+    def listar_tokens(self) -> list:
+        ...
+
+    @abstractmethod
+    def listar_tokens_pagina(self, busca=None, status=None, cursor=None, limite: int = 50) -> tuple[list, str | None]:
+        ...
+
+    @abstractmethod
+    def importar_tokens_lote(self, arquivo, formato: str = "csv", dias_validade: int = 7, progresso=None) -> dict | None:
+        ...
+
+    @abstractmethod
+    def alterar_tokens_lote(self, operacao: str, busca=None, status=None, dias=None) -> int | None:
+        ...
+
+    @abstractmethod
+    def excluir_token(self, token: str) -> bool:
+        ...
+
+    @abstractmethod
+    def verificar_token_valido(self, token_a_verificar: str) -> bool:
+        ...
+
+    @abstractmethod
+    def atualizar_validade_token(self, token_a_atualizar: str, dias_a_adicionar: int) -> bool:
+        ...
+
+    @abstractmethod
+    def buscar_token_ativo_por_telefone(self, telefone_a_buscar: str) -> str | None:
+        ...
+
+    @abstractmethod
+    def manter_particoes_chat(self) -> dict | None:
+        ...
+
+    @abstractmethod
+    def consumir_ficha_taxa(self, chave: str, capacidade: float, por_segundo: float) -> bool:
+        ...
+
+    @abstractmethod
+    def reservar_idempotencia(self, user_token: str, chave: str) -> tuple[str, str | None]:
+        ...
+
+    @abstractmethod
+    def concluir_idempotencia(self, user_token: str, chave: str, resposta: str) -> bool:
+        ...
+
+    @abstractmethod
+    def liberar_idempotencia(self, user_token: str, chave: str) -> bool:
+        ...
+
+    @abstractmethod
+    def add_chat_message(self, user_token: str, role: str, content: str) -> bool:
+        ...
+
+    @abstractmethod
+    def get_chat_history(self, user_token: str, limit: int = 20) -> list:
+        ...
+
+    @abstractmethod
+    def registrar_turno_chat(self, user_token: str, content: str, limit: int = 20,
+                             chave_idempotencia: str | None = None) -> list | None:
+        ...
+
+    @abstractmethod
+    def obter_resumo_conversa(self, user_token: str) -> str | None:
+        ...
+
+    @abstractmethod
+    def estatisticas_pool(self) -> dict:
+        ...
+
+    def fechar(self):
+        pass
+
+
+def esquema_url(url: str | None) -> str | None:
+    """'sqlite', 'postgresql'... ou None para DSN no formato chave=valor / URL ausente."""
+    if not url or "://" not in url:
+        return None
+    return urlsplit(url).scheme.lower()
+
+
+def usa_sqlite(url: str | None) -> bool:
+    return esquema_url(url) in ESQUEMAS_SQLITE
+
+
+def caminho_sqlite(url: str) -> str:
+    """sqlite:///dados/clara.db -> 'dados/clara.db'; sqlite:////var/clara.db -> '/var/clara.db'."""
+    partes = urlsplit(url)
+    caminho = unquote(partes.netloc + partes.path)
+    if caminho.startswith("/") and not caminho.startswith("//"):
+        caminho = caminho[1:]  # sqlite:///relativo
+    elif caminho.startswith("//"):
+        caminho = caminho[1:]  # sqlite:////absoluto
+    if not caminho:
+        raise ValueError(f"URL SQLite sem caminho: {url!r}")
+    return caminho
+
+
+# --- Backend do processo (criado sob demanda, recriado após fork) ---
+
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+
+def obter(url: str) -> Armazenamento:
+    """Backend alternativo do processo atual para a URL (hoje só SQLite)."""
+    global _backend, _backend_pid
+    pid = os.getpid()
+    if _backend is not None and _backend_pid == pid:
+        return _backend
+    with _backend_lock:
+        if _backend is None or _backend_pid != pid:
+            # Importação tardia: bd_sqlite usa helpers de painel/__init__.py
+            from .bd_sqlite import ArmazenamentoSQLite
+            _backend = ArmazenamentoSQLite(caminho_sqlite(url))
+            _backend_pid = pid
+    return _backend
+
+
+def fechar():
+    """Fecha as conexões do backend do processo (ex.: no shutdown do worker)."""
+    global _backend, _backend_pid
+    with _backend_lock:
+        if _backend is not None and _backend_pid == os.getpid():
+            _backend.fechar()
+        _backend = None
+        _backend_pid = None
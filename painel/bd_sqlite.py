@@ -0,0 +1,812 @@
+# painel/bd_sqlite.py - Backend SQLite (modo WAL) do painel, para um nó só
+#
+# Mesmo modelo de dados do Postgres (tokens, chat_messages com token_id/role
+# SMALLINT, chat_resumos) num arquivo local: sem ida à rede, consultas na casa
+# dos microssegundos. Serve para consultórios pequenos, nós de borda e para
+# rodar o benchmark sem um servidor Postgres. Com WAL os leitores não esperam
+# o escritor (que é um só por vez); synchronous=NORMAL pode perder as últimas
+# transações numa queda de energia, mas não corrompe o arquivo.
+#
+# Diferenças em relação ao Postgres:
+#   - datas em TEXT ISO-8601 UTC de tamanho fixo (comparáveis como texto);
+#   - sem cache de tokens/histórico em memória: a consulta local já é barata e
+#     os workers que abrem o mesmo arquivo não têm como se avisar (não há LISTEN/NOTIFY);
+#   - sem partições: manter_particoes_chat arquiva (CSV gzip) e apaga as
+#     mensagens dos meses além de CHAT_RETENCAO_MESES;
+#   - versão do esquema em PRAGMA user_version (python -m painel migrate continua valendo);
+#   - a busca do painel por nome (LIKE) ignora maiúsculas só em ASCII.
+#
+# Variáveis de ambiente:
+#   SQLITE_POOL_MAX       conexões abertas por processo (padrão 8)
+#   SQLITE_BUSY_TIMEOUT   segundos esperando a vez de escrever (padrão 5)
+
+import os
+import gzip
+import csv
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from . import (FUSO_PAINEL, PYTZ_IMPORTADO, pytz_timezone, gerar_token,
+               _escapar_like, _codificar_cursor, _decodificar_cursor)
+from . import esquema
+from . import importacao
+from . import particoes
+from . import resumos
+from . import idempotencia
+from .armazenamento import Armazenamento
+
+SQLITE_POOL_MAX = int(os.getenv("SQLITE_POOL_MAX", "8"))
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))
+
+ROLES_TEXTO = {numero: nome for nome, numero in esquema.ROLES.items()}
+
+# (versão, nome, comandos) - mesma regra de migracoes.py: só acrescentar no fim
+MIGRACOES = [
+    (1, "tabelas", [
+        """
+        CREATE TABLE IF NOT EXISTS tokens (
+            id INTEGER PRIMARY KEY,
+            nome TEXT NOT NULL,
+            telefone TEXT NOT NULL UNIQUE,
+            token TEXT NOT NULL UNIQUE,
+            criado_em TEXT NOT NULL,
+            validade_em TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_tokens_criado_id ON tokens (criado_em DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_tokens_validade ON tokens (validade_em)",
+        """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY,
+            token_id INTEGER NOT NULL REFERENCES tokens(id) ON DELETE CASCADE,
+            role INTEGER NOT NULL CHECK (role IN (1, 2)),
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+        """,
+        # id cresce com a inserção (um escritor por vez), então ordena como o timestamp
+        "CREATE INDEX IF NOT EXISTS idx_chat_msgs_token_id ON chat_messages (token_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_msgs_ts ON chat_messages (timestamp)",
+        """
+        CREATE TABLE IF NOT EXISTS chat_resumos (
+            token_id INTEGER PRIMARY KEY REFERENCES tokens(id) ON DELETE CASCADE,
+            resumo TEXT NOT NULL,
+            ate_id INTEGER NOT NULL,
+            atualizado_em TEXT NOT NULL
+        )
+        """,
+    ]),
+    (2, "limites_taxa", [
+        """
+        CREATE TABLE IF NOT EXISTS limites_taxa (
+            chave TEXT PRIMARY KEY,
+            fichas REAL NOT NULL,
+            atualizado_em REAL NOT NULL  -- time.time() da última ficha tirada
+        )
+        """,
+    ]),
+    (3, "chat_idempotencia", [
+        """
+        CREATE TABLE IF NOT EXISTS chat_idempotencia (
+            token_id INTEGER NOT NULL REFERENCES tokens(id) ON DELETE CASCADE,
+            chave TEXT NOT NULL,
+            resposta TEXT,  -- NULL = a requisição original ainda está em andamento
+            criado_em TEXT NOT NULL,
+            PRIMARY KEY (token_id, chave)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_chat_idempotencia_criado ON chat_idempotencia (criado_em)",
+    ]),
+    (4, "chat_idempotencia_mensagem", [
+        "ALTER TABLE chat_idempotencia ADD COLUMN mensagem_gravada INTEGER NOT NULL DEFAULT 0",
+    ]),
+]
+VERSAO_ATUAL = MIGRACOES[-1][0]
+
+STATUS_FILTROS = {
+    "ativos": "validade_em > :agora",
+    "expirados": "(validade_em IS NULL OR validade_em <= :agora)",
+}
+
+SQL_LOTE = {
+    "estender": "UPDATE tokens SET validade_em = :nova_validade {where} RETURNING token",
+    "expirar": "UPDATE tokens SET validade_em = :agora {where} RETURNING token",
+    "excluir": "DELETE FROM tokens {where} RETURNING token",  # msgs e resumos vão junto (ON DELETE CASCADE)
+}
+
+SQL_INSERIR_MENSAGEM = """
+    INSERT INTO chat_messages (token_id, role, content, timestamp)
+    SELECT id, ?, ?, ? FROM tokens WHERE token = ?
+    RETURNING id
+"""
+SQL_HISTORICO = """
+    SELECT role, content FROM (
+        SELECT id, role, content FROM chat_messages
+        WHERE token_id = {token_id}
+        ORDER BY id DESC
+        LIMIT ?
+    ) ORDER BY id
+"""
+SQL_HISTORICO_POR_ID = SQL_HISTORICO.format(token_id="?")
+SQL_HISTORICO_POR_TOKEN = SQL_HISTORICO.format(token_id="(SELECT id FROM tokens WHERE token = ?)")
+SQL_LER_RESUMO = """
+    SELECT r.resumo, r.ate_id FROM chat_resumos r
+    JOIN tokens t ON t.id = r.token_id
+    WHERE t.token = ?
+"""
+SQL_PENDENTES = """
+    SELECT id, role, content FROM (
+        SELECT id, role, content FROM chat_messages
+        WHERE token_id = (SELECT id FROM tokens WHERE token = ?) AND id > ?
+        ORDER BY id DESC
+        LIMIT -1 OFFSET ?
+    ) ORDER BY id
+    LIMIT ?
+"""
+SQL_GRAVAR_RESUMO = """
+    INSERT INTO chat_resumos (token_id, resumo, ate_id, atualizado_em)
+    SELECT id, ?, ?, ? FROM tokens WHERE token = ?
+    ON CONFLICT (token_id) DO UPDATE
+        SET resumo = excluded.resumo, ate_id = excluded.ate_id, atualizado_em = excluded.atualizado_em
+        WHERE chat_resumos.ate_id < excluded.ate_id
+"""
+
+# Mesmo token bucket de painel.SQL_CONSUMIR_FICHA
+SQL_CONSUMIR_FICHA = """
+    INSERT INTO limites_taxa (chave, fichas, atualizado_em) VALUES (:chave, :capacidade - 1, :agora)
+    ON CONFLICT (chave) DO UPDATE
+        SET fichas = min(:capacidade, fichas + (:agora - atualizado_em) * :por_segundo) - 1,
+            atualizado_em = :agora
+        WHERE min(:capacidade, fichas + (:agora - atualizado_em) * :por_segundo) >= 1
+    RETURNING fichas
+"""
+
+# Mesma reserva de idempotencia.SQL_RESERVAR; o estado é lido depois, na mesma transação
+SQL_RESERVAR_IDEMPOTENCIA = """
+    INSERT INTO chat_idempotencia (token_id, chave, criado_em)
+    SELECT id, :chave, :agora FROM tokens WHERE token = :token
+    ON CONFLICT (token_id, chave) DO UPDATE SET criado_em = excluded.criado_em
+        WHERE chat_idempotencia.resposta IS NULL AND chat_idempotencia.criado_em < :abandono
+"""
+SQL_ESTADO_IDEMPOTENCIA = """
+    SELECT t.id, i.resposta FROM tokens t
+    LEFT JOIN chat_idempotencia i ON i.token_id = t.id AND i.chave = :chave
+    WHERE t.token = :token
+"""
+SQL_CONCLUIR_IDEMPOTENCIA = """
+    UPDATE chat_idempotencia SET resposta = ?
+    WHERE token_id = (SELECT id FROM tokens WHERE token = ?) AND chave = ?
+"""
+# Mesma regra de idempotencia.SQL_MARCAR_MENSAGEM / SQL_LIBERAR, em comandos separados na transação
+SQL_MENSAGEM_IDEMPOTENCIA = """
+    SELECT mensagem_gravada FROM chat_idempotencia
+    WHERE token_id = (SELECT id FROM tokens WHERE token = :token) AND chave = :chave
+"""
+SQL_MARCAR_MENSAGEM_IDEMPOTENCIA = """
+    UPDATE chat_idempotencia SET mensagem_gravada = 1
+    WHERE token_id = (SELECT id FROM tokens WHERE token = :token) AND chave = :chave
+"""
+SQL_LIBERAR_IDEMPOTENCIA = """
+    DELETE FROM chat_idempotencia
+    WHERE token_id = (SELECT id FROM tokens WHERE token = :token) AND chave = :chave
+      AND resposta IS NULL AND NOT mensagem_gravada
+"""
+SQL_SOLTAR_IDEMPOTENCIA = """
+    UPDATE chat_idempotencia SET criado_em = :abandono
+    WHERE token_id = (SELECT id FROM tokens WHERE token = :token) AND chave = :chave
+      AND resposta IS NULL AND mensagem_gravada
+"""
+
+
+def _iso(momento: datetime) -> str:
+    """Data UTC em texto de tamanho fixo (a ordem do texto é a ordem das datas)."""
+    return momento.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def _agora() -> str:
+    return _iso(datetime.now(timezone.utc))
+
+
+def _data(texto: str | None) -> datetime | None:
+    return datetime.fromisoformat(texto) if texto else None
+
+
+@contextmanager
+def _transacao(conn):
+    """BEGIN IMMEDIATE (pega o lock de escrita já no início) ... COMMIT, ou ROLLBACK na exceção."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+class PoolSQLiteEsgotadoError(sqlite3.OperationalError):
+    """Nenhuma conexão livre dentro de SQLITE_BUSY_TIMEOUT."""
+
+
+class PoolSQLite:
+    """
+    Até `maximo` conexões por processo, reaproveitadas entre requisições.
+    Conexões em autocommit (isolation_level=None): as escritas de várias
+    instruções abrem a transação explicitamente (_transacao).
+    """
+
+    def __init__(self, caminho: str, maximo: int = SQLITE_POOL_MAX, timeout: float = SQLITE_BUSY_TIMEOUT):
+        self.caminho = caminho
+        self.memoria = caminho == ":memory:"
+        self.maximo = max(1, maximo)
+        self.timeout = timeout
+        self._livres = []
+        self._todas = []
+        self._vagas = threading.BoundedSemaphore(self.maximo)
+        self._lock = threading.Lock()
+        self._stats = {"aquisicoes": 0, "conexoes_criadas": 0, "esperas_timeout": 0,
+                       "espera_total_s": 0.0, "espera_max_s": 0.0}
+        if not self.memoria and os.path.dirname(caminho):
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+
+    def _abrir(self) -> sqlite3.Connection:
+        # ':memory:' compartilhado entre as conexões do pool (senão cada uma teria um banco vazio)
+        alvo = f"file:painel_{id(self)}?mode=memory&cache=shared" if self.memoria else self.caminho
+        conn = sqlite3.connect(alvo, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=False, uri=self.memoria)
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        if not self.memoria:
+            conn.execute("PRAGMA journal_mode = WAL")
+        with self._lock:
+            self._todas.append(conn)
+            self._stats["conexoes_criadas"] += 1
+        return conn
+
+    @contextmanager
+    def conexao(self):
+        inicio = time.perf_counter()
+        if not self._vagas.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["esperas_timeout"] += 1
+            raise PoolSQLiteEsgotadoError(f"Nenhuma conexão SQLite livre em {self.timeout:.0f}s.")
+        try:
+            espera = time.perf_counter() - inicio
+            with self._lock:
+                conn = self._livres.pop() if self._livres else None
+                self._stats["aquisicoes"] += 1
+                self._stats["espera_total_s"] += espera
+                self._stats["espera_max_s"] = max(self._stats["espera_max_s"], espera)
+            if conn is None:
+                conn = self._abrir()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                with self._lock:
+                    self._livres.append(conn)
+        finally:
+            self._vagas.release()
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["conexoes_abertas"] = len(self._todas)
+        stats["max"] = self.maximo
+        stats["espera_media_s"] = stats["espera_total_s"] / stats["aquisicoes"] if stats["aquisicoes"] else 0.0
+        return stats
+
+    def fechar(self):
+        with self._lock:
+            conexoes, self._todas, self._livres = self._todas, [], []
+        for conn in conexoes:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                logging.debug("Falha ao fechar conexão SQLite.", exc_info=True)
+
+
+class ArmazenamentoSQLite(Armazenamento):
+    """As funções públicas do painel sobre um arquivo SQLite (ver o topo do módulo)."""
+
+    nome = "sqlite"
+
+    def __init__(self, caminho: str):
+        self.pool = PoolSQLite(caminho)
+        self._fuso = None
+        if PYTZ_IMPORTADO:
+            try:
+                self._fuso = pytz_timezone(FUSO_PAINEL)
+            except Exception as tz_e:
+                logging.warning(f"Erro timezone SP: {tz_e}. Usando UTC.")
+        logging.info(f"Armazenamento SQLite em '{caminho}' (pid={os.getpid()}, max={self.pool.maximo} conexões).")
+
+    def _local(self, texto: str | None, formato: str) -> str | None:
+        momento = _data(texto)
+        if momento is None:
+            return None
+        return (momento.astimezone(self._fuso) if self._fuso else momento).strftime(formato)
+
+    # --- Esquema ---
+
+    def migrar_esquema(self) -> list[int] | None:
+        try:
+            aplicadas = []
+            with self.pool.conexao() as conn:
+                for versao, nome, comandos in MIGRACOES:
+                    inicio = time.monotonic()
+                    with _transacao(conn):
+                        # Relido com o lock de escrita: outro processo pode ter migrado antes
+                        if conn.execute("PRAGMA user_version").fetchone()[0] >= versao:
+                            continue
+                        for comando in comandos:
+                            conn.execute(comando)
+                        conn.execute(f"PRAGMA user_version = {int(versao)}")
+                    aplicadas.append(versao)
+                    logging.info(f"Migração SQLite {versao:03d} '{nome}' aplicada em {time.monotonic() - inicio:.2f}s.")
+            logging.info(f"Esquema SQLite na versão {VERSAO_ATUAL} ({len(aplicadas)} migração(ões) aplicada(s)).")
+            return aplicadas
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite migrar esquema: {e}")
+            return None
+
+    def verificar_esquema(self) -> bool:
+        try:
+            with self.pool.conexao() as conn:
+                versao = conn.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite verificar esquema: {e}")
+            return False
+        if versao < VERSAO_ATUAL:
+            logging.error(f"Esquema SQLite na versão {versao}, o app espera {VERSAO_ATUAL}. "
+                          f"Rode 'python -m painel migrate'.")
+            return False
+        if versao > VERSAO_ATUAL:
+            logging.warning(f"Esquema SQLite ({versao}) mais novo que o app ({VERSAO_ATUAL}).")
+        return True
+
+    # --- Tokens ---
+
+    def inserir_token(self, nome: str, telefone: str, dias_validade: int) -> str | None:
+        if not nome or not telefone:
+            logging.warning("Tentativa token nome/tel vazio.")
+            return None
+        token_novo = gerar_token()
+        agora_utc = datetime.now(timezone.utc)
+        validade_utc = agora_utc + timedelta(days=int(dias_validade))
+        try:
+            with self.pool.conexao() as conn:
+                conn.execute(
+                    "INSERT INTO tokens (nome, telefone, token, criado_em, validade_em) VALUES (?, ?, ?, ?, ?)",
+                    (nome, telefone, token_novo, _iso(agora_utc), _iso(validade_utc)),
+                )
+            logging.info(f"Token inserido: Nome='{nome}', Tel='***{telefone[-4:]}', T='{token_novo[:8]}...'")
+            return token_novo
+        except sqlite3.IntegrityError as e:
+            logging.warning(f"Tel duplicado: '***{telefone[-4:]}' ('{nome}'). {e}")
+            return None
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite inserir token N='{nome}', T='***{telefone[-4:]}': {e}")
+            return None
+
+    def listar_tokens(self) -> list:
+        try:
+            with self.pool.conexao() as conn:
+                linhas = conn.execute(
+                    "SELECT nome, telefone, token, criado_em, validade_em FROM tokens ORDER BY criado_em DESC"
+                ).fetchall()
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite listar tokens: {e}")
+            return []
+        formato = '%Y-%m-%d %H:%M:%S %Z%z'
+        return [(nome, telefone, tok, self._local(criado, formato), self._local(validade, formato))
+                for nome, telefone, tok, criado, validade in linhas]
+
+    def _filtros(self, busca: str | None, status: str | None, agora: str) -> tuple[list, dict]:
+        condicoes, params = [], {"agora": agora}
+        if busca and busca.strip():
+            termo = busca.strip()
+            condicoes.append("(nome LIKE :contem ESCAPE '\\' OR substr(telefone, 1, length(:prefixo)) = :prefixo"
+                             " OR substr(token, 1, length(:prefixo)) = :prefixo)")
+            params["contem"] = f"%{_escapar_like(termo)}%"
+            params["prefixo"] = termo
+        if status in STATUS_FILTROS:
+            condicoes.append(STATUS_FILTROS[status])
+        return condicoes, params
+
+    def listar_tokens_pagina(self, busca=None, status=None, cursor=None, limite: int = 50) -> tuple[list, str | None]:
+        limite = max(1, min(int(limite), 500))
+        agora = _agora()
+        condicoes, params = self._filtros(busca, status, agora)
+        params["limite"] = limite + 1
+        if cursor:
+            posicao = _decodificar_cursor(cursor)
+            if posicao is None:
+                logging.warning("Cursor de paginação inválido; voltando à primeira página.")
+            else:
+                condicoes.append("(criado_em, id) < (:cursor_criado, :cursor_id)")
+                params["cursor_criado"], params["cursor_id"] = _iso(posicao[0]), posicao[1]
+        where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+        try:
+            with self.pool.conexao() as conn:
+                linhas = conn.execute(f"""
+                    SELECT nome, telefone, token, criado_em, validade_em, id FROM tokens
+                    {where}
+                    ORDER BY criado_em DESC, id DESC
+                    LIMIT :limite
+                """, params).fetchall()
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite listar página de tokens: {e}")
+            return [], None
+
+        proximo = None
+        if len(linhas) > limite:
+            linhas = linhas[:limite]
+            proximo = _codificar_cursor(_data(linhas[-1][3]), linhas[-1][5])
+        formato = '%Y-%m-%d %H:%M:%S'
+        return [(nome, telefone, tok, self._local(criado, formato), self._local(validade, formato),
+                 validade is not None and validade > agora)
+                for nome, telefone, tok, criado, validade, _id in linhas], proximo
+
+    def _importar(self, conn, arquivo, formato: str, dias_padrao: int, progresso) -> dict:
+        """Mesmo relatório de importacao.importar(), com um INSERT por linha na transação aberta."""
+        agora = datetime.now(timezone.utc)
+        linhas, vistos = [], set()
+        validas = inseridos = invalidas = 0
+        for numero, registro in importacao.ler_registros(arquivo, formato):
+            valido, motivo = importacao.validar_registro(registro, dias_padrao)
+            if valido is None:
+                linhas.append((numero, str((registro or {}).get("nome") or ""),
+                               str((registro or {}).get("telefone") or ""), None, motivo))
+                invalidas += 1
+                continue
+            nome, telefone, dias = valido
+            validas += 1
+            if progresso and validas % importacao.IMPORT_BLOCO == 0:
+                progresso("copiadas", validas)
+            if telefone in vistos:
+                linhas.append((numero, nome, telefone, None, "telefone repetido no arquivo"))
+                continue
+            vistos.add(telefone)
+            token = gerar_token()
+            cur = conn.execute(
+                "INSERT INTO tokens (nome, telefone, token, criado_em, validade_em) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT DO NOTHING",
+                (nome, telefone, token, _iso(agora), _iso(agora + timedelta(days=dias))),
+            )
+            if cur.rowcount:
+                inseridos += 1
+                linhas.append((numero, nome, telefone, token, "inserido"))
+            else:
+                linhas.append((numero, nome, telefone, None, "telefone já cadastrado"))
+        if progresso:
+            progresso("copiadas", validas)
+            progresso("inseridas", inseridos)
+        logging.info(f"Importação de tokens: {validas} linha(s) válidas, {inseridos} inserida(s), "
+                     f"{validas - inseridos} conflito(s), {invalidas} inválida(s).")
+        return {"linhas": linhas, "inseridos": inseridos, "conflitos": validas - inseridos, "invalidos": invalidas}
+
+    def importar_tokens_lote(self, arquivo, formato: str = "csv", dias_validade: int = 7, progresso=None) -> dict | None:
+        try:
+            with self.pool.conexao() as conn, _transacao(conn):
+                return self._importar(conn, arquivo, formato, int(dias_validade), progresso)
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite importar tokens: {e}")
+            return None
+        except Exception:
+            logging.exception("Erro inesperado importar tokens")
+            return None
+
+    def alterar_tokens_lote(self, operacao: str, busca=None, status=None, dias=None) -> int | None:
+        if operacao not in SQL_LOTE:
+            logging.warning(f"Operação em lote desconhecida: {operacao}")
+            return None
+        agora = _agora()
+        condicoes, params = self._filtros(busca, status, agora)
+        if operacao == "estender":
+            try:
+                dias_int = int(dias)
+            except (TypeError, ValueError):
+                dias_int = 0
+            if dias_int <= 0:
+                logging.warning(f"Dias inválidos ({dias}) p/ estender em lote.")
+                return None
+            params["nova_validade"] = _iso(datetime.now(timezone.utc) + timedelta(days=dias_int))
+        elif operacao == "expirar":
+            condicoes.append("(validade_em IS NULL OR validade_em > :agora)")
+        where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+        try:
+            with self.pool.conexao() as conn, _transacao(conn):
+                afetados = conn.execute(SQL_LOTE[operacao].format(where=where), params).fetchall()
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite operação em lote '{operacao}': {e}")
+            return None
+        logging.info(f"Operação em lote '{operacao}': {len(afetados)} token(s) (busca={bool(busca)}, status={status}).")
+        return len(afetados)
+
+    def excluir_token(self, token: str) -> bool:
+        if not token:
+            logging.error("Token ausente.")
+            return False
+        try:
+            with self.pool.conexao() as conn:
+                removidos = conn.execute("DELETE FROM tokens WHERE token = ?", (token,)).rowcount
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite excluir token {token[:8]}: {e}")
+            return False
+        if removidos > 0:
+            logging.info(f"Token excluído: {token[:8]}...")
+            return True
+        logging.warning(f"Token não encontrado para exclusão: {token[:8]}...")
+        return False
+
+    def verificar_token_valido(self, token_a_verificar: str) -> bool:
+        if not token_a_verificar:
+            logging.warning("Tentativa verificar token vazio.")
+            return False
+        try:
+            with self.pool.conexao() as conn:
+                linha = conn.execute("SELECT validade_em FROM tokens WHERE token = ?", (token_a_verificar,)).fetchone()
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite verificar token {token_a_verificar[:8]}: {e}")
+            return False
+        if linha is None:
+            logging.info(f"Token não encontrado: {token_a_verificar[:8]}...")
+            return False
+        if linha[0] is None:
+            logging.warning(f"Token {token_a_verificar[:8]} s/ validade.")
+            return False
+        if linha[0] > _agora():
+            return True
+        logging.info(f"Token expirado: {token_a_verificar[:8]} Val:{linha[0]}")
+        return False
+
+    def atualizar_validade_token(self, token_a_atualizar: str, dias_a_adicionar: int) -> bool:
+        if not token_a_atualizar:
+            logging.warning("Tentativa atualizar token vazio.")
+            return False
+        try:
+            dias_int = int(dias_a_adicionar)
+        except (ValueError, TypeError):
+            logging.warning(f"Dias inválidos ({dias_a_adicionar}) p/ token {token_a_atualizar[:8]}")
+            return False
+        if dias_int <= 0:
+            logging.warning(f"Dias <= 0 ({dias_int}) p/ token {token_a_atualizar[:8]}")
+            return False
+        nova_validade = _iso(datetime.now(timezone.utc) + timedelta(days=dias_int))
+        try:
+            with self.pool.conexao() as conn:
+                alteradas = conn.execute("UPDATE tokens SET validade_em = ? WHERE token = ?",
+                                         (nova_validade, token_a_atualizar)).rowcount
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite att validade token {token_a_atualizar[:8]}: {e}")
+            return False
+        if alteradas > 0:
+            logging.info(f"Validade token {token_a_atualizar[:8]} atualizada p/ {nova_validade}.")
+            return True
+        logging.warning(f"Token {token_a_atualizar[:8]} não encontrado p/ att validade.")
+        return False
+
+    def buscar_token_ativo_por_telefone(self, telefone_a_buscar: str) -> str | None:
+        if not telefone_a_buscar:
+            logging.warning("Tentativa de buscar token com telefone vazio.")
+            return None
+        try:
+            with self.pool.conexao() as conn:
+                linha = conn.execute("SELECT token, validade_em FROM tokens WHERE telefone = ?",
+                                     (telefone_a_buscar,)).fetchone()
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite ao buscar token por telefone ***{telefone_a_buscar[-4:]}: {e}")
+            return None
+        if linha is None:
+            logging.info(f"Nenhum token encontrado para o telefone ***{telefone_a_buscar[-4:]}")
+            return None
+        token, validade = linha
+        if validade and validade > _agora():
+            logging.info(f"Token ativo encontrado para tel ***{telefone_a_buscar[-4:]}: {token[:8]}...")
+            return token
+        logging.warning(f"Telefone ***{telefone_a_buscar[-4:]} encontrado, mas nenhum token ativo associado.")
+        return None
+
+    # --- Chat ---
+
+    def manter_particoes_chat(self) -> dict | None:
+        """
+        Sem partições no SQLite: arquiva e apaga as mensagens anteriores ao mês limite
+        da retenção. Também apaga as chaves de idempotência vencidas.
+        """
+        resultado = {"desanexadas": [], "arquivadas": [], "apagadas": [], "chaves_expiradas": 0}
+        try:
+            with self.pool.conexao() as conn:
+                if particoes.CHAT_RETENCAO_MESES > 0:
+                    limite = particoes._somar_meses(particoes._mes_atual(), -particoes.CHAT_RETENCAO_MESES)
+                    limite_iso = _iso(datetime(limite.year, limite.month, 1, tzinfo=timezone.utc))
+                    with _transacao(conn):
+                        rotulo = f"chat_messages_ate_{limite:%Y%m}"
+                        if particoes.CHAT_ARQUIVO_DIR:
+                            destino = self._arquivar(conn, rotulo, limite_iso)
+                            if destino:
+                                resultado["arquivadas"].append(destino)
+                        apagadas = conn.execute("DELETE FROM chat_messages WHERE timestamp < ?", (limite_iso,)).rowcount
+                    if apagadas:
+                        resultado["apagadas"].append(f"{rotulo} ({apagadas} msgs)")
+                        logging.info(f"{apagadas} msg(s) anteriores a {limite:%Y-%m} apagadas "
+                                     f"(retenção de {particoes.CHAT_RETENCAO_MESES} meses).")
+                vencimento = _iso(datetime.now(timezone.utc) - timedelta(hours=idempotencia.IDEMPOTENCIA_TTL_HORAS))
+                resultado["chaves_expiradas"] = conn.execute(
+                    "DELETE FROM chat_idempotencia WHERE criado_em < ?", (vencimento,)).rowcount
+                conn.execute("PRAGMA optimize")
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            return resultado
+        except (sqlite3.Error, OSError) as e:
+            logging.exception(f"Erro SQLite manter retenção de 'chat_messages': {e}")
+            return None
+
+    def _arquivar(self, conn, rotulo: str, limite_iso: str) -> str | None:
+        """Grava as mensagens anteriores ao limite em CHAT_ARQUIVO_DIR/<rotulo>_<agora>.csv.gz."""
+        cursor = conn.execute(
+            "SELECT id, token_id, role, content, timestamp FROM chat_messages WHERE timestamp < ? ORDER BY id",
+            (limite_iso,))
+        primeira = cursor.fetchone()
+        if primeira is None:
+            return None
+        os.makedirs(particoes.CHAT_ARQUIVO_DIR, exist_ok=True)
+        destino = os.path.join(particoes.CHAT_ARQUIVO_DIR, f"{rotulo}_{datetime.now(timezone.utc):%Y%m%d%H%M%S}.csv.gz")
+        parcial = destino + ".parcial"
+        with gzip.open(parcial, "wt", encoding="utf-8", newline="") as arquivo:
+            escritor = csv.writer(arquivo)
+            escritor.writerow(["id", "token_id", "role", "content", "timestamp"])
+            escritor.writerow(primeira)
+            escritor.writerows(cursor)
+        with open(parcial, "rb") as arquivo:
+            os.fsync(arquivo.fileno())
+        os.replace(parcial, destino)
+        logging.info(f"Mensagens anteriores a {limite_iso[:7]} arquivadas em '{destino}'.")
+        return destino
+
+    def add_chat_message(self, user_token: str, role: str, content: str) -> bool:
+        if not user_token or role not in esquema.ROLES or content is None:
+            logging.warning(f"Tentativa msg chat inválida. T:{user_token[:8] if user_token else 'N/A'} R:{role} C:{content is None}")
+            return False
+        try:
+            with self.pool.conexao() as conn:
+                linha = conn.execute(SQL_INSERIR_MENSAGEM, (esquema.ROLES[role], content, _agora(), user_token)).fetchone()
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite salvar msg T:{user_token[:8]} R:{role}: {e}")
+            return False
+        if linha is None:
+            logging.warning(f"Msg não salva: token inexistente T:{user_token[:8]} R:{role}")
+            return False
+        logging.debug("Msg salva SQLite: T:%s R:%s C:%d bytes", user_token[:8], role, len(content))
+        return True
+
+    def get_chat_history(self, user_token: str, limit: int = 20) -> list:
+        if not user_token or limit <= 0:
+            return []
+        try:
+            with self.pool.conexao() as conn:
+                linhas = conn.execute(SQL_HISTORICO_POR_TOKEN, (user_token, limit)).fetchall()
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite buscar hist T:{user_token[:8]}: {e}")
+            return []
+        return [{"role": ROLES_TEXTO[role], "content": content} for role, content in linhas]
+
+    def registrar_turno_chat(self, user_token: str, content: str, limit: int = 20,
+                             chave_idempotencia: str | None = None) -> list | None:
+        if not user_token or content is None:
+            logging.warning(f"Tentativa turno chat inválido. T:{user_token[:8] if user_token else 'N/A'} C:{content is None}")
+            return None
+        agora = _agora()
+        try:
+            with self.pool.conexao() as conn, _transacao(conn):
+                ja_gravada = False
+                if chave_idempotencia:
+                    params = {"token": user_token, "chave": chave_idempotencia}
+                    marca = conn.execute(SQL_MENSAGEM_IDEMPOTENCIA, params).fetchone()
+                    ja_gravada = bool(marca and marca[0])
+                    if marca is not None and not ja_gravada:
+                        conn.execute(SQL_MARCAR_MENSAGEM_IDEMPOTENCIA, params)
+                linha = conn.execute("SELECT id FROM tokens WHERE token = ? AND validade_em > ?",
+                                     (user_token, agora)).fetchone()
+                if linha is None:
+                    linhas = None
+                else:
+                    if ja_gravada:
+                        # Reenvio depois de uma falha: a msg já está no banco, não grava de novo
+                        logging.info(f"Turno chat: msg já gravada por uma tentativa anterior T:{user_token[:8]}...")
+                    else:
+                        conn.execute("INSERT INTO chat_messages (token_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+                                     (linha[0], esquema.ROLES["user"], content, agora))
+                    linhas = conn.execute(SQL_HISTORICO_POR_ID, (linha[0], max(limit, 1))).fetchall()
+        except sqlite3.Error as e:
+            logging.exception(f"Erro SQLite turno chat T:{user_token[:8]}: {e}")
+            return None
+        if linhas is None:
+            logging.info(f"Turno chat recusado, token inválido/expirado: {user_token[:8]}...")
+            return None
+        resumos.marcar_conversa_ativa(self, user_token)
+        return [{"role": ROLES_TEXTO[role], "content": texto} for role, texto in linhas]
+
+    def consumir_ficha_taxa(self, chave: str, capacidade: float, por_segundo: float) -> bool:
+        if not chave:
+            return True
+        try:
+            with self.pool.conexao() as conn:
+                linha = conn.execute(SQL_CONSUMIR_FICHA, {"chave": chave, "capacidade": capacidade,
+                                                          "por_segundo": por_segundo, "agora": time.time()}).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Erro SQLite limite de taxa ({chave[:13]}): {e}. Deixando passar.")
+            return True
+        return linha is not None
+
+    def reservar_idempotencia(self, user_token: str, chave: str) -> tuple[str, str | None]:
+        if not user_token or not chave:
+            return "nova", None
+        agora = datetime.now(timezone.utc)
+        params = {"token": user_token, "chave": chave, "agora": _iso(agora),
+                  "abandono": _iso(agora - timedelta(seconds=idempotencia.IDEMPOTENCIA_ABANDONO))}
+        try:
+            with self.pool.conexao() as conn, _transacao(conn):
+                reservou = conn.execute(SQL_RESERVAR_IDEMPOTENCIA, params).rowcount > 0
+                linha = conn.execute(SQL_ESTADO_IDEMPOTENCIA, params).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Erro SQLite reservar chave de idempotência T:{user_token[:8]}: {e}")
+            return "nova", None
+        resposta = linha[1] if linha else None
+        return idempotencia.estado(linha is not None, reservou, resposta), resposta
+
+    def concluir_idempotencia(self, user_token: str, chave: str, resposta: str) -> bool:
+        if not user_token or not chave:
+            return False
+        try:
+            with self.pool.conexao() as conn:
+                return conn.execute(SQL_CONCLUIR_IDEMPOTENCIA, (resposta, user_token, chave)).rowcount > 0
+        except sqlite3.Error as e:
+            logging.warning(f"Erro SQLite concluir chave de idempotência T:{user_token[:8]}: {e}")
+            return False
+
+    def liberar_idempotencia(self, user_token: str, chave: str) -> bool:
+        if not user_token or not chave:
+            return False
+        params = {"token": user_token, "chave": chave,
+                  "abandono": _iso(datetime.now(timezone.utc) - timedelta(seconds=idempotencia.IDEMPOTENCIA_ABANDONO))}
+        try:
+            with self.pool.conexao() as conn, _transacao(conn):
+                liberadas = conn.execute(SQL_LIBERAR_IDEMPOTENCIA, params).rowcount
+                liberadas += conn.execute(SQL_SOLTAR_IDEMPOTENCIA, params).rowcount
+            return liberadas > 0
+        except sqlite3.Error as e:
+            logging.warning(f"Erro SQLite liberar chave de idempotência T:{user_token[:8]}: {e}")
+            return False
+
+    # --- Resumos (fonte do resumos.Resumidor) ---
+
+    def obter_resumo_conversa(self, user_token: str) -> str | None:
+        if not user_token:
+            return None
+        return resumos.obter_resumo(self, user_token)
+
+    def ler_resumo(self, user_token: str) -> tuple[str, int] | None:
+        with self.pool.conexao() as conn:
+            return conn.execute(SQL_LER_RESUMO, (user_token,)).fetchone()
+
+    def ler_pendentes(self, user_token: str, ate_id: int, janela: int, limite: int) -> list:
+        with self.pool.conexao() as conn:
+            linhas = conn.execute(SQL_PENDENTES, (user_token, ate_id, janela, limite)).fetchall()
+        return [(id_msg, ROLES_TEXTO[role], content) for id_msg, role, content in linhas]
+
+    def gravar_resumo(self, user_token: str, resumo: str, ate_id: int):
+        with self.pool.conexao() as conn:
+            conn.execute(SQL_GRAVAR_RESUMO, (resumo, ate_id, _agora(), user_token))
+
+    # --- Processo ---
+
+    def estatisticas_pool(self) -> dict:
+        return dict(self.pool.estatisticas(), backend=self.nome, caminho=self.pool.caminho)
+
+    def fechar(self):
+        self.pool.fechar()
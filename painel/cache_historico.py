@@ -0,0 +1,149 @@
+# painel/cache_historico.py - Cache write-through das últimas mensagens de cada conversa
+
+import os
+import threading
+from collections import OrderedDict, deque
+
+HISTORY_CACHE_MSGS = int(os.getenv("HISTORY_CACHE_MSGS", "40"))  # mensagens guardadas por conversa (ring buffer)
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # teto de memória do processo
+
+_OVERHEAD_MSG = 100  # bytes aproximados de dict/tupla por mensagem além do texto
+
+
+def _tamanho(content: str) -> int:
+    return len(content.encode("utf-8")) + _OVERHEAD_MSG
+
+
+class _Conversa:
+    __slots__ = ("msgs", "bytes", "completo", "base_id", "base_ts", "anexadas")
+
+    def __init__(self, maxlen: int):
+        self.msgs = deque(maxlen=maxlen)  # (id, role, content)
+        self.bytes = 0
+        self.completo = False  # True = o buffer tem a conversa inteira (menos msgs que o ring)
+        # Marco do último carregamento do banco: quantas msgs apareceram depois dele por ESTE
+        # processo. Se o banco tiver mais, outro worker escreveu e o cache está velho.
+        self.base_id = 0
+        self.base_ts = None
+        self.anexadas = 0
+
+
+class CacheHistorico:
+    """
+    Ring buffer por user_token com as mensagens mais recentes, com LRU entre
+    conversas limitado pelo total de bytes. Thread-safe.
+    """
+
+    def __init__(self, msgs_por_conversa: int = HISTORY_CACHE_MSGS, max_bytes: int = HISTORY_CACHE_MAX_BYTES):
+        self.msgs_por_conversa = max(1, msgs_por_conversa)
+        self.max_bytes = max_bytes
+        self._conversas = OrderedDict()  # user_token -> _Conversa
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "recargas": 0, "escritas": 0}
+
+    def cabe(self, limit: int) -> bool:
+        """O cache só atende pedidos de até msgs_por_conversa mensagens."""
+        return 0 < limit <= self.msgs_por_conversa
+
+    def obter(self, user_token: str, limit: int) -> list | None:
+        """Últimas `limit` mensagens como [{"role", "content"}], ou None se não estiver em cache."""
+        with self._lock:
+            conversa = self._conversas.get(user_token)
+            if conversa is None or not self.cabe(limit) or (len(conversa.msgs) < limit and not conversa.completo):
+                self._stats["misses"] += 1
+                return None
+            self._conversas.move_to_end(user_token)
+            self._stats["hits"] += 1
+            recentes = list(conversa.msgs)[-limit:]
+        return [{"role": role, "content": content} for _id, role, content in recentes]
+
+    def marco(self, user_token: str) -> tuple | None:
+        """(base_id, base_ts, anexadas) da conversa em cache, para o teste de frescor no banco."""
+        with self._lock:
+            conversa = self._conversas.get(user_token)
+            if conversa is None or conversa.base_ts is None:
+                return None
+            return conversa.base_id, conversa.base_ts, conversa.anexadas
+
+    def carregar(self, user_token: str, linhas: list, completo: bool):
+        """Substitui a conversa pelas `linhas` [(id, role, content, timestamp)] lidas do banco (ordem cronológica)."""
+        conversa = _Conversa(self.msgs_por_conversa)
+        for id_msg, role, content, _ts in linhas[-self.msgs_por_conversa:]:
+            conversa.msgs.append((id_msg, role, content))
+            conversa.bytes += _tamanho(content)
+        conversa.completo = completo and len(linhas) <= self.msgs_por_conversa
+        if linhas:
+            conversa.base_id, conversa.base_ts = linhas[-1][0], linhas[-1][3]
+        else:
+            conversa.base_id, conversa.base_ts = 0, None
+        with self._lock:
+            antiga = self._conversas.pop(user_token, None)
+            if antiga is not None:
+                self._bytes -= antiga.bytes
+            if linhas or completo:
+                self._conversas[user_token] = conversa
+                self._bytes += conversa.bytes
+            self._stats["recargas"] += 1
+            self._evictar()
+
+    def anexar(self, user_token: str, id_msg: int, role: str, content: str):
+        """Write-through: acrescenta uma mensagem recém-gravada se a conversa estiver em cache."""
+        with self._lock:
+            conversa = self._conversas.get(user_token)
+            if conversa is None:
+                return
+            if len(conversa.msgs) == conversa.msgs.maxlen:
+                _id, _role, velho = conversa.msgs[0]
+                conversa.bytes -= _tamanho(velho)
+                self._bytes -= _tamanho(velho)
+                conversa.completo = False
+            conversa.msgs.append((id_msg, role, content))
+            conversa.bytes += _tamanho(content)
+            conversa.anexadas += 1
+            self._bytes += _tamanho(content)
+            self._conversas.move_to_end(user_token)
+            self._stats["escritas"] += 1
+            self._evictar()
+
+    def invalidar(self, user_token: str):
+        with self._lock:
+            conversa = self._conversas.pop(user_token, None)
+            if conversa is not None:
+                self._bytes -= conversa.bytes
+
+    def _evictar(self):
+        # Chamado com o lock; remove as conversas menos usadas até caber no teto
+        while self._bytes > self.max_bytes and len(self._conversas) > 1:
+            _token, conversa = self._conversas.popitem(last=False)
+            self._bytes -= conversa.bytes
+            self._stats["evictions"] += 1
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["conversas"] = len(self._conversas)
+            stats["bytes"] = self._bytes
+        total = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / total if total else 0.0
+        stats["max_bytes"] = self.max_bytes
+        stats["msgs_por_conversa"] = self.msgs_por_conversa
+        return stats
+
+
+# --- Instância do processo (recriada após fork) ---
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def obter_cache() -> CacheHistorico:
+    global _cache, _cache_pid
+    pid = os.getpid()
+    if _cache is None or _cache_pid != pid:
+        with _cache_lock:
+            if _cache is None or _cache_pid != pid:
+                _cache = CacheHistorico()
+                _cache_pid = pid
+    return _cache
@@ -0,0 +1,163 @@
+# painel/cache_tokens.py - Cache em memória de token -> validade_em, invalidado via LISTEN/NOTIFY
+
+import os
+import time
+import select
+import logging
+import threading
+from collections import OrderedDict
+
+import psycopg2
+
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "60"))  # segundos; limite de desatualização se um NOTIFY se perder
+TOKEN_CACHE_MAX = int(os.getenv("TOKEN_CACHE_MAX", "10000"))  # entradas (LRU)
+CANAL_NOTIFY = "tokens_alterados"  # payload = token alterado, ou "*" para limpar tudo
+
+_AUSENTE = object()  # Marca "token não existe no banco" (cache negativo)
+
+
+class CacheTokens:
+    """
+    LRU com TTL de token -> validade_em (ou ausência do token).
+    Thread-safe; guarda contadores de hit/miss/invalidação.
+    """
+
+    def __init__(self, ttl: float = TOKEN_CACHE_TTL, max_entradas: int = TOKEN_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entradas = max(1, max_entradas)
+        self._dados = OrderedDict()  # token -> (validade_em | _AUSENTE, expira_monotonic)
+        self._lock = threading.Lock()
+        self._versao = 0  # Muda a cada invalidação: descarta leituras do banco que ficaram velhas no caminho
+        self._stats = {"hits": 0, "misses": 0, "invalidacoes": 0, "limpezas": 0, "evictions": 0}
+
+    def obter(self, token: str):
+        """Retorna (True, validade_em|None) num hit, (False, None) num miss. None = token inexistente."""
+        agora = time.monotonic()
+        with self._lock:
+            item = self._dados.get(token)
+            if item is None or item[1] <= agora:
+                if item is not None:
+                    del self._dados[token]
+                self._stats["misses"] += 1
+                return False, None
+            self._dados.move_to_end(token)
+            self._stats["hits"] += 1
+            valor = item[0]
+        return True, (None if valor is _AUSENTE else valor)
+
+    def versao(self) -> int:
+        """Leia antes de consultar o banco e passe para guardar()."""
+        with self._lock:
+            return self._versao
+
+    def guardar(self, token: str, validade_em, existe: bool = True, versao: int | None = None):
+        with self._lock:
+            if versao is not None and versao != self._versao:
+                return  # Houve invalidação durante a consulta: não guarda valor possivelmente velho
+            self._dados[token] = (validade_em if existe else _AUSENTE, time.monotonic() + self.ttl)
+            self._dados.move_to_end(token)
+            while len(self._dados) > self.max_entradas:
+                self._dados.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidar(self, token: str):
+        with self._lock:
+            self._dados.pop(token, None)
+            self._versao += 1
+            self._stats["invalidacoes"] += 1
+
+    def limpar(self):
+        with self._lock:
+            self._dados.clear()
+            self._versao += 1
+            self._stats["limpezas"] += 1
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entradas"] = len(self._dados)
+        total = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / total if total else 0.0
+        stats["ttl_s"] = self.ttl
+        stats["max_entradas"] = self.max_entradas
+        return stats
+
+
+class OuvinteInvalidacao(threading.Thread):
+    """
+    Thread que mantém uma conexão dedicada em LISTEN e invalida o cache a cada NOTIFY.
+    Se a conexão cair, limpa o cache (pode ter perdido avisos) e reconecta com backoff.
+    """
+
+    def __init__(self, dsn: str, cache: CacheTokens):
+        super().__init__(name="painel-token-listener", daemon=True)
+        self.dsn = dsn
+        self.cache = cache
+        self.conectado = False
+        self._parar = threading.Event()
+
+    def run(self):
+        espera = 1.0
+        while not self._parar.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CANAL_NOTIFY};")
+                # Avisos perdidos enquanto estava desconectado: começa do zero
+                self.cache.limpar()
+                self.conectado = True
+                espera = 1.0
+                logging.info(f"Ouvinte de invalidação de tokens conectado (LISTEN {CANAL_NOTIFY}).")
+                while not self._parar.is_set():
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        aviso = conn.notifies.pop(0)
+                        if aviso.payload in ("", "*"):
+                            self.cache.limpar()
+                        else:
+                            self.cache.invalidar(aviso.payload)
+            except Exception as e:
+                logging.warning(f"Ouvinte de invalidação de tokens caiu: {e}. Reconectando em {espera:.0f}s.")
+            finally:
+                self.conectado = False
+                self.cache.limpar()
+                if conn is not None and not conn.closed:
+                    conn.close()
+            self._parar.wait(espera)
+            espera = min(espera * 2, 30.0)
+
+    def parar(self):
+        self._parar.set()
+
+
+# --- Instâncias do processo (recriadas após fork) ---
+
+_cache = CacheTokens()
+_ouvinte = None
+_ouvinte_pid = None
+_ouvinte_lock = threading.Lock()
+
+
+def obter_cache(dsn: str | None = None) -> CacheTokens:
+    """Retorna o cache do processo, iniciando o ouvinte LISTEN/NOTIFY se ainda não estiver rodando."""
+    global _cache, _ouvinte, _ouvinte_pid
+    pid = os.getpid()
+    if dsn and _ouvinte_pid != pid:
+        with _ouvinte_lock:
+            if _ouvinte_pid != pid:
+                # Processo novo (fork do gunicorn): cache e thread não são herdados com segurança
+                _cache = CacheTokens()
+                _ouvinte = OuvinteInvalidacao(dsn, _cache)
+                _ouvinte.start()
+                _ouvinte_pid = pid
+    return _cache
+
+
+def estatisticas() -> dict:
+    stats = _cache.estatisticas()
+    stats["ouvinte_conectado"] = bool(_ouvinte and _ouvinte_pid == os.getpid() and _ouvinte.conectado)
+    return stats
@@ -0,0 +1,388 @@
+# painel/escrita.py - Gravação em segundo plano (write-behind) das mensagens do chat
+#
+# add_chat_message só enfileira a mensagem (com o horário em que ela chegou) e
+# volta. Uma thread por worker junta as mensagens de todas as requisições e as
+# grava com um INSERT de várias linhas quando a fila chega a ESCRITA_LOTE
+# mensagens ou a mais antiga espera ESCRITA_INTERVALO segundos.
+#
+# Se o banco falhar (fora do ar, pool esgotado, INSERT acima de ESCRITA_TIMEOUT),
+# o lote vai para um spool local só de acréscimo (uma mensagem JSON por linha).
+# A cada ESCRITA_RETENTATIVA segundos o spool é reenviado ao banco na ordem em
+# que foi escrito; enquanto houver spool pendente, os lotes novos entram no fim
+# dele em vez de passar na frente. Cada mensagem leva o próprio timestamp, então
+# a ordem da conversa no banco não depende de quando o lote foi gravado.
+#
+# A msg do usuário de um turno é gravada na hora, com o relógio do banco; a
+# resposta que vem depois sai da fila com o horário do banco daquela msg mais o
+# tempo decorrido (marcar_turno), não com o relógio do app. O histórico é
+# ordenado por timestamp, e uma diferença entre os dois relógios poria a
+# resposta antes da pergunta (ex.: resposta instantânea do cache).
+#
+# Antes de gravar o turno seguinte de uma conversa com mensagens ainda na fila,
+# o painel espera a gravação delas (aguardar_token): o histórico lido do banco e
+# o teste de frescor do cache de histórico continuam batendo.
+#
+# No shutdown (worker_exit do gunicorn via fechar_pool, ou atexit) a fila é
+# gravada no banco ou, se ele não responder, no spool. O spool de um processo
+# que morreu sem reenviá-lo (kill -9, queda da máquina) é adotado pelo próximo
+# worker que subir: cada processo mantém flock no próprio arquivo.
+#
+# Variáveis de ambiente:
+#   ESCRITA_ASSINCRONA   true (padrão) = write-behind; false = um INSERT síncrono por mensagem (modo antigo)
+#   ESCRITA_LOTE         mensagens por INSERT (padrão 200)
+#   ESCRITA_INTERVALO    segundos máximos de uma mensagem na fila (padrão 0.2)
+#   ESCRITA_TIMEOUT      statement_timeout do INSERT em lote, em segundos (padrão 2)
+#   ESCRITA_RETENTATIVA  segundos entre tentativas de reenviar o spool (padrão 5)
+#   ESCRITA_SPOOL_DIR    diretório dos spools (padrão <tmp>/clara_spool)
+
+import os
+import glob
+import json
+import time
+import atexit
+import logging
+import tempfile
+import threading
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem flock, cada processo só reenvia o próprio spool
+    fcntl = None
+
+ESCRITA_ASSINCRONA = os.getenv("ESCRITA_ASSINCRONA", "True").lower() in ['true', '1', 't']
+ESCRITA_LOTE = max(1, int(os.getenv("ESCRITA_LOTE", "200")))
+ESCRITA_INTERVALO = float(os.getenv("ESCRITA_INTERVALO", "0.2"))
+ESCRITA_TIMEOUT = float(os.getenv("ESCRITA_TIMEOUT", "2"))
+ESCRITA_RETENTATIVA = float(os.getenv("ESCRITA_RETENTATIVA", "5"))
+ESCRITA_SPOOL_DIR = os.getenv("ESCRITA_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "clara_spool"))
+
+PADRAO_SPOOL = "mensagens-*.jsonl"
+TURNOS_MAX = 10000  # conversas com turno marcado à espera da resposta (as mais antigas saem)
+
+
+class Spool:
+    """
+    Arquivo só de acréscimo com as mensagens não gravadas ([token, role, content, ts]
+    em JSON por linha) e, ao lado (.pos), o byte até onde ele já foi reenviado.
+    Quem abre o arquivo segura um flock exclusivo até fechá-lo.
+    """
+
+    def __init__(self, caminho: str):
+        self.caminho = caminho
+        self.caminho_pos = caminho + ".pos"
+        self._arquivo = None
+        self._pos = 0
+
+    def abrir(self) -> bool:
+        """Abre (criando) e trava o arquivo; False se outro processo vivo já o tem."""
+        if self._arquivo is not None:
+            return True
+        os.makedirs(os.path.dirname(self.caminho) or ".", exist_ok=True)
+        arquivo = open(self.caminho, "a+b")
+        if fcntl is not None:
+            try:
+                fcntl.flock(arquivo.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                arquivo.close()
+                return False
+        self._arquivo = arquivo
+        try:
+            with open(self.caminho_pos, "r") as f:
+                self._pos = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            self._pos = 0
+        return True
+
+    def pendente(self) -> bool:
+        return self._arquivo is not None and os.fstat(self._arquivo.fileno()).st_size > self._pos
+
+    def anexar(self, mensagens: list):
+        if not self.abrir():
+            raise OSError(f"Spool {self.caminho} travado por outro processo")
+        linhas = b"".join(
+            json.dumps([token, role, content, ts.isoformat()], ensure_ascii=False).encode() + b"\n"
+            for token, role, content, ts in mensagens
+        )
+        self._arquivo.seek(0, os.SEEK_END)
+        self._arquivo.write(linhas)
+        self._arquivo.flush()
+        os.fsync(self._arquivo.fileno())
+
+    def ler(self, limite: int) -> tuple[list, int]:
+        """Até `limite` mensagens a partir da posição já reenviada, e a posição depois delas."""
+        self._arquivo.seek(self._pos)
+        mensagens = []
+        pos = self._pos
+        while len(mensagens) < limite:
+            linha = self._arquivo.readline()
+            if not linha:
+                break
+            pos += len(linha)
+            if not linha.endswith(b"\n"):
+                # Só acontece se o processo caiu no meio de uma escrita (anexar e ler não se cruzam)
+                logging.warning(f"Última linha cortada ignorada no spool {self.caminho} ({len(linha)} bytes).")
+                break
+            try:
+                token, role, content, ts = json.loads(linha)
+                mensagens.append((token, role, content, datetime.fromisoformat(ts)))
+            except (ValueError, TypeError):
+                logging.warning(f"Linha inválida ignorada no spool {self.caminho} (byte {pos - len(linha)}).")
+        return mensagens, pos
+
+    def avancar(self, pos: int):
+        """Marca como reenviado até `pos`; com tudo reenviado o arquivo volta a ficar vazio."""
+        if pos >= os.fstat(self._arquivo.fileno()).st_size:
+            self._arquivo.truncate(0)
+            pos = 0
+        temporario = self.caminho_pos + ".tmp"
+        with open(temporario, "w") as f:
+            f.write(str(pos))
+        os.replace(temporario, self.caminho_pos)
+        self._pos = pos
+
+    def fechar(self, remover: bool = False):
+        if self._arquivo is None:
+            return
+        if remover:
+            for caminho in (self.caminho, self.caminho_pos):
+                try:
+                    os.remove(caminho)
+                except FileNotFoundError:
+                    pass
+        self._arquivo.close()  # Solta o flock
+        self._arquivo = None
+
+
+def _processo_vivo(caminho: str) -> bool:
+    """O pid no nome do spool (mensagens-<pid>.jsonl) ainda existe? Evita adotar um arquivo que o dono está abrindo."""
+    try:
+        pid = int(os.path.basename(caminho).split("-", 1)[1].split(".", 1)[0])
+        os.kill(pid, 0)
+    except (ValueError, IndexError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True  # Existe, mas é de outro usuário
+    return True
+
+
+class EscritorMensagens(threading.Thread):
+    """Thread do worker que grava em lote as mensagens enfileiradas pelo /chat."""
+
+    def __init__(self, gravar_lote, diretorio: str = ESCRITA_SPOOL_DIR):
+        super().__init__(name="painel-escritor", daemon=True)
+        self.gravar_lote = gravar_lote  # [(token, role, content, datetime)] -> None; levanta exceção em erro de BD
+        self.diretorio = diretorio
+        self.spool = Spool(os.path.join(diretorio, f"mensagens-{os.getpid()}.jsonl"))
+        self._adotados = []  # Spools de processos mortos, reenviados antes de serem apagados
+        self._fila = deque()
+        self._por_token = Counter()  # Mensagens ainda não gravadas por token (inclui o lote em gravação)
+        self._turnos = {}  # token -> (horário do banco da msg do usuário, time.monotonic() de quando voltou)
+        self._cond = threading.Condition()
+        self._gravando = threading.Lock()  # Um lote por vez, da thread ou de quem chamou descarregar()
+        self._parar = False
+        self._proxima_tentativa = 0.0
+        self.stats = {"enfileiradas": 0, "gravadas": 0, "lotes": 0, "maior_lote": 0, "falhas": 0,
+                      "para_spool": 0, "reenviadas": 0, "perdidas": 0, "spools_adotados": 0}
+
+    def marcar_turno(self, user_token: str, momento: datetime):
+        """Guarda o horário (do banco) da msg do usuário recém-gravada; a próxima msg enfileirada da conversa sai depois dele."""
+        with self._cond:
+            self._turnos.pop(user_token, None)
+            self._turnos[user_token] = (momento, time.monotonic())
+            while len(self._turnos) > TURNOS_MAX:
+                self._turnos.pop(next(iter(self._turnos)))
+
+    def enfileirar(self, user_token: str, role: str, content: str):
+        with self._cond:
+            turno = self._turnos.pop(user_token, None)
+            if turno is not None:
+                momento = turno[0] + timedelta(seconds=max(time.monotonic() - turno[1], 0.001))
+            else:
+                momento = datetime.now(timezone.utc)
+            self._fila.append((user_token, role, content, momento))
+            self._por_token[user_token] += 1
+            self.stats["enfileiradas"] += 1
+            tamanho = len(self._fila)
+            if tamanho == 1 or tamanho >= ESCRITA_LOTE:
+                self._cond.notify()
+            encerrado = self._parar
+        if encerrado:
+            self.descarregar()  # Depois do shutdown não há thread: grava na hora
+
+    def pendente(self, user_token: str) -> bool:
+        with self._cond:
+            return self._por_token.get(user_token, 0) > 0
+
+    def aguardar_token(self, user_token: str):
+        """Se a conversa tem mensagens na fila, grava a fila agora (ou espera o lote em andamento)."""
+        if self.pendente(user_token):
+            self.descarregar()
+
+    def run(self):
+        self._reenviar_spools()
+        while True:
+            with self._cond:
+                if not self._fila and not self._parar:
+                    self._cond.wait(ESCRITA_RETENTATIVA)
+                if self._fila and len(self._fila) < ESCRITA_LOTE and not self._parar:
+                    self._cond.wait(ESCRITA_INTERVALO)  # Junta as mensagens de outras requisições
+                if self._parar:
+                    return
+            try:
+                self.descarregar()
+                if time.monotonic() >= self._proxima_tentativa:
+                    self._reenviar_spools()
+            except Exception:
+                logging.exception("Erro inesperado na thread de escrita de mensagens")
+
+    def descarregar(self):
+        """Grava tudo o que está na fila agora (no banco ou, se ele falhar, no spool)."""
+        with self._gravando:
+            while True:
+                with self._cond:
+                    lote = [self._fila.popleft() for _ in range(min(len(self._fila), ESCRITA_LOTE))]
+                if not lote:
+                    return
+                try:
+                    self._gravar(lote)
+                finally:
+                    with self._cond:
+                        self._por_token.subtract(m[0] for m in lote)
+                        self._por_token += Counter()  # Remove as contagens zeradas
+
+    def _gravar(self, lote: list):
+        if self.spool.pendente():
+            self._para_spool(lote)  # Não passa na frente do que já está no spool
+            return
+        try:
+            self.gravar_lote(lote)
+        except Exception as e:
+            self.stats["falhas"] += 1
+            self._proxima_tentativa = time.monotonic() + ESCRITA_RETENTATIVA
+            logging.warning(f"Gravação de {len(lote)} msg(s) falhou; indo para o spool {self.spool.caminho}: {e}")
+            self._para_spool(lote)
+            return
+        self.stats["gravadas"] += len(lote)
+        self.stats["lotes"] += 1
+        self.stats["maior_lote"] = max(self.stats["maior_lote"], len(lote))
+
+    def _para_spool(self, lote: list):
+        try:
+            self.spool.anexar(lote)
+            self.stats["para_spool"] += len(lote)
+        except OSError:
+            self.stats["perdidas"] += len(lote)
+            logging.exception(f"Não foi possível gravar {len(lote)} msg(s) no spool {self.spool.caminho}. Mensagens perdidas.")
+
+    def _adotar_orfaos(self):
+        if fcntl is None:
+            return
+        em_uso = {self.spool.caminho} | {spool.caminho for spool in self._adotados}
+        for caminho in sorted(glob.glob(os.path.join(self.diretorio, PADRAO_SPOOL))):
+            if caminho in em_uso or _processo_vivo(caminho):
+                continue
+            orfao = Spool(caminho)
+            try:
+                if not orfao.abrir():
+                    continue  # O dono está vivo
+            except OSError:
+                continue
+            self._adotados.append(orfao)
+            self.stats["spools_adotados"] += 1
+            logging.info(f"Spool de mensagens adotado: {caminho}")
+
+    def _reenviar_spools(self):
+        """Reenvia os spools (os adotados primeiro), na ordem do arquivo; para no primeiro erro."""
+        with self._gravando:
+            self._adotar_orfaos()
+            if not self.spool.abrir():
+                return
+            for spool in list(self._adotados) + [self.spool]:
+                while spool.pendente():
+                    mensagens, pos = spool.ler(ESCRITA_LOTE)
+                    try:
+                        if mensagens:
+                            self.gravar_lote(mensagens)
+                    except Exception as e:
+                        self.stats["falhas"] += 1
+                        self._proxima_tentativa = time.monotonic() + ESCRITA_RETENTATIVA
+                        logging.warning(f"Reenvio do spool {spool.caminho} falhou; nova tentativa em {ESCRITA_RETENTATIVA:.0f}s: {e}")
+                        return
+                    spool.avancar(pos)
+                    self.stats["reenviadas"] += len(mensagens)
+                    logging.info(f"Spool {spool.caminho}: {len(mensagens)} msg(s) reenviada(s) ao banco.")
+                if spool is not self.spool:
+                    spool.fechar(remover=True)
+                    self._adotados.remove(spool)
+            self._proxima_tentativa = time.monotonic() + ESCRITA_RETENTATIVA
+
+    def parar(self, timeout: float = 10):
+        """Para a thread e grava o que restou na fila (banco ou spool)."""
+        with self._cond:
+            self._parar = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join(timeout)
+        self.descarregar()
+        with self._gravando:
+            for spool in self._adotados:
+                spool.fechar()
+            self._adotados = []
+            self.spool.fechar(remover=not self.spool.pendente())
+
+    def estatisticas(self) -> dict:
+        with self._cond:
+            stats = dict(self.stats, na_fila=len(self._fila))
+        stats["spool_pendente"] = self.spool.pendente()
+        stats["spools_adotados_pendentes"] = len(self._adotados)
+        return stats
+
+
+# --- Escritor do processo (criado sob demanda, recriado após fork) ---
+
+_escritor = None
+_escritor_pid = None
+_escritor_lock = threading.Lock()
+
+
+def obter_escritor(gravar_lote) -> EscritorMensagens:
+    """Escritor do processo atual; a thread sobe na primeira mensagem de cada worker."""
+    global _escritor, _escritor_pid
+    pid = os.getpid()
+    if _escritor is not None and _escritor_pid == pid:
+        return _escritor
+    with _escritor_lock:
+        if _escritor is None or _escritor_pid != pid:
+            _escritor = EscritorMensagens(gravar_lote)
+            _escritor.start()
+            _escritor_pid = pid
+            atexit.register(encerrar)
+            logging.info(f"Escrita de mensagens em lote ligada (pid={pid}, lote={ESCRITA_LOTE}, intervalo={ESCRITA_INTERVALO}s, spool={_escritor.spool.caminho}).")
+    return _escritor
+
+
+def aguardar_token(user_token: str):
+    """Garante que as mensagens enfileiradas da conversa estão no banco (no-op se não houver)."""
+    escritor = _escritor
+    if escritor is not None and _escritor_pid == os.getpid():
+        escritor.aguardar_token(user_token)
+
+
+def encerrar():
+    """Grava a fila (banco ou spool) e para a thread; chamado no shutdown do worker."""
+    global _escritor, _escritor_pid
+    with _escritor_lock:
+        escritor = _escritor if _escritor_pid == os.getpid() else None
+        _escritor = None
+        _escritor_pid = None
+    if escritor is not None:
+        escritor.parar()
+        logging.info(f"Escrita de mensagens encerrada: {escritor.estatisticas()}")
+
+
+def estatisticas() -> dict:
+    if _escritor is None or _escritor_pid != os.getpid():
+        return {"ativo": False, "assincrona": ESCRITA_ASSINCRONA}
+    return dict(_escritor.estatisticas(), ativo=True, assincrona=ESCRITA_ASSINCRONA)
@@ -0,0 +1,77 @@
+# painel/esquema.py - Esquema compacto das tabelas de chat (token_id INTEGER + role SMALLINT)
+#
+# chat_messages e chat_resumos referenciam tokens(id) em vez de repetir o token
+# TEXT (22+ bytes por linha e por entrada de índice) e apagam junto com o token
+# (ON DELETE CASCADE). O role vira SMALLINT; as queries devolvem o texto de
+# sempre ('user'/'assistant'), então a API do painel não muda.
+
+import logging
+
+CHAVE_LOCK_ESQUEMA = 727014  # pg_advisory_xact_lock: um processo por vez altera o esquema
+
+ROLES = {"user": 1, "assistant": 2}
+SQL_ROLE_TEXTO = "CASE role WHEN 1 THEN 'user' ELSE 'assistant' END"
+
+
+def colunas(cur, tabela: str) -> set:
+    """Nomes das colunas da tabela (vazio se ela não existir)."""
+    cur.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+    """, (tabela,))
+    return {linha[0] for linha in cur.fetchall()}
+
+
+def _compactar_mensagens(cur):
+    cur.execute("LOCK TABLE chat_messages IN ACCESS EXCLUSIVE MODE")
+    cur.execute("ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS token_id INTEGER")
+    cur.execute("UPDATE chat_messages m SET token_id = t.id FROM tokens t WHERE t.token = m.user_token")
+    cur.execute("DELETE FROM chat_messages WHERE token_id IS NULL")  # Órfãs de tokens já excluídos
+    orfas = cur.rowcount
+    cur.execute("ALTER TABLE chat_messages ALTER COLUMN token_id SET NOT NULL")
+    # O CHECK de role (texto) existe no pai e, se veio da tabela antiga, também na partição legado
+    cur.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'chat_messages'::regclass")
+    particoes = [linha[0] for linha in cur.fetchall()]
+    for tabela in ["chat_messages"] + particoes:
+        cur.execute(f"ALTER TABLE {tabela} DROP CONSTRAINT IF EXISTS chat_messages_role_check")
+    cur.execute("""
+        ALTER TABLE chat_messages ALTER COLUMN role TYPE SMALLINT
+        USING (CASE role WHEN 'user' THEN 1 ELSE 2 END)
+    """)
+    cur.execute("ALTER TABLE chat_messages ADD CONSTRAINT chat_messages_role_check CHECK (role IN (1, 2))")
+    cur.execute("ALTER TABLE chat_messages DROP COLUMN user_token")  # Leva junto idx_chat_msgs_user_token_ts
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_msgs_token_ts ON chat_messages (token_id, timestamp DESC)")
+    cur.execute("""
+        ALTER TABLE chat_messages ADD CONSTRAINT chat_messages_token_id_fkey
+        FOREIGN KEY (token_id) REFERENCES tokens(id) ON DELETE CASCADE
+    """)
+    logging.info(f"'chat_messages' migrada para token_id/role SMALLINT ({orfas} msg(s) órfã(s) removida(s)).")
+
+
+def _compactar_resumos(cur):
+    cur.execute("LOCK TABLE chat_resumos IN ACCESS EXCLUSIVE MODE")
+    cur.execute("ALTER TABLE chat_resumos ADD COLUMN IF NOT EXISTS token_id INTEGER")
+    cur.execute("UPDATE chat_resumos r SET token_id = t.id FROM tokens t WHERE t.token = r.user_token")
+    cur.execute("DELETE FROM chat_resumos WHERE token_id IS NULL")
+    cur.execute("ALTER TABLE chat_resumos DROP COLUMN user_token")  # Leva junto a PK antiga
+    cur.execute("ALTER TABLE chat_resumos ADD PRIMARY KEY (token_id)")
+    cur.execute("""
+        ALTER TABLE chat_resumos ADD CONSTRAINT chat_resumos_token_id_fkey
+        FOREIGN KEY (token_id) REFERENCES tokens(id) ON DELETE CASCADE
+    """)
+    logging.info("'chat_resumos' migrada para token_id.")
+
+
+def compactar(cur):
+    """
+    Migra, dentro da transação do chamador, tabelas ainda no formato antigo
+    (user_token TEXT / role TEXT) e remove os índices de 'tokens' que duplicavam
+    as constraints UNIQUE. Não faz nada se já estiver tudo no formato novo.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (CHAVE_LOCK_ESQUEMA,))
+    if "user_token" in colunas(cur, "chat_messages"):
+        _compactar_mensagens(cur)
+    if "user_token" in colunas(cur, "chat_resumos"):
+        _compactar_resumos(cur)
+    cur.execute("DROP INDEX IF EXISTS idx_tokens_token")
+    cur.execute("DROP INDEX IF EXISTS idx_tokens_telefone")
@@ -0,0 +1,104 @@
+# painel/idempotencia.py - Chaves de idempotência das mensagens do /chat
+#
+# O cliente manda uma chave por mensagem (header Idempotency-Key) e a repete nos
+# reenvios. A primeira requisição reserva a chave em 'chat_idempotencia' e, ao
+# terminar, guarda ali a resposta da IA; as repetidas recebem essa resposta em
+# vez de gravar a mensagem e chamar a IA de novo. A espera pela original e a
+# liberação da reserva em caso de falha ficam no app (app.py).
+#
+# 'mensagem_gravada' é ligada na mesma transação que grava a msg do usuário
+# (registrar_turno_chat com a chave). Se a requisição falha depois disso (IA
+# fora do ar...), a reserva não é apagada: fica com criado_em recuado até o
+# limite de abandono, e o reenvio a assume na hora, sem gravar a msg de novo -
+# só relê o histórico (que já a tem) e chama a IA.
+#
+# Variáveis de ambiente:
+#   IDEMPOTENCIA_ABANDONO   segundos sem resposta até outra requisição poder assumir a chave
+#                           (a original morreu com o worker; padrão 180, acima do GUNICORN_TIMEOUT)
+#   IDEMPOTENCIA_TTL_HORAS  horas que as chaves ficam guardadas (padrão 24; apagadas na manutenção)
+
+import os
+
+IDEMPOTENCIA_ABANDONO = float(os.getenv("IDEMPOTENCIA_ABANDONO", "180"))
+IDEMPOTENCIA_TTL_HORAS = float(os.getenv("IDEMPOTENCIA_TTL_HORAS", "24"))
+
+SQL_CRIAR_TABELA = """
+    CREATE TABLE IF NOT EXISTS chat_idempotencia (
+        token_id INTEGER NOT NULL REFERENCES tokens(id) ON DELETE CASCADE,
+        chave TEXT NOT NULL,
+        resposta TEXT,  -- NULL = a requisição original ainda está em andamento
+        criado_em TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (token_id, chave)
+    );
+    CREATE INDEX IF NOT EXISTS idx_chat_idempotencia_criado ON chat_idempotencia (criado_em);
+"""
+
+# Reserva a chave (ou assume uma abandonada) numa ida ao banco e devolve
+# (token existe, reservou, resposta já guardada). O SELECT final vê o estado de
+# antes do INSERT: se reservou, a resposta não importa.
+SQL_RESERVAR = """
+    WITH tok AS (
+        SELECT id FROM tokens WHERE token = $1::text
+    ), nova AS (
+        INSERT INTO chat_idempotencia (token_id, chave)
+        SELECT id, $2::text FROM tok
+        ON CONFLICT (token_id, chave) DO UPDATE SET criado_em = now()
+            WHERE chat_idempotencia.resposta IS NULL
+              AND chat_idempotencia.criado_em < now() - make_interval(secs => $3::float8)
+        RETURNING token_id
+    )
+    SELECT EXISTS (SELECT 1 FROM tok), EXISTS (SELECT 1 FROM nova),
+           (SELECT resposta FROM chat_idempotencia WHERE token_id = (SELECT id FROM tok) AND chave = $2::text)
+"""
+
+# Migração 6: bancos com a tabela da migração 5 ganham a coluna
+SQL_COLUNA_MENSAGEM = """
+    ALTER TABLE chat_idempotencia ADD COLUMN IF NOT EXISTS mensagem_gravada BOOLEAN NOT NULL DEFAULT false
+"""
+
+# Marca a msg do usuário como gravada (na transação do turno) e devolve o valor
+# de antes: true = uma tentativa anterior já a gravou; sem linha = sem reserva.
+SQL_MARCAR_MENSAGEM = """
+    WITH antes AS (
+        SELECT token_id, mensagem_gravada FROM chat_idempotencia
+        WHERE token_id = (SELECT id FROM tokens WHERE token = $1::text) AND chave = $2::text
+        FOR UPDATE
+    )
+    UPDATE chat_idempotencia i SET mensagem_gravada = true
+    FROM antes
+    WHERE i.token_id = antes.token_id AND i.chave = $2::text
+    RETURNING antes.mensagem_gravada
+"""
+
+SQL_CONCLUIR = """
+    UPDATE chat_idempotencia SET resposta = $3::text
+    WHERE token_id = (SELECT id FROM tokens WHERE token = $1::text) AND chave = $2::text
+"""
+
+# Sem msg gravada a reserva é apagada; com ela, só fica livre para o reenvio assumir
+SQL_LIBERAR = """
+    WITH tok AS (
+        SELECT id FROM tokens WHERE token = $1::text
+    ), apagada AS (
+        DELETE FROM chat_idempotencia
+        WHERE token_id = (SELECT id FROM tok) AND chave = $2::text AND resposta IS NULL AND NOT mensagem_gravada
+        RETURNING 1
+    )
+    UPDATE chat_idempotencia SET criado_em = now() - make_interval(secs => $3::float8)
+    WHERE token_id = (SELECT id FROM tok) AND chave = $2::text AND resposta IS NULL AND mensagem_gravada
+"""
+
+SQL_EXPURGAR = "DELETE FROM chat_idempotencia WHERE criado_em < now() - make_interval(secs => %s)"
+
+
+def estado(token_existe: bool, reservou: bool, resposta: str | None) -> str:
+    """'nova' (esta requisição processa a mensagem), 'concluida' ou 'andamento'."""
+    if not token_existe or reservou:
+        return "nova"  # Token inexistente: o turno do chat é que recusa a requisição
+    return "concluida" if resposta is not None else "andamento"
+
+
+def expurgar(cur) -> int:
+    """Apaga as chaves mais velhas que IDEMPOTENCIA_TTL_HORAS; retorna quantas."""
+    cur.execute(SQL_EXPURGAR, (IDEMPOTENCIA_TTL_HORAS * 3600,))
+    return cur.rowcount
@@ -0,0 +1,152 @@
+# painel/importacao.py - Importação de tokens em lote (CSV/NDJSON) via COPY para uma tabela de staging
+#
+# O arquivo é lido em streaming, cada linha válida ganha um token e vai para a
+# tabela temporária 'tokens_importacao' por COPY, em blocos de IMPORT_BLOCO linhas
+# (com aviso de progresso). Depois um único INSERT ... SELECT ... ON CONFLICT
+# move tudo para 'tokens' e devolve a situação de cada linha (o relatório).
+
+import io
+import os
+import csv
+import json
+import codecs
+import secrets
+import logging
+
+IMPORT_BLOCO = int(os.getenv("IMPORT_BLOCO", "5000"))  # linhas por COPY (e por aviso de progresso)
+IMPORT_MAX_DIAS = 3650
+
+SQL_CRIAR_STAGING = """
+    CREATE TEMP TABLE tokens_importacao (
+        linha INTEGER NOT NULL,
+        nome TEXT NOT NULL,
+        telefone TEXT NOT NULL,
+        token TEXT NOT NULL,
+        dias INTEGER NOT NULL
+    ) ON COMMIT DROP
+"""
+
+SQL_COPY_STAGING = "COPY tokens_importacao (linha, nome, telefone, token, dias) FROM STDIN WITH (FORMAT csv)"
+
+# Um telefone repetido no arquivo fica só na primeira linha; o resto é conflito.
+# ON CONFLICT sem alvo cobre telefone e token (UNIQUE) já existentes em 'tokens'.
+SQL_IMPORTAR = """
+    WITH candidatos AS (
+        SELECT DISTINCT ON (telefone) linha, nome, telefone, token, dias
+        FROM tokens_importacao
+        ORDER BY telefone, linha
+    ), inseridos AS (
+        INSERT INTO tokens (nome, telefone, token, criado_em, validade_em)
+        SELECT nome, telefone, token, now(), now() + make_interval(days => dias)
+        FROM candidatos
+        ORDER BY linha
+        ON CONFLICT DO NOTHING
+        RETURNING token
+    )
+    SELECT i.linha, i.nome, i.telefone,
+           CASE WHEN n.token IS NOT NULL THEN i.token END,
+           CASE WHEN n.token IS NOT NULL THEN 'inserido'
+                WHEN c.linha IS NULL THEN 'telefone repetido no arquivo'
+                ELSE 'telefone já cadastrado' END
+    FROM tokens_importacao i
+    LEFT JOIN candidatos c ON c.linha = i.linha
+    LEFT JOIN inseridos n ON n.token = i.token
+    ORDER BY i.linha
+"""
+
+
+def ler_registros(arquivo, formato: str):
+    """
+    Gera (numero_linha, dict) a partir de um arquivo binário.
+    CSV precisa de cabeçalho com 'nome' e 'telefone' ('dias_validade' opcional),
+    separado por vírgula ou ponto e vírgula. NDJSON: um objeto JSON por linha.
+    """
+    texto = codecs.getreader("utf-8-sig")(arquivo, errors="replace")
+    if formato == "ndjson":
+        for numero, bruta in enumerate(texto, start=1):
+            if not bruta.strip():
+                continue
+            try:
+                registro = json.loads(bruta)
+            except json.JSONDecodeError:
+                yield numero, None
+                continue
+            yield numero, registro if isinstance(registro, dict) else None
+        return
+    cabecalho = texto.readline()
+    delimitador = ";" if cabecalho.count(";") > cabecalho.count(",") else ","
+    campos = [c.strip().lower() for c in next(csv.reader([cabecalho], delimiter=delimitador), [])]
+    for numero, valores in enumerate(csv.reader(texto, delimiter=delimitador), start=2):
+        if not any(v.strip() for v in valores):
+            continue
+        yield numero, dict(zip(campos, valores))
+
+
+def validar_registro(registro: dict | None, dias_padrao: int) -> tuple[tuple | None, str | None]:
+    """Retorna ((nome, telefone, dias), None) ou (None, motivo)."""
+    if registro is None:
+        return None, "linha mal formada"
+    nome = str(registro.get("nome") or "").strip()
+    telefone = str(registro.get("telefone") or "").strip()
+    if not nome or not telefone:
+        return None, "nome/telefone vazio"
+    dias = registro.get("dias_validade")
+    if dias in (None, ""):
+        dias = dias_padrao
+    try:
+        dias = int(dias)
+    except (TypeError, ValueError):
+        return None, "dias_validade inválido"
+    if not 0 < dias <= IMPORT_MAX_DIAS:
+        return None, "dias_validade fora do intervalo"
+    return (nome, telefone, dias), None
+
+
+def importar(cur, arquivo, formato: str, dias_padrao: int, progresso=None) -> dict:
+    """
+    Carrega o arquivo na staging e insere em 'tokens' dentro da transação do cursor
+    (o commit fica com quem chamou). `progresso(etapa, linhas)` é chamado a cada bloco.
+    Retorna {"linhas": [(linha, nome, telefone, token|None, situacao)], "inseridos", "conflitos", "invalidos"}.
+    """
+    cur.execute(SQL_CRIAR_STAGING)
+    invalidas = []
+    bloco = io.StringIO()
+    escritor = csv.writer(bloco)
+    no_bloco = copiadas = 0
+
+    def enviar_bloco():
+        nonlocal bloco, escritor, no_bloco, copiadas
+        bloco.seek(0)
+        cur.copy_expert(SQL_COPY_STAGING, bloco)
+        copiadas += no_bloco
+        bloco = io.StringIO()
+        escritor = csv.writer(bloco)
+        no_bloco = 0
+        if progresso:
+            progresso("copiadas", copiadas)
+
+    for numero, registro in ler_registros(arquivo, formato):
+        valido, motivo = validar_registro(registro, dias_padrao)
+        if valido is None:
+            nome = str((registro or {}).get("nome") or "")
+            telefone = str((registro or {}).get("telefone") or "")
+            invalidas.append((numero, nome, telefone, None, motivo))
+            continue
+        nome, telefone, dias = valido
+        escritor.writerow((numero, nome, telefone, secrets.token_urlsafe(16), dias))
+        no_bloco += 1
+        if no_bloco >= IMPORT_BLOCO:
+            enviar_bloco()
+    if no_bloco:
+        enviar_bloco()
+
+    cur.execute(SQL_IMPORTAR)
+    linhas = cur.fetchall()
+    inseridos = sum(1 for linha in linhas if linha[3] is not None)
+    if progresso:
+        progresso("inseridas", inseridos)
+
+    linhas = sorted(linhas + invalidas, key=lambda linha: linha[0])
+    logging.info(f"Importação de tokens: {copiadas} linha(s) válidas, {inseridos} inserida(s), "
+                 f"{copiadas - inseridos} conflito(s), {len(invalidas)} inválida(s).")
+    return {"linhas": linhas, "inseridos": inseridos, "conflitos": copiadas - inseridos, "invalidos": len(invalidas)}
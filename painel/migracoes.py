@@ -0,0 +1,146 @@
+# painel/migracoes.py - Migrações versionadas do esquema do painel
+#
+# O DDL não roda mais na importação do app (cada worker, a cada boot). Ele roda
+# uma vez por deploy com:
+#   python -m painel migrate
+# (no Heroku, pela fase 'release' do Procfile). Execuções simultâneas são
+# serializadas por pg_advisory_lock; cada migração roda na sua transação e é
+# registrada em 'schema_migrations'. Os workers só conferem a versão ao subir.
+#
+# Migrações novas entram SEMPRE no fim de MIGRACOES, com a próxima versão.
+# As primeiras são idempotentes (IF NOT EXISTS) porque bancos já em produção
+# chegaram aqui sem 'schema_migrations'.
+
+import time
+import logging
+
+import psycopg2
+
+from . import esquema
+from . import particoes
+from . import resumos
+from . import idempotencia
+
+CHAVE_LOCK_MIGRACOES = 727016
+
+SQL_CRIAR_CONTROLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        versao INTEGER PRIMARY KEY,
+        nome TEXT NOT NULL,
+        aplicada_em TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+SQL_VERSAO = """
+    SELECT CASE WHEN to_regclass('schema_migrations') IS NULL THEN NULL
+                ELSE (SELECT max(versao) FROM schema_migrations) END
+"""
+
+
+def _tokens(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS tokens (
+            id SERIAL PRIMARY KEY,
+            nome TEXT NOT NULL,
+            telefone TEXT NOT NULL UNIQUE,
+            token TEXT NOT NULL UNIQUE,
+            criado_em TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            validade_em TIMESTAMP WITH TIME ZONE
+        );
+    """)
+    # Painel: ordem/paginação, filtro de status e busca por prefixo (LIKE 'x%' só usa índice com text_pattern_ops)
+    cur.execute(""" CREATE INDEX IF NOT EXISTS idx_tokens_criado_id ON tokens (criado_em DESC, id DESC); """)
+    cur.execute(""" CREATE INDEX IF NOT EXISTS idx_tokens_validade ON tokens (validade_em); """)
+    cur.execute(""" CREATE INDEX IF NOT EXISTS idx_tokens_telefone_prefixo ON tokens (telefone text_pattern_ops); """)
+    cur.execute(""" CREATE INDEX IF NOT EXISTS idx_tokens_token_prefixo ON tokens (token text_pattern_ops); """)
+
+
+def _busca_nome_trgm(cur):
+    # Busca por parte do nome (ILIKE '%x%') precisa de trigramas; opcional se a extensão não puder ser criada
+    cur.execute("SAVEPOINT trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute(""" CREATE INDEX IF NOT EXISTS idx_tokens_nome_trgm ON tokens USING gin (nome gin_trgm_ops); """)
+        cur.execute("RELEASE SAVEPOINT trgm")
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT trgm")
+        logging.warning(f"pg_trgm indisponível ({e.pgcode}); busca por nome sem índice.")
+
+
+def _chat(cur):
+    # Formato antigo (user_token TEXT) -> token_id; depois particionamento mensal
+    esquema.compactar(cur)
+    particoes.garantir_estrutura(cur)
+    cur.execute(resumos.SQL_CRIAR_TABELA)
+
+
+def _limites_taxa(cur):
+    # Baldes do limite de taxa por token (consumir_ficha_taxa). UNLOGGED: sem WAL,
+    # e perder os baldes numa queda do Postgres só zera os limites.
+    cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS limites_taxa (
+            chave TEXT PRIMARY KEY,
+            fichas DOUBLE PRECISION NOT NULL,
+            atualizado_em TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+    """)
+
+
+def _idempotencia(cur):
+    cur.execute(idempotencia.SQL_CRIAR_TABELA)
+
+
+def _idempotencia_mensagem(cur):
+    cur.execute(idempotencia.SQL_COLUNA_MENSAGEM)
+
+
+# (versão, nome, função(cur)) - nunca reordenar nem editar uma já publicada
+MIGRACOES = [
+    (1, "tokens", _tokens),
+    (2, "busca_nome_trgm", _busca_nome_trgm),
+    (3, "chat_compacto_particionado", _chat),
+    (4, "limites_taxa", _limites_taxa),
+    (5, "chat_idempotencia", _idempotencia),
+    (6, "chat_idempotencia_mensagem", _idempotencia_mensagem),
+]
+VERSAO_ATUAL = MIGRACOES[-1][0]
+
+
+def versao_banco(cur) -> int:
+    """Maior migração aplicada (0 se o controle ainda não existir). Uma consulta só."""
+    cur.execute(SQL_VERSAO)
+    versao = cur.fetchone()[0]
+    return versao or 0
+
+
+def migrar(conn) -> list[int]:
+    """
+    Aplica as migrações pendentes, cada uma na sua transação.
+    Bloqueia enquanto outro processo estiver migrando. Retorna as versões aplicadas.
+    """
+    aplicadas = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (CHAVE_LOCK_MIGRACOES,))
+    conn.commit()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SQL_CRIAR_CONTROLE)
+            cur.execute("SELECT versao FROM schema_migrations")
+            ja_aplicadas = {linha[0] for linha in cur.fetchall()}
+        conn.commit()
+        for versao, nome, funcao in MIGRACOES:
+            if versao in ja_aplicadas:
+                continue
+            inicio = time.monotonic()
+            with conn.cursor() as cur:
+                funcao(cur)
+                cur.execute("INSERT INTO schema_migrations (versao, nome) VALUES (%s, %s)", (versao, nome))
+            conn.commit()
+            aplicadas.append(versao)
+            logging.info(f"Migração {versao:03d} '{nome}' aplicada em {time.monotonic() - inicio:.2f}s.")
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (CHAVE_LOCK_MIGRACOES,))
+        conn.commit()
+    return aplicadas
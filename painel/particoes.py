@@ -0,0 +1,210 @@
+# painel/particoes.py - Partições mensais de chat_messages, retenção e arquivamento
+#
+# 'chat_messages' é particionada por RANGE(timestamp), uma partição por mês (UTC):
+#   chat_messages_pAAAAMM          mensagens do mês AAAA-MM
+#   chat_messages_legado_ate_AAAAMM  tabela antiga (antes do particionamento), tudo antes de AAAA-MM
+#   chat_messages_padrao           DEFAULT: só recebe algo se faltar a partição do mês
+#
+# A retenção desanexa (DETACH) as partições inteiramente mais velhas que
+# CHAT_RETENCAO_MESES, grava cada uma em CSV gzip em CHAT_ARQUIVO_DIR e só
+# então a apaga (DROP) - sem DELETE linha a linha nem VACUUM pesado.
+#
+# Rodar periodicamente (ex.: Heroku Scheduler, cron diário):
+#   python -m painel manutencao
+
+import os
+import re
+import gzip
+import logging
+from datetime import date, datetime, timezone
+
+from .esquema import CHAVE_LOCK_ESQUEMA
+
+CHAT_PARTICOES_FUTURAS = int(os.getenv("CHAT_PARTICOES_FUTURAS", "2"))  # meses criados adiantado
+CHAT_RETENCAO_MESES = int(os.getenv("CHAT_RETENCAO_MESES", "0"))  # 0 = guarda tudo
+CHAT_ARQUIVO_DIR = os.getenv("CHAT_ARQUIVO_DIR", "arquivo_chat")  # vazio = apaga sem arquivar
+
+CHAVE_LOCK_PARTICOES = CHAVE_LOCK_ESQUEMA  # pg_advisory_lock: um processo por vez mexe nas partições
+
+PARTICAO_PADRAO = "chat_messages_padrao"
+_RE_MENSAL = re.compile(r"^chat_messages_p(\d{4})(\d{2})$")
+_RE_LEGADO = re.compile(r"^chat_messages_legado_ate_(\d{4})(\d{2})$")
+
+SQL_CRIAR_PAI = """
+    CREATE TABLE chat_messages (
+        id SERIAL,
+        token_id INTEGER NOT NULL REFERENCES tokens(id) ON DELETE CASCADE,
+        role SMALLINT NOT NULL CHECK (role IN (1, 2)),  -- esquema.ROLES
+        content TEXT NOT NULL,
+        timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp)
+"""
+
+SQL_LISTAR = """
+    SELECT c.relname, c.relispartition
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = current_schema() AND c.relkind = 'r'
+      AND (c.relname LIKE 'chat\\_messages\\_p%' OR c.relname LIKE 'chat\\_messages\\_legado\\_ate\\_%')
+    ORDER BY c.relname
+"""
+
+
+def _somar_meses(mes: date, n: int) -> date:
+    total = mes.year * 12 + (mes.month - 1) + n
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def _mes_atual() -> date:
+    hoje = datetime.now(timezone.utc).date()
+    return date(hoje.year, hoje.month, 1)
+
+
+def _literal(mes: date) -> str:
+    return f"'{mes.isoformat()} 00:00:00+00'"
+
+
+def _limites(nome: str) -> tuple[date | None, date] | None:
+    """(inicio, fim) do intervalo de uma partição pelo nome; inicio None = MINVALUE."""
+    m = _RE_MENSAL.match(nome)
+    if m:
+        inicio = date(int(m.group(1)), int(m.group(2)), 1)
+        return inicio, _somar_meses(inicio, 1)
+    m = _RE_LEGADO.match(nome)
+    if m:
+        return None, date(int(m.group(1)), int(m.group(2)), 1)
+    return None
+
+
+def listar(cur) -> list[tuple[str, bool]]:
+    """[(nome, anexada)] das partições mensais/legado existentes (anexadas ou já desanexadas)."""
+    cur.execute(SQL_LISTAR)
+    return cur.fetchall()
+
+
+def _tipo_tabela(cur) -> str | None:
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('chat_messages')")
+    linha = cur.fetchone()
+    return linha[0] if linha else None
+
+
+def _converter_legado(cur):
+    """
+    Transforma a chat_messages antiga (tabela comum) na partição que cobre tudo
+    até o fim do mês corrente (ou da mensagem mais recente), sem copiar dados.
+    """
+    cur.execute("LOCK TABLE chat_messages IN ACCESS EXCLUSIVE MODE")
+    cur.execute("SELECT max(timestamp) FROM chat_messages")
+    ultima = cur.fetchone()[0]
+    fim = _somar_meses(_mes_atual(), 1)
+    if ultima is not None:
+        ultima = ultima.astimezone(timezone.utc)
+        fim = max(fim, _somar_meses(date(ultima.year, ultima.month, 1), 1))
+    legado = f"chat_messages_legado_ate_{fim:%Y%m}"
+    cur.execute("UPDATE chat_messages SET timestamp = to_timestamp(0) WHERE timestamp IS NULL")
+    cur.execute("ALTER TABLE chat_messages ALTER COLUMN timestamp SET NOT NULL")
+    cur.execute(f"ALTER TABLE chat_messages RENAME TO {legado}")
+    cur.execute(f"ALTER TABLE {legado} RENAME CONSTRAINT chat_messages_pkey TO {legado}_pkey")
+    cur.execute("ALTER INDEX IF EXISTS idx_chat_msgs_token_ts RENAME TO idx_chat_msgs_legado_token_ts")
+    cur.execute(SQL_CRIAR_PAI.replace("id SERIAL", "id INTEGER NOT NULL DEFAULT nextval('chat_messages_id_seq')"))
+    cur.execute("ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id")
+    cur.execute(f"ALTER TABLE chat_messages ATTACH PARTITION {legado} FOR VALUES FROM (MINVALUE) TO ({_literal(fim)})")
+    logging.info(f"'chat_messages' convertida para particionada; dados antigos em '{legado}'.")
+
+
+def garantir_estrutura(cur):
+    """
+    Cria (ou converte) a chat_messages particionada, o índice por conversa e as
+    partições do mês atual e dos próximos CHAT_PARTICOES_FUTURAS meses.
+    Roda dentro da transação do chamador, serializada por advisory lock.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (CHAVE_LOCK_PARTICOES,))
+    tipo = _tipo_tabela(cur)
+    if tipo is None:
+        cur.execute(SQL_CRIAR_PAI)
+    elif tipo == "r":
+        _converter_legado(cur)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chat_msgs_token_ts
+        ON chat_messages (token_id, timestamp DESC);
+    """)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {PARTICAO_PADRAO} PARTITION OF chat_messages DEFAULT")
+    inicio_livre = None
+    for nome, anexada in listar(cur):
+        limites = _limites(nome)
+        if anexada and limites and limites[0] is None:
+            inicio_livre = limites[1]  # Meses cobertos pelo legado não ganham partição própria
+    atual = _mes_atual()
+    for n in range(CHAT_PARTICOES_FUTURAS + 1):
+        mes = _somar_meses(atual, n)
+        if inicio_livre and mes < inicio_livre:
+            continue
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS chat_messages_p{mes:%Y%m} PARTITION OF chat_messages
+            FOR VALUES FROM ({_literal(mes)}) TO ({_literal(_somar_meses(mes, 1))})
+        """)
+
+
+def _arquivar(conn, nome: str) -> str:
+    """Grava a tabela desanexada em CHAT_ARQUIVO_DIR/<nome>.csv.gz (via arquivo temporário)."""
+    os.makedirs(CHAT_ARQUIVO_DIR, exist_ok=True)
+    destino = os.path.join(CHAT_ARQUIVO_DIR, f"{nome}.csv.gz")
+    parcial = destino + ".parcial"
+    with gzip.open(parcial, "wt", encoding="utf-8", newline="") as arquivo:
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY {nome} TO STDOUT WITH (FORMAT csv, HEADER)", arquivo)
+        arquivo.flush()
+    with open(parcial, "rb") as arquivo:
+        os.fsync(arquivo.fileno())
+    os.replace(parcial, destino)
+    return destino
+
+
+def aplicar_retencao(conn) -> dict:
+    """
+    Desanexa as partições além da retenção, arquiva e apaga as desanexadas.
+    Usa a conexão em modo transacional, com commit a cada passo (uma falha no
+    arquivamento deixa a partição desanexada para a próxima execução).
+    """
+    resultado = {"desanexadas": [], "arquivadas": [], "apagadas": []}
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (CHAVE_LOCK_PARTICOES,))
+        if not cur.fetchone()[0]:
+            logging.info("Manutenção de partições já em andamento em outro processo.")
+            conn.rollback()
+            return resultado
+    conn.commit()
+    try:
+        if CHAT_RETENCAO_MESES > 0:
+            limite = _somar_meses(_mes_atual(), -CHAT_RETENCAO_MESES)
+            with conn.cursor() as cur:
+                particoes = listar(cur)
+            for nome, anexada in particoes:
+                limites = _limites(nome)
+                if anexada and limites and limites[1] <= limite:
+                    with conn.cursor() as cur:
+                        cur.execute(f"ALTER TABLE chat_messages DETACH PARTITION {nome}")
+                    conn.commit()
+                    resultado["desanexadas"].append(nome)
+                    logging.info(f"Partição '{nome}' desanexada (retenção de {CHAT_RETENCAO_MESES} meses).")
+        with conn.cursor() as cur:
+            soltas = [nome for nome, anexada in listar(cur) if not anexada and _limites(nome)]
+        conn.commit()
+        for nome in soltas:
+            if CHAT_ARQUIVO_DIR:
+                destino = _arquivar(conn, nome)
+                conn.commit()
+                resultado["arquivadas"].append(destino)
+                logging.info(f"Partição '{nome}' arquivada em '{destino}'.")
+            with conn.cursor() as cur:
+                cur.execute(f"DROP TABLE {nome}")
+            conn.commit()
+            resultado["apagadas"].append(nome)
+            logging.info(f"Partição '{nome}' apagada.")
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (CHAVE_LOCK_PARTICOES,))
+        conn.commit()
+    return resultado
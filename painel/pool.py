@@ -0,0 +1,238 @@
+# painel/pool.py - Pool de conexões Postgres compartilhado pelas funções do painel
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+
+# Configuração do pool (via .env / ambiente)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))  # conexões abertas já na criação do pool
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))  # conexões no total; todas ficam abertas quando ociosas
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # segundos esperando conexão livre
+DB_POOL_HEALTHCHECK = float(os.getenv("DB_POOL_HEALTHCHECK", "30"))  # ociosa há mais que isso -> SELECT 1
+
+
+class PoolEsgotadoError(psycopg2.OperationalError):
+    """Nenhuma conexão livre dentro de DB_POOL_TIMEOUT."""
+
+
+class PoolConexoes:
+    """
+    Pool thread-safe de conexões psycopg2, com espera limitada por conexão livre,
+    health-check de conexões ociosas, cache de prepared statements por conexão e
+    estatísticas de uso. Conexões devolvidas ficam abertas (até `maxconn`): o
+    ThreadedConnectionPool do psycopg2 fecharia as que passam de `minconn`, e cada
+    aquisição sob concorrência pagaria conexão nova (TCP+TLS+auth) e novos PREPAREs.
+    """
+
+    def __init__(self, dsn: str, minconn: int = DB_POOL_MIN, maxconn: int = DB_POOL_MAX,
+                 timeout: float = DB_POOL_TIMEOUT, healthcheck: float = DB_POOL_HEALTHCHECK):
+        self.dsn = dsn
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.healthcheck = healthcheck
+        self._vagas = threading.BoundedSemaphore(self.maxconn)
+        self._lock = threading.Lock()
+        self._ociosas = []  # Pilha: a mais recente sai primeiro (PREPAREs quentes, menos health-checks)
+        self._meta = {}  # id(conn) -> {"ultimo_uso": float, "preparados": set()}
+        self._stats = {
+            "aquisicoes": 0,
+            "em_uso": 0,
+            "pico_em_uso": 0,
+            "esperas_timeout": 0,
+            "espera_total_s": 0.0,
+            "espera_max_s": 0.0,
+            "conexoes_criadas": 0,
+            "conexoes_descartadas": 0,
+            "healthchecks": 0,
+        }
+        for _ in range(self.minconn):
+            self._ociosas.append(self._conectar())
+
+    # --- Aquisição / devolução ---
+
+    def _conectar(self):
+        conn = psycopg2.connect(self.dsn)
+        with self._lock:
+            self._stats["conexoes_criadas"] += 1
+            self._meta[id(conn)] = {"ultimo_uso": time.monotonic(), "preparados": set()}
+        return conn
+
+    def _registrar_espera(self, espera: float):
+        with self._lock:
+            self._stats["aquisicoes"] += 1
+            self._stats["em_uso"] += 1
+            self._stats["pico_em_uso"] = max(self._stats["pico_em_uso"], self._stats["em_uso"])
+            self._stats["espera_total_s"] += espera
+            self._stats["espera_max_s"] = max(self._stats["espera_max_s"], espera)
+
+    def _conexao_saudavel(self, conn) -> bool:
+        if conn.closed:
+            return False
+        meta = self._meta.get(id(conn))
+        if meta is None or time.monotonic() - meta["ultimo_uso"] < self.healthcheck:
+            return True
+        with self._lock:
+            self._stats["healthchecks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _descartar(self, conn):
+        with self._lock:
+            self._meta.pop(id(conn), None)
+            self._stats["conexoes_descartadas"] += 1
+        try:
+            conn.close()
+        except Exception:
+            logging.debug("Falha ao descartar conexão do pool.", exc_info=True)
+
+    def getconn(self):
+        """Obtém uma conexão saudável, esperando até `timeout` segundos por uma vaga."""
+        inicio = time.monotonic()
+        if not self._vagas.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["esperas_timeout"] += 1
+            raise PoolEsgotadoError(f"Pool esgotado: nenhuma conexão livre em {self.timeout}s.")
+        try:
+            # Reaproveita uma ociosa; mortas são descartadas e, sem ociosas, abre uma nova
+            while True:
+                with self._lock:
+                    conn = self._ociosas.pop() if self._ociosas else None
+                if conn is None:
+                    conn = self._conectar()
+                    break
+                if self._conexao_saudavel(conn):
+                    break
+                logging.warning("Conexão do pool inválida/ociosa demais. Descartando.")
+                self._descartar(conn)
+        except Exception:
+            self._vagas.release()
+            raise
+        self._registrar_espera(time.monotonic() - inicio)
+        return conn
+
+    def putconn(self, conn, close: bool = False):
+        """Devolve a conexão ao pool (fecha se `close` ou se estiver quebrada)."""
+        try:
+            if close or conn.closed:
+                self._descartar(conn)
+            else:
+                with self._lock:
+                    meta = self._meta.get(id(conn))
+                    if meta is not None:
+                        meta["ultimo_uso"] = time.monotonic()
+                    self._ociosas.append(conn)  # Cabe sempre: o semáforo limita a maxconn conexões
+        finally:
+            with self._lock:
+                self._stats["em_uso"] = max(0, self._stats["em_uso"] - 1)
+            self._vagas.release()
+
+    @contextmanager
+    def conexao(self):
+        """
+        Context manager: empresta uma conexão e a devolve ao final.
+        Em exceção faz rollback; conexões com erro de rede são descartadas.
+        """
+        conn = self.getconn()
+        descartar = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            descartar = True
+            raise
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    descartar = True
+            raise
+        finally:
+            if not descartar and not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+                # Transação esquecida aberta: não devolve sujeira ao pool
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    descartar = True
+            self.putconn(conn, close=descartar)
+
+    # --- Prepared statements ---
+
+    def executar_preparado(self, cur, nome: str, sql: str, params: tuple):
+        """
+        Executa `sql` (placeholders $1, $2...) como prepared statement nomeado.
+        O PREPARE é feito uma única vez por conexão física.
+        """
+        with self._lock:
+            meta = self._meta.setdefault(id(cur.connection), {"ultimo_uso": time.monotonic(), "preparados": set()})
+        if nome not in meta["preparados"]:
+            # PREPARE vale para a sessão inteira (não é desfeito por rollback)
+            cur.execute(f"PREPARE {nome} AS {sql}")
+            meta["preparados"].add(nome)
+        if params:
+            cur.execute(f"EXECUTE {nome} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f"EXECUTE {nome}")
+
+    # --- Estatísticas / encerramento ---
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["conexoes_abertas"] = len(self._meta)
+            stats["conexoes_ociosas"] = len(self._ociosas)
+        stats["min"] = self.minconn
+        stats["max"] = self.maxconn
+        stats["espera_media_s"] = stats["espera_total_s"] / stats["aquisicoes"] if stats["aquisicoes"] else 0.0
+        return stats
+
+    def fechar(self):
+        with self._lock:
+            ociosas, self._ociosas = self._ociosas, []
+            self._meta.clear()
+        for conn in ociosas:
+            try:
+                conn.close()
+            except Exception:
+                logging.debug("Falha ao fechar conexão do pool.", exc_info=True)
+
+
+# --- Pool global do processo (criado sob demanda, recriado após fork) ---
+
+_pool_global = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def obter_pool(dsn: str) -> PoolConexoes:
+    """Retorna o pool do processo atual, criando-o na primeira chamada."""
+    global _pool_global, _pool_pid
+    pid = os.getpid()
+    if _pool_global is not None and _pool_pid == pid:
+        return _pool_global
+    with _pool_lock:
+        if _pool_global is None or _pool_pid != pid:
+            # Após o fork do gunicorn as conexões herdadas não podem ser reutilizadas
+            _pool_global = PoolConexoes(dsn)
+            _pool_pid = pid
+            logging.info(f"Pool Postgres criado (pid={pid}, min={_pool_global.minconn}, max={_pool_global.maxconn}).")
+    return _pool_global
+
+
+def fechar_pool():
+    """Fecha todas as conexões do pool do processo (ex.: no shutdown do worker)."""
+    global _pool_global, _pool_pid
+    with _pool_lock:
+        if _pool_global is not None and _pool_pid == os.getpid():
+            _pool_global.fechar()
+        _pool_global = None
+        _pool_pid = None
@@ -0,0 +1,224 @@
+# painel/resumos.py - Resumos contínuos das conversas, calculados fora do caminho do /chat
+#
+# Cada worker anota os user_tokens que conversaram (marcar_conversa_ativa) e uma
+# thread em segundo plano, a cada RESUMO_INTERVALO segundos, condensa as mensagens
+# que já saíram da janela de histórico enviada à IA num resumo guardado em
+# 'chat_resumos'. O /chat só lê o resumo pronto (com cache em memória).
+#
+# A janela é a do prompt que foi de fato enviado: o contexto.montar_contexto
+# corta msgs das CONTEXT_MAX_MSGS buscadas para caber no orçamento de tokens, e
+# o /chat informa quantas foram (limitar_janela). O resumo passa a cobrir as
+# anteriores a elas; sem isso as cortadas não estariam nem no prompt nem no resumo.
+#
+# O acesso ao banco passa por uma "fonte" (ler_resumo / ler_pendentes /
+# gravar_resumo): FontePostgres aqui, e o backend SQLite (bd_sqlite.py) implementa as mesmas três.
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+import psycopg2
+
+from .esquema import SQL_ROLE_TEXTO
+
+RESUMO_INTERVALO = float(os.getenv("RESUMO_INTERVALO", "60"))  # segundos entre ciclos
+RESUMO_MIN_NOVAS = int(os.getenv("RESUMO_MIN_NOVAS", "10"))  # msgs fora da janela necessárias para resumir de novo
+RESUMO_MAX_MSGS_LOTE = int(os.getenv("RESUMO_MAX_MSGS_LOTE", "200"))  # msgs antigas por chamada de resumo
+RESUMO_CACHE_TTL = float(os.getenv("RESUMO_CACHE_TTL", "300"))
+RESUMO_CACHE_MAX = int(os.getenv("RESUMO_CACHE_MAX", "10000"))
+
+SQL_CRIAR_TABELA = """
+    CREATE TABLE IF NOT EXISTS chat_resumos (
+        token_id INTEGER PRIMARY KEY REFERENCES tokens(id) ON DELETE CASCADE,
+        resumo TEXT NOT NULL,
+        ate_id INTEGER NOT NULL,  -- maior chat_messages.id já incluído no resumo
+        atualizado_em TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+SQL_LER = """
+    SELECT r.resumo, r.ate_id FROM chat_resumos r
+    JOIN tokens t ON t.id = r.token_id
+    WHERE t.token = %s
+"""
+
+# Mensagens ainda não resumidas que já saíram da janela (OFFSET) das mais recentes
+SQL_PENDENTES = f"""
+    SELECT id, {SQL_ROLE_TEXTO}, content FROM (
+        SELECT id, role, content, timestamp
+        FROM chat_messages
+        WHERE token_id = (SELECT id FROM tokens WHERE token = %s) AND id > %s
+        ORDER BY timestamp DESC, id DESC
+        OFFSET %s
+    ) AS fora_da_janela
+    ORDER BY timestamp ASC, id ASC
+    LIMIT %s
+"""
+
+# Só grava se avançar: outro worker pode ter resumido a mesma conversa nesse meio tempo
+SQL_GRAVAR = """
+    INSERT INTO chat_resumos (token_id, resumo, ate_id, atualizado_em)
+    SELECT id, %s, %s, CURRENT_TIMESTAMP FROM tokens WHERE token = %s
+    ON CONFLICT (token_id) DO UPDATE
+        SET resumo = EXCLUDED.resumo, ate_id = EXCLUDED.ate_id, atualizado_em = EXCLUDED.atualizado_em
+        WHERE chat_resumos.ate_id < EXCLUDED.ate_id
+"""
+
+
+class FontePostgres:
+    """Leituras/gravações do resumidor no Postgres, pelas conexões do pool do painel."""
+
+    def __init__(self, conexao):
+        self.conexao = conexao  # callable -> context manager de conexão (pool do painel)
+
+    def ler_resumo(self, user_token: str) -> tuple[str, int] | None:
+        """(resumo, ate_id) guardado para a conversa, ou None."""
+        with self.conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SQL_LER, (user_token,))
+                linha = cur.fetchone()
+            conn.rollback()
+        return linha
+
+    def ler_pendentes(self, user_token: str, ate_id: int, janela: int, limite: int) -> list:
+        """[(id, role, content)] depois de ate_id que já saíram da janela, em ordem cronológica."""
+        with self.conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SQL_PENDENTES, (user_token, ate_id, janela, limite))
+                pendentes = cur.fetchall()
+            conn.rollback()
+        return pendentes
+
+    def gravar_resumo(self, user_token: str, resumo: str, ate_id: int):
+        with self.conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SQL_GRAVAR, (resumo, ate_id, user_token))
+            conn.commit()
+
+
+class Resumidor(threading.Thread):
+    """Thread do worker que resume as conversas ativas marcadas desde o último ciclo."""
+
+    def __init__(self, fonte, funcao_resumir, janela: int):
+        super().__init__(name="painel-resumidor", daemon=True)
+        self.fonte = fonte  # FontePostgres ou o backend SQLite
+        self.funcao_resumir = funcao_resumir  # (resumo_anterior | None, [{"role","content"}]) -> str
+        self.janela = janela
+        self._ativos = {}  # user_token -> msgs do histórico no último prompt (janela a preservar)
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self.stats = {"ciclos": 0, "resumos_gerados": 0, "erros": 0}
+
+    def marcar(self, user_token: str, janela: int | None = None):
+        """Anota a conversa; `janela` (msgs do histórico que couberam no prompt) reduz a janela padrão."""
+        with self._lock:
+            atual = self._ativos.get(user_token, self.janela)
+            self._ativos[user_token] = min(atual, max(1, janela)) if janela is not None else atual
+
+    def run(self):
+        while not self._parar.wait(RESUMO_INTERVALO):
+            with self._lock:
+                tokens, self._ativos = self._ativos, {}
+            self.stats["ciclos"] += 1
+            for user_token, janela in tokens.items():
+                try:
+                    self.resumir_conversa(user_token, janela)
+                except Exception:
+                    self.stats["erros"] += 1
+                    logging.exception(f"Erro ao resumir conversa T:{user_token[:8]}")
+
+    def resumir_conversa(self, user_token: str, janela: int | None = None) -> bool:
+        # 1) Leitura curta (a chamada à IA acontece sem conexão presa)
+        linha = self.fonte.ler_resumo(user_token)
+        resumo_anterior, ate_id = linha if linha else (None, 0)
+        pendentes = self.fonte.ler_pendentes(user_token, ate_id, janela or self.janela, RESUMO_MAX_MSGS_LOTE)
+        if len(pendentes) < RESUMO_MIN_NOVAS:
+            return False
+
+        # 2) Resumo pela IA
+        inicio = time.monotonic()
+        novo_resumo = self.funcao_resumir(resumo_anterior, [{"role": r, "content": c} for _id, r, c in pendentes])
+        if not novo_resumo or not novo_resumo.strip():
+            logging.warning(f"Resumo vazio para T:{user_token[:8]}. Mantendo o anterior.")
+            return False
+
+        # 3) Grava (só se ninguém avançou mais)
+        novo_ate_id = pendentes[-1][0]
+        self.fonte.gravar_resumo(user_token, novo_resumo.strip(), novo_ate_id)
+        _cache_resumos.pop(user_token, None)
+        self.stats["resumos_gerados"] += 1
+        logging.info(f"Resumo atualizado T:{user_token[:8]}: +{len(pendentes)} msgs (até id {novo_ate_id}) em {time.monotonic() - inicio:.1f}s")
+        return True
+
+    def parar(self):
+        self._parar.set()
+
+
+# --- Estado do processo ---
+
+_funcao_resumir = None
+_janela = 40
+_resumidor = None
+_resumidor_pid = None
+_resumidor_lock = threading.Lock()
+_cache_resumos = {}  # user_token -> (resumo | None, expira_monotonic)
+
+
+def configurar(funcao_resumir, janela: int):
+    """Registra a função que chama a IA; a thread só sobe no primeiro uso em cada worker."""
+    global _funcao_resumir, _janela
+    _funcao_resumir = funcao_resumir
+    _janela = janela
+
+
+def marcar_conversa_ativa(fonte, user_token: str):
+    """Anota a conversa para o próximo ciclo do resumidor (não faz I/O)."""
+    global _resumidor, _resumidor_pid
+    if _funcao_resumir is None:
+        return
+    pid = os.getpid()
+    if _resumidor is None or _resumidor_pid != pid:
+        with _resumidor_lock:
+            if _resumidor is None or _resumidor_pid != pid:
+                _resumidor = Resumidor(fonte, _funcao_resumir, _janela)
+                _resumidor.start()
+                _resumidor_pid = pid
+    _resumidor.marcar(user_token)
+
+
+def limitar_janela(user_token: str, msgs_no_prompt: int):
+    """O prompt do turno levou só as `msgs_no_prompt` msgs mais recentes: o próximo resumo cobre as demais."""
+    if _resumidor is not None and _resumidor_pid == os.getpid():
+        _resumidor.marcar(user_token, msgs_no_prompt)
+
+
+def obter_resumo(fonte, user_token: str) -> str | None:
+    """Resumo guardado da conversa (cache em memória de RESUMO_CACHE_TTL segundos)."""
+    agora = time.monotonic()
+    item = _cache_resumos.get(user_token)
+    if item is not None and item[1] > agora:
+        return item[0]
+    resumo = None
+    try:
+        linha = fonte.ler_resumo(user_token)
+        resumo = linha[0] if linha else None
+    except psycopg2.Error as e:
+        logging.warning(f"Erro BD ler resumo T:{user_token[:8]}: {e.pgcode} - {e.pgerror}")
+        return None
+    except sqlite3.Error as e:
+        logging.warning(f"Erro SQLite ler resumo T:{user_token[:8]}: {e}")
+        return None
+    if len(_cache_resumos) >= RESUMO_CACHE_MAX:
+        _cache_resumos.clear()  # Limite simples de memória; recarrega sob demanda
+    _cache_resumos[user_token] = (resumo, agora + RESUMO_CACHE_TTL)
+    return resumo
+
+
+def estatisticas() -> dict:
+    if _resumidor is None or _resumidor_pid != os.getpid():
+        return {"ativo": False}
+    with _resumidor._lock:
+        pendentes = len(_resumidor._ativos)
+    return dict(_resumidor.stats, ativo=True, conversas_marcadas=pendentes)
@@ -9,6 +9,10 @@
         profilePic, modal, modalImg, closeModalBtn,
         emojiBtn, emojiPicker;
 
+    // Reenvios automáticos de uma mensagem (com a mesma chave de idempotência)
+    const SEND_MAX_ATTEMPTS = 3; // 1 envio + 2 reenvios
+    const RETRYABLE_STATUS = [409, 502, 503, 504]; // 409 = a original ainda está sendo respondida
+
     // --- INICIALIZAÇÃO ---
     function init() {
         // Seleciona os elementos DOM essenciais uma vez
@@ -81,6 +85,19 @@
         return userId;
     }
 
+    // Gera a chave de idempotência de uma mensagem (header Idempotency-Key do /chat/stream)
+    function newIdempotencyKey() {
+        if (window.crypto && typeof window.crypto.randomUUID === "function") {
+            return window.crypto.randomUUID();
+        }
+        return 'msg-' + Date.now().toString(36) + Math.random().toString(36).substring(2, 12);
+    }
+
+    // Promessa que resolve depois de `ms` milissegundos (espera entre reenvios)
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
     // Formata a hora atual para HH:MM (formato 24h)
     function formatTime(date = new Date()) {
         try {
@@ -176,6 +193,40 @@
         msgDiv.appendChild(footerDiv); // Adiciona rodapé (hora/checks) à mensagem
         chatBox.appendChild(msgDiv); // Adiciona mensagem completa ao chatbox
         scrollToBottom(); // Rola para a nova mensagem
+        return contentDiv; // Permite atualizar o texto depois (streaming)
+    }
+
+    // Lê um corpo text/event-stream e chama onEvent(nomeEvento, dados) para cada evento
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder("utf-8");
+        let buffer = "";
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // Eventos SSE são separados por linha em branco
+            let sepIndex;
+            while ((sepIndex = buffer.indexOf("\n\n")) !== -1) {
+                const rawEvent = buffer.slice(0, sepIndex);
+                buffer = buffer.slice(sepIndex + 2);
+
+                let eventName = "message";
+                let dataLines = [];
+                rawEvent.split("\n").forEach(line => {
+                    if (line.startsWith("event:")) eventName = line.slice(6).trim();
+                    else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+                });
+                if (dataLines.length === 0) continue;
+                try {
+                    onEvent(eventName, JSON.parse(dataLines.join("\n")));
+                } catch (e) {
+                    console.warn("Evento SSE inválido ignorado:", rawEvent);
+                }
+            }
+        }
     }
 
     // Função assíncrona para enviar a mensagem para o backend
@@ -198,41 +249,91 @@
 
         setTypingStatus(true); // Mostra "digitando..."
 
-        try {
-            // ***** LINHA PRINCIPAL DA COMUNICAÇÃO COM BACKEND *****
-            // Faz a requisição POST para a rota /chat do Flask
-            const response = await fetch("/chat", { // <-- URL CORRIGIDA AQUI
-                method: "POST",
-                headers: {
-                    "Content-Type": "application/json",
-                },
-                // Envia a mensagem no corpo da requisição como JSON
-                // Usando 'mensagem' como chave para ser compatível com app.py
-                body: JSON.stringify({ mensagem: messageText, user_id: currentUserId })
-            });
+        // Mesma chave em todos os reenvios desta mensagem: o servidor devolve a resposta
+        // já gerada (ou espera a original) em vez de chamar a IA e gravar a mensagem de novo
+        const idempotencyKey = newIdempotencyKey();
+        let replyDiv = null;
 
-            // Verifica se a resposta do servidor foi bem sucedida (status 2xx)
-            if (!response.ok) {
-                let errorDetail = response.statusText; // Pega texto do erro (ex: "Not Found")
-                try { // Tenta pegar mais detalhes do corpo da resposta JSON, se houver
-                    const errorData = await response.json();
-                    errorDetail = errorData.error || errorData.message || errorDetail;
-                } catch (e) { /* Ignora se não conseguir ler corpo como JSON */ }
-                throw new Error(`Erro ${response.status}: ${errorDetail}`); // Lança um erro
+        try {
+            let replyText = "";
+            for (let attempt = 1; ; attempt++) {
+                replyText = "";
+                let streamError = null;
+                try {
+                    // ***** LINHA PRINCIPAL DA COMUNICAÇÃO COM BACKEND *****
+                    // Faz a requisição POST para a rota /chat/stream do Flask (resposta em Server-Sent Events)
+                    const response = await fetch("/chat/stream", {
+                        method: "POST",
+                        headers: {
+                            "Content-Type": "application/json",
+                            "Accept": "text/event-stream",
+                            "Idempotency-Key": idempotencyKey,
+                        },
+                        // Envia a mensagem no corpo da requisição como JSON
+                        // Usando 'mensagem' como chave para ser compatível com app.py
+                        body: JSON.stringify({ mensagem: messageText, user_id: currentUserId })
+                    });
+
+                    // Verifica se a resposta do servidor foi bem sucedida (status 2xx)
+                    if (!response.ok) {
+                        let errorDetail = response.statusText; // Pega texto do erro (ex: "Not Found")
+                        try { // Tenta pegar mais detalhes do corpo da resposta JSON, se houver
+                            const errorData = await response.json();
+                            errorDetail = errorData.error || errorData.message || errorDetail;
+                        } catch (e) { /* Ignora se não conseguir ler corpo como JSON */ }
+                        const error = new Error(`Erro ${response.status}: ${errorDetail}`);
+                        error.status = response.status;
+                        error.retryable = RETRYABLE_STATUS.includes(response.status);
+                        error.retryAfter = Number(response.headers.get("Retry-After")) || 0;
+                        throw error; // Lança um erro
+                    }
+
+                    // Vai montando a resposta da Dra. Ana conforme os pedaços chegam
+                    await readEventStream(response, (eventName, data) => {
+                        if (eventName === "error") {
+                            streamError = data.error || "Tive um problema para me conectar.";
+                        } else if (eventName === "done") {
+                            replyText = data.response || replyText; // Texto final (já limpo pelo servidor)
+                            if (replyDiv) replyDiv.textContent = replyText;
+                        } else if (data.delta) {
+                            replyText += data.delta;
+                            if (!replyDiv) {
+                                setTypingStatus(false); // Primeiro pedaço chegou: some o "digitando..."
+                                replyDiv = displayMessage({ from: "her", text: replyText });
+                            } else {
+                                replyDiv.textContent = replyText;
+                                scrollToBottom();
+                            }
+                        }
+                    });
+                } catch (error) {
+                    // Rede caiu (no fetch ou no meio do stream) ou erro transitório do servidor: reenvia com a mesma chave
+                    const retryable = error.retryable ?? (error instanceof TypeError);
+                    if (!retryable || attempt >= SEND_MAX_ATTEMPTS) throw error;
+                    console.warn(`Reenviando mensagem (tentativa ${attempt + 1}):`, error);
+                    await sleep(Math.max(error.retryAfter || 0, attempt) * 1000);
+                    continue;
+                }
+                if (streamError) throw new Error(streamError);
+                break;
             }
 
-            // Se a resposta foi OK, lê o corpo como JSON
-            const data = await response.json();
-
-            // Exibe a resposta da IA (ou uma mensagem padrão se a chave 'resposta' não existir)
-            displayMessage({
-                from: "her", // Define que a mensagem é da "Dra. Ana"
-                text: data.response || "Hmm, não entendi bem o que dizer agora." // Usa 'response' como chave
-            });
+            if (!replyDiv) {
+                // Nenhum pedaço recebido: exibe a resposta final (ou a mensagem padrão)
+                displayMessage({
+                    from: "her", // Define que a mensagem é da "Dra. Ana"
+                    text: replyText || "Hmm, não entendi bem o que dizer agora."
+                });
+            }
 
         } catch (error) {
             // Se houve erro na comunicação (rede, servidor não respondeu, etc.)
             console.error("Falha na comunicação com a API:", error);
+            if (error.status === 403) {
+                // Sessão inválida/expirada (a página pode ter aberto do cache do service worker): volta ao acesso
+                window.location.href = "/instalar";
+                return;
+            }
             // Mostra uma mensagem de erro no chat para o usuário
             displayMessage({
                 from: "her",
@@ -338,7 +439,7 @@
     function openProfileModal() {
         // Mostra o modal com a imagem de perfil
         if (modal && modalImg && profilePic) {
-            modalImg.src = profilePic.src; // Define a imagem do modal
+            modalImg.src = profilePic.dataset.full || profilePic.currentSrc || profilePic.src; // Foto ampliada no modal
             modal.style.display = "flex"; // Mostra o modal
         }
     }
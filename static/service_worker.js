@@ -1,16 +1,8 @@
-self.addEventListener("install", event => {
-    self.skipWaiting();
-  });
-  
-  self.addEventListener("activate", event => {
-    event.waitUntil(clients.claim());
-  });
-  
-  self.addEventListener("fetch", event => {
-    event.respondWith(
-      caches.match(event.request).then(response => {
-        return response || fetch(event.request);
-      })
-    );
-  });
-  
+// Service worker antigo (escopo /static/, não cobria o /dra-ana). O atual é o
+// /service_worker.js (templates/service_worker.js); este só se desregistra nos
+// navegadores que ainda o têm instalado.
+self.addEventListener("install", () => self.skipWaiting());
+
+self.addEventListener("activate", event => {
+    event.waitUntil(self.registration.unregister());
+});
@@ -0,0 +1,71 @@
+// service_worker.js - App shell do /dra-ana (gerado por estaticos.py, versão {{ versao }})
+//
+// install:  pré-carrega os assets com hash e o próprio /dra-ana num cache desta versão
+// activate: apaga os caches das versões anteriores
+// fetch:    /dra-ana abre do cache e se atualiza em segundo plano (stale-while-revalidate);
+//           assets com hash saem do cache (são imutáveis); o resto (API, POSTs) vai direto à rede
+
+const VERSAO = {{ versao|tojson }};
+const CACHE = "dra-ana-" + VERSAO;
+const SHELL = {{ shell|tojson }};
+const PREFIXO_ASSETS = {{ prefixo|tojson }};
+const PRECACHE = {{ precache|tojson }};
+
+// Guarda o shell só se veio a página mesmo (sem sessão o servidor redireciona para o acesso)
+async function guardarShell(cache, resposta) {
+    if (resposta.ok && !resposta.redirected && resposta.type !== "opaqueredirect") {
+        await cache.put(SHELL, resposta.clone());
+    } else if (resposta.redirected || resposta.type === "opaqueredirect") {
+        await cache.delete(SHELL); // Sessão expirou: não abre mais o shell guardado
+    }
+    return resposta;
+}
+
+self.addEventListener("install", event => {
+    event.waitUntil((async () => {
+        const cache = await caches.open(CACHE);
+        await cache.addAll(PRECACHE);
+        try {
+            await guardarShell(cache, await fetch(SHELL, { credentials: "same-origin" }));
+        } catch (e) { /* Sem rede para o shell: fica para a primeira visita */ }
+        await self.skipWaiting();
+    })());
+});
+
+self.addEventListener("activate", event => {
+    event.waitUntil((async () => {
+        const nomes = await caches.keys();
+        await Promise.all(nomes.filter(nome => nome.startsWith("dra-ana-") && nome !== CACHE)
+                               .map(nome => caches.delete(nome)));
+        await self.clients.claim();
+    })());
+});
+
+self.addEventListener("fetch", event => {
+    const request = event.request;
+    if (request.method !== "GET") return;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) return;
+
+    if (request.mode === "navigate" && url.pathname === SHELL) {
+        event.respondWith((async () => {
+            const cache = await caches.open(CACHE);
+            const guardado = await cache.match(SHELL);
+            const rede = fetch(request).then(resposta => guardarShell(cache, resposta));
+            if (guardado) {
+                event.waitUntil(rede.catch(() => {}));
+                return guardado;
+            }
+            return rede;
+        })());
+    } else if (url.pathname.startsWith(PREFIXO_ASSETS)) {
+        event.respondWith((async () => {
+            const cache = await caches.open(CACHE);
+            const guardado = await cache.match(request);
+            if (guardado) return guardado;
+            const resposta = await fetch(request);
+            if (resposta.ok) await cache.put(request, resposta.clone());
+            return resposta;
+        })());
+    }
+});